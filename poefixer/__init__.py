@@ -4,3 +4,4 @@ See poeapi.py for more details on how to use this module.
 
 from .stashapi import *
 from .db import *
+from .archive import *
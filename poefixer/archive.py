@@ -0,0 +1,455 @@
+"""
+An on-disk archive of raw stash API pages, and an API class that replays it.
+
+Recording a live feed:
+
+    archive = PageArchive('pages/')
+    api = PoeApi(recorder=archive)
+    while True:
+        db.insert_api_stashes(api.get_next(), with_items=True)
+
+Replaying it later, with no network and no rate limiting:
+
+    api = ReplayPoeApi(PageArchive('pages/'))
+    while True:
+        try:
+            db.insert_api_stashes(api.get_next(), with_items=True)
+        except NoMorePages:
+            break
+
+The archive is a directory of numbered segment files. Each segment is a
+sequence of records, one per page: a fixed header, the change id that
+was requested, the page's next_change_id and the zlib-compressed page
+exactly as the API sent it. Next to each segment is a small text index
+of where each of its pages starts, so that any page can be found by
+change id without reading the segment. Segments are read through `mmap`,
+and pages are decompressed straight out of the mapping, so the
+compressed data is never copied into Python objects. Since a page's
+`PageLocation` is all that is needed to read it, pages can be handed to
+worker processes cheaply, see `PageArchive.map_pages`.
+"""
+
+
+import os
+import mmap
+import zlib
+import struct
+import logging
+import threading
+import multiprocessing
+
+import rapidjson as json
+
+from .stashapi import PoeApi, NoMorePages, extract_next_change_id
+
+
+# magic, change id length, next change id length, compressed length,
+# raw length
+_RECORD_HEADER = struct.Struct('>4sHHII')
+_RECORD_MAGIC = b'PFPG'
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+
+class PageLocation:
+    """Where one archived page lives on disk"""
+
+    __slots__ = (
+        'change_id', 'next_change_id', 'segment', 'offset',
+        'compressed_size', 'size')
+
+    def __init__(
+            self, change_id, next_change_id, segment, offset,
+            compressed_size, size):
+        self.change_id = change_id
+        self.next_change_id = next_change_id
+        self.segment = segment
+        self.offset = offset
+        self.compressed_size = compressed_size
+        self.size = size
+
+    @property
+    def end(self):
+        """The offset just past this page's data in its segment"""
+
+        return self.offset + self.compressed_size
+
+    def index_line(self):
+        """This location as a line of a segment's sidecar index"""
+
+        return "%s\t%s\t%d\t%d\t%d\n" % (
+            self.change_id or '', self.next_change_id, self.offset,
+            self.compressed_size, self.size)
+
+    @classmethod
+    def from_index_line(cls, segment, line):
+        """Parse a line written by `index_line`"""
+
+        change_id, next_change_id, offset, compressed_size, size = \
+            line.rstrip('\n').split('\t')
+        return cls(
+            change_id or None, next_change_id, segment,
+            int(offset), int(compressed_size), int(size))
+
+
+class PageArchive:
+    """
+    A directory of compressed, change-id-indexed stash API pages.
+
+    Parameters:
+
+    * `path` - The archive directory. It is created if needed.
+    * `segment_size` - Start a new segment file once the current one
+                       is at least this many bytes.
+    * `compression_level` - zlib compression level for new pages.
+    """
+
+    segment_size = 256 * 1024 * 1024
+    compression_level = 6
+
+    def __init__(
+            self, path, segment_size=None, compression_level=None,
+            logger=logging):
+        self.path = path
+        self.logger = logger
+        if segment_size is not None:
+            self.segment_size = segment_size
+        if compression_level is not None:
+            self.compression_level = compression_level
+        self._writer = None
+        self._index_writer = None
+        self._write_lock = threading.Lock()
+        self._index = None
+        self._first = None
+        self._maps = {}
+        self._map_lock = threading.Lock()
+
+    def segments(self):
+        """The list of segment file paths, oldest first"""
+
+        if not os.path.isdir(self.path):
+            return []
+        return [
+            os.path.join(self.path, name)
+            for name in sorted(os.listdir(self.path))
+            if name.endswith(SEGMENT_SUFFIX)]
+
+    def record(self, change_id, raw, next_change_id=None):
+        """
+        Append one raw page (bytes) that was fetched by requesting
+        `change_id` (None for the first page of the feed).
+        """
+
+        if next_change_id is None:
+            next_change_id = self._find_next_change_id(raw)
+        compressed = zlib.compress(raw, self.compression_level)
+        change_id_bytes = (change_id or '').encode('utf-8')
+        next_id_bytes = next_change_id.encode('utf-8')
+        header = _RECORD_HEADER.pack(
+            _RECORD_MAGIC, len(change_id_bytes), len(next_id_bytes),
+            len(compressed), len(raw))
+
+        with self._write_lock:
+            writer = self._segment_writer()
+            offset = writer.tell()
+            writer.write(header)
+            writer.write(change_id_bytes)
+            writer.write(next_id_bytes)
+            writer.write(compressed)
+            writer.flush()
+            location = PageLocation(
+                change_id, next_change_id, writer.name,
+                offset + _RECORD_HEADER.size +
+                len(change_id_bytes) + len(next_id_bytes),
+                len(compressed), len(raw))
+            self._index_writer.write(location.index_line())
+            self._index_writer.flush()
+            if self._index is not None:
+                self._add_location(location)
+        self.logger.debug(
+            "Archived page %s (%s -> %s bytes)",
+            change_id, len(raw), len(compressed))
+
+    def close(self):
+        """Close the segment being written, if any"""
+
+        with self._write_lock:
+            if self._writer:
+                self._writer.close()
+                self._index_writer.close()
+                self._writer = None
+                self._index_writer = None
+        with self._map_lock:
+            for view, mapping in self._maps.values():
+                self._unmap(view, mapping)
+            self._maps = {}
+
+    def locate(self, change_id):
+        """
+        Return the `PageLocation` of the page fetched with `change_id`,
+        or None if it is not in the archive. A `change_id` of None means
+        the earliest page in the archive.
+        """
+
+        index = self._get_index()
+        if change_id is None:
+            return self._first
+        return index.get(change_id)
+
+    def read(self, location):
+        """Return the raw page (bytes) at a `PageLocation`"""
+
+        view = self._segment_view(location.segment, location.end)
+        return zlib.decompress(view[location.offset:location.end])
+
+    def read_chunks(self, location, chunk_size=64 * 1024):
+        """
+        Generate the raw page at a `PageLocation` as a series of chunks
+        of roughly `chunk_size` bytes, decompressing as we go rather
+        than holding the whole page in memory.
+        """
+
+        view = self._segment_view(location.segment, location.end)
+        decompressor = zlib.decompressobj()
+        for start in range(location.offset, location.end, chunk_size):
+            data = view[start:min(start + chunk_size, location.end)]
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+    def locations(self, start_id=None):
+        """
+        Generate the `PageLocation` of each page following the chain of
+        change ids from `start_id` until it leaves the archive.
+        """
+
+        location = self.locate(start_id)
+        while location is not None:
+            yield location
+            if location.next_change_id == location.change_id:
+                # The live API repeats the last id when it has caught up
+                break
+            location = self.locate(location.next_change_id)
+
+    def pages(self, start_id=None):
+        """
+        Generate `(change_id, next_change_id, raw)` tuples following the
+        chain of change ids from `start_id` until it leaves the archive.
+        """
+
+        for location in self.locations(start_id):
+            yield (
+                location.change_id, location.next_change_id,
+                self.read(location))
+
+    def map_pages(self, func, start_id=None, processes=None):
+        """
+        Call `func(change_id, raw)` on each page in the chain from
+        `start_id`, spread across a pool of `processes` worker processes,
+        and generate the results in chain order.
+
+        Only page locations are sent to the workers; each of them maps
+        the segment files itself. `func` must be picklable, so it should
+        be a module-level function.
+        """
+
+        pool = multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(self.path,))
+        try:
+            for result in pool.imap(
+                    _call_worker,
+                    ((func, location) for location in self.locations(start_id))):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def _segment_writer(self):
+        if self._writer and self._writer.tell() >= self.segment_size:
+            self._writer.close()
+            self._index_writer.close()
+            self._writer = None
+        if not self._writer:
+            segments = self.segments()
+            if segments and os.path.getsize(segments[-1]) < self.segment_size:
+                name = segments[-1]
+                # Make sure the sidecar index is complete before appending
+                self._segment_locations(name)
+            else:
+                os.makedirs(self.path, exist_ok=True)
+                name = os.path.join(
+                    self.path, '%08d%s' % (len(segments), SEGMENT_SUFFIX))
+            self._writer = open(name, 'ab')
+            self._index_writer = open(self._index_path(name), 'a')
+        return self._writer
+
+    def _segment_view(self, path, end):
+        """
+        Return a memoryview of the mapped segment at `path`, which must
+        be at least `end` bytes long (it may have grown since we last
+        mapped it).
+        """
+
+        with self._map_lock:
+            if path in self._maps:
+                view, mapping = self._maps[path]
+                if len(view) >= end:
+                    return view
+                self._unmap(view, mapping)
+            with open(path, 'rb') as segment:
+                mapping = mmap.mmap(
+                    segment.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapping)
+            if len(view) < end:
+                raise ValueError("Page archive segment %s is truncated" % path)
+            self._maps[path] = (view, mapping)
+            return view
+
+    @staticmethod
+    def _unmap(view, mapping):
+        try:
+            view.release()
+            mapping.close()
+        except BufferError:
+            # A reader still holds a slice; the mapping goes away with it
+            pass
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = {}
+            for segment in self.segments():
+                for location in self._segment_locations(segment):
+                    self._add_location(location)
+        return self._index
+
+    @staticmethod
+    def _index_path(segment):
+        return segment[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+    def _segment_locations(self, segment):
+        """
+        Return the list of page locations in a segment, from its sidecar
+        index if that is up to date, or by scanning the segment's record
+        headers (and rewriting the index) if not.
+        """
+
+        index_path = self._index_path(segment)
+        segment_size = os.path.getsize(segment)
+        if os.path.exists(index_path):
+            with open(index_path) as index:
+                locations = [
+                    PageLocation.from_index_line(segment, line)
+                    for line in index if line.strip()]
+            end = locations[-1].end if locations else 0
+            if end == segment_size:
+                return locations
+            self.logger.warning("Rebuilding stale page index %s", index_path)
+        locations = list(self._scan_segment(segment))
+        with open(index_path, 'w') as index:
+            index.writelines(location.index_line() for location in locations)
+        return locations
+
+    def _add_location(self, location):
+        if self._first is None:
+            self._first = location
+        # If a page was archived twice, the later copy wins
+        self._index[location.change_id] = location
+
+    def _scan_segment(self, path):
+        """Read just the record headers of a segment"""
+
+        with open(path, 'rb') as segment:
+            while True:
+                offset = segment.tell()
+                header = segment.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    if header:
+                        self.logger.warning(
+                            "Truncated page header in %s at %s", path, offset)
+                    return
+                (magic, id_size, next_id_size, compressed_size, size) = \
+                    _RECORD_HEADER.unpack(header)
+                if magic != _RECORD_MAGIC:
+                    raise ValueError(
+                        "Corrupt page archive segment %s at %s" % (
+                            path, offset))
+                change_id = segment.read(id_size).decode('utf-8') or None
+                next_change_id = segment.read(next_id_size).decode('utf-8')
+                location = PageLocation(
+                    change_id, next_change_id, path, segment.tell(),
+                    compressed_size, size)
+                if location.end > os.path.getsize(path):
+                    self.logger.warning(
+                        "Truncated page in %s at %s", path, offset)
+                    return
+                yield location
+                segment.seek(compressed_size, os.SEEK_CUR)
+
+    @staticmethod
+    def _find_next_change_id(raw):
+        next_change_id = extract_next_change_id(raw[:PoeApi.next_id_scan_limit])
+        if next_change_id is None:
+            # pylint: disable=c-extension-no-member
+            next_change_id = json.loads(raw)['next_change_id']
+        return next_change_id
+
+
+class ReplayPoeApi(PoeApi):
+    """
+    A `PoeApi` that reads pages from a `PageArchive` instead of the
+    network. It has the same `get_next` interface, but no rate limit,
+    and raises `NoMorePages` when the chain of change ids runs out of
+    archived pages. `next_id` defaults to the earliest archived page.
+    """
+
+    def __init__(self, archive, next_id=None, **kwargs):
+        super().__init__(next_id=next_id, **kwargs)
+        self.archive = archive
+        self._last_change_id = None
+
+    def rate_wait(self):
+        """Archived pages are never rate limited"""
+
+    def fetch_raw(self, next_id=None, slow=False, on_next_id=None):
+        location = self._locate(next_id)
+        if on_next_id is not None:
+            on_next_id(location.next_change_id)
+        return self.archive.read(location)
+
+    def fetch_chunks(self, next_id=None, slow=False):
+        return self.archive.read_chunks(
+            self._locate(next_id), chunk_size=self.chunk_size)
+
+    def _locate(self, next_id):
+        location = self.archive.locate(next_id)
+        if location is None:
+            raise NoMorePages("Change id %s is not in the archive" % next_id)
+        if next_id is not None and next_id == self._last_change_id:
+            # A caught-up page points back at itself
+            raise NoMorePages("Archive ends at change id %s" % next_id)
+        self._last_change_id = location.change_id
+        self.logger.info("Replaying stash set: %s", location.change_id)
+        return location
+
+
+# The archive opened by each `map_pages` worker process
+_worker_archive = None
+
+
+def _init_worker(path):
+    global _worker_archive
+    _worker_archive = PageArchive(path)
+
+
+def _call_worker(job):
+    func, location = job
+    return func(location.change_id, _worker_archive.read(location))
+
+
+# vim: et:sw=4:sts=4:ai:
@@ -0,0 +1,189 @@
+"""
+Columnar representations of a page of API data.
+
+An `ItemBatch` holds all of the items in a page (one `get_next` worth
+of stashes) as columns rather than objects: numeric fields and flags are
+NumPy arrays and strings are dictionary-encoded (`DictionaryColumn`), so
+that a consumer can work on a whole column at once. Strings in this data
+repeat constantly (a page has a handful of leagues and a few dozen price
+notes) so anything done per value, such as parsing notes, only needs to
+be done once per distinct value:
+
+    batch = ItemBatch.from_stashes(api.get_next())
+    prices = batch['note'].map_unique(parse_note)
+    standard = batch['league'].equals('Standard')
+"""
+
+
+import numpy
+
+
+class DictionaryColumn:
+    """
+    A column of strings (or None) stored as an array of integer `codes`
+    that index into a list of the distinct `values`.
+    """
+
+    __slots__ = ('codes', 'values')
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    @classmethod
+    def encode(cls, strings):
+        """Build a column from an iterable of strings"""
+
+        lookup = {}
+        codes = [lookup.setdefault(value, len(lookup)) for value in strings]
+        return cls(numpy.array(codes, dtype=numpy.int32), list(lookup))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def __iter__(self):
+        values = self.values
+        return (values[code] for code in self.codes.tolist())
+
+    def tolist(self):
+        """The decoded column as a list"""
+
+        values = self.values
+        return [values[code] for code in self.codes.tolist()]
+
+    def map_unique(self, func):
+        """
+        Return a list of `func(value)` for every row, calling `func` only
+        once per distinct value.
+        """
+
+        results = [func(value) for value in self.values]
+        return [results[code] for code in self.codes.tolist()]
+
+    def equals(self, value):
+        """A boolean array of the rows that hold `value`"""
+
+        try:
+            code = self.values.index(value)
+        except ValueError:
+            return numpy.zeros(len(self.codes), dtype=bool)
+        return self.codes == code
+
+    def isin(self, values):
+        """A boolean array of the rows that hold any of `values`"""
+
+        values = set(values)
+        codes = [
+            code for code, value in enumerate(self.values) if value in values]
+        return numpy.isin(self.codes, codes)
+
+
+class ItemBatch:
+    """
+    The items of a page of stashes, by column.
+
+    * `stashes` - The stashes (`ApiStash` or `CompactApiStash`) that the
+                  items came from.
+    * `stash_index` - For each item, its stash's index in `stashes`.
+    * `api_ids` - The API ids of the items, in order.
+
+    Indexing the batch by field name returns its column: a
+    `numpy.ma.MaskedArray` (masked where the API gave no value) for
+    `int_fields` and `flag_fields`, a `DictionaryColumn` for
+    `string_fields` and a list for anything else. The extra string
+    column `stash` is the name of each item's stash.
+    """
+
+    int_fields = (
+        'h', 'w', 'x', 'y', 'frameType', 'ilvl', 'stackSize',
+        'maxStackSize', 'talismanTier')
+    flag_fields = (
+        'abyssJewel', 'corrupted', 'duplicated', 'elder', 'identified',
+        'isRelic', 'lockedToCharacter', 'shaper', 'support', 'verified')
+    string_fields = (
+        'league', 'typeLine', 'name', 'note', 'inventoryId', 'icon',
+        'artFilename', 'descrText', 'secDescrText', 'prophecyText',
+        'prophecyDiffText')
+    object_fields = (
+        'category', 'cosmeticMods', 'craftedMods', 'enchantMods',
+        'explicitMods', 'flavourText', 'implicitMods',
+        'nextLevelRequirements', 'properties', 'requirements', 'sockets',
+        'utilityMods')
+
+    def __init__(self, stashes, stash_index, api_ids, columns):
+        self.stashes = stashes
+        self.stash_index = stash_index
+        self.api_ids = api_ids
+        self.columns = columns
+
+    @classmethod
+    def from_stashes(cls, stashes):
+        """Build a batch from an iterable of stashes, such as a page"""
+
+        stashes = list(stashes)
+        fields = (
+            cls.int_fields + cls.flag_fields + cls.string_fields +
+            cls.object_fields)
+        values = dict((field, []) for field in fields)
+        appenders = [(field, values[field].append) for field in fields]
+        stash_index = []
+        api_ids = []
+        for index, stash in enumerate(stashes):
+            for item in stash.items:
+                stash_index.append(index)
+                api_ids.append(item.id)
+                for field, append in appenders:
+                    append(getattr(item, field, None))
+
+        stash_names = [stash.stash for stash in stashes]
+        columns = {}
+        for field in cls.int_fields:
+            columns[field] = cls._masked(values[field], numpy.int64, 0)
+        for field in cls.flag_fields:
+            columns[field] = cls._masked(values[field], bool, False)
+        for field in cls.string_fields:
+            columns[field] = DictionaryColumn.encode(values[field])
+        for field in cls.object_fields:
+            columns[field] = values[field]
+        columns['stash'] = DictionaryColumn.encode(
+            stash_names[index] for index in stash_index)
+
+        return cls(
+            stashes, numpy.array(stash_index, dtype=numpy.int32), api_ids,
+            columns)
+
+    @staticmethod
+    def _masked(values, dtype, fill):
+        mask = numpy.fromiter(
+            (value is None for value in values), dtype=bool, count=len(values))
+        data = numpy.array(
+            [fill if value is None else value for value in values],
+            dtype=dtype)
+        return numpy.ma.MaskedArray(data, mask=mask)
+
+    def __len__(self):
+        return len(self.api_ids)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def column_list(self, field):
+        """A column as a plain list, with None for missing values"""
+
+        column = self.columns[field]
+        if isinstance(column, list):
+            return column
+        return column.tolist()
+
+    def rows(self, fields):
+        """Yield a dict of the given `fields` per item"""
+
+        columns = [self.column_list(field) for field in fields]
+        for values in zip(*columns):
+            yield dict(zip(fields, values))
+
+
+# vim: et:sw=4:sts=4:ai:
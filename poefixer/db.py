@@ -8,12 +8,20 @@ and a new, auto-incrementing primary key is labeled "id".
 
 
 import re
+import zlib
 import time
+import hashlib
 import logging
+import collections
 import sqlalchemy
+import sqlalchemy.dialects.mysql
+import sqlalchemy.dialects.sqlite
+import sqlalchemy.dialects.postgresql
 from sqlalchemy.ext.declarative import declarative_base
 import rapidjson as json
 
+from .batch import DictionaryColumn
+
 PoeDbBase = declarative_base()
 PoeDbMetadata = PoeDbBase.metadata
 
@@ -23,6 +31,8 @@ class SemiJSON(sqlalchemy.types.TypeDecorator):
     """A stopgap for using SQLite implementations that do not support JSON"""
 
     impl = sqlalchemy.UnicodeText
+    # Stateless, so statements using it can be cached
+    cache_ok = True
 
     def load_dialect_impl(self, dialect):
         if dialect.name == 'sqlite':
@@ -60,6 +70,8 @@ class Stash(PoeDbBase):
     stash = sqlalchemy.Column(sqlalchemy.Unicode(255))
     stashType = sqlalchemy.Column(sqlalchemy.Unicode(32), nullable=False)
     public = sqlalchemy.Column(sqlalchemy.Boolean, nullable=False, index=True)
+    # A hash of the API fields, so that unchanged stashes are not rewritten
+    content_hash = sqlalchemy.Column(sqlalchemy.String(32))
     created_at = sqlalchemy.Column(
         sqlalchemy.Integer, nullable=False, index=True)
     updated_at = sqlalchemy.Column(
@@ -135,11 +147,34 @@ class Item(PoeDbBase):
     # items in it inactive, then we re-activate the one's we see again.
     active = sqlalchemy.Column(
         sqlalchemy.Boolean, nullable=False, default=True, index=True)
+    # The price set by the item's note, or failing that its stash's name,
+    # if it was parsed when the item was written (see
+    # `PoeDb(price_parser=...)`). `price_source` is 'item' or 'stash'
+    # for a priced item, '' for an item without a price and NULL if
+    # the item was never parsed, or its price's currency wasn't known.
+    price_amount = sqlalchemy.Column(sqlalchemy.Float, index=True)
+    price_currency = sqlalchemy.Column(sqlalchemy.Unicode(255))
+    price_source = sqlalchemy.Column(sqlalchemy.String(8), index=True)
+    # Derived from `category` when the item is written, so that they can
+    # be filtered on without decoding it. NULL for items written before
+    # these columns existed.
+    category_root = sqlalchemy.Column(sqlalchemy.String(32), index=True)
+    is_currency = sqlalchemy.Column(sqlalchemy.Boolean, index=True)
+    # A hash of `league` and `typeLine` (see `PoeDb.shard_key`), by
+    # which currency postprocessor workers split items between them in
+    # SQL. NULL for items written before this column existed.
+    shard_key = sqlalchemy.Column(sqlalchemy.BigInteger)
+    # A hash of the API fields and the stash's name, so that unchanged
+    # items are not rewritten (and `updated_at` only moves on a change)
+    content_hash = sqlalchemy.Column(sqlalchemy.String(32))
     created_at = sqlalchemy.Column(
         sqlalchemy.Integer, nullable=False, index=True)
     updated_at = sqlalchemy.Column(
         sqlalchemy.Integer, nullable=False, index=True)
 
+    # For keyset pagination in update order (see the postprocessors)
+    __table_args__ = (
+        sqlalchemy.Index('ix_item_updated_at_id', 'updated_at', 'id'),)
 
     def __repr__(self):
         return "<Item(name=%r, id=%s, api_id=%s, typeLine=%r)>" % (
@@ -166,6 +201,9 @@ class Sale(PoeDbBase):
         sqlalchemy.Unicode(255), nullable=False, index=True)
     sale_amount = sqlalchemy.Column(sqlalchemy.Float)
     sale_amount_chaos = sqlalchemy.Column(sqlalchemy.Float)
+    # The `CurrencyValuation.version` that `sale_amount_chaos` was last
+    # computed from, or NULL if it was computed as the sale was written
+    valuation_version = sqlalchemy.Column(sqlalchemy.Integer)
     created_at = sqlalchemy.Column(
         sqlalchemy.Integer, nullable=False, index=True)
     # The updated_at field from Item, as of the time that this sale
@@ -205,6 +243,13 @@ class CurrencySummary(PoeDbBase):
     weight = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
     mean = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
     standard_dev = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+    # Robust statistics of the same sales, unweighted, from a
+    # `poefixer.postprocess.sketch.QuantileSketch`: the median, the
+    # interquartile range and the mean of the prices within 1.5
+    # interquartile ranges of the quartiles
+    median = sqlalchemy.Column(sqlalchemy.Float)
+    interquartile_range = sqlalchemy.Column(sqlalchemy.Float)
+    trimmed_mean = sqlalchemy.Column(sqlalchemy.Float)
     created_at = sqlalchemy.Column(
         sqlalchemy.Integer, nullable=False, index=True)
     updated_at = sqlalchemy.Column(
@@ -214,6 +259,119 @@ class CurrencySummary(PoeDbBase):
         sqlalchemy.UniqueConstraint('from_currency', 'to_currency', 'league'),)
 
 
+class CurrencyValuation(PoeDbBase):
+    """
+    The value in Chaos Orbs of one currency in one league, as last used
+    to revalue sales (see `poefixer.postprocess.revalue`). `version` goes
+    up each time the value changes.
+    """
+
+    __tablename__ = 'currency_valuation'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    currency = sqlalchemy.Column(sqlalchemy.Unicode(255), nullable=False)
+    league = sqlalchemy.Column(sqlalchemy.Unicode(64), nullable=False)
+    value = sqlalchemy.Column(sqlalchemy.Float)
+    version = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    updated_at = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+    __table_args__ = (sqlalchemy.UniqueConstraint('currency', 'league'),)
+
+    def __repr__(self):
+        return "<CurrencyValuation(%s in %s = %s, version=%s)>" % (
+            self.currency, self.league, self.value, self.version)
+
+
+class PriceBucket(PoeDbBase):
+    """
+    The sufficient statistics of the sales of one `name` in one
+    `currency` in one `league` whose items were updated in one hour
+    (starting at `hour`, in Unix time), kept by
+    `poefixer.postprocess.buckets.PriceBuckets`.
+    """
+
+    __tablename__ = 'price_bucket'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.Unicode(255), nullable=False)
+    currency = sqlalchemy.Column(sqlalchemy.Unicode(255), nullable=False)
+    league = sqlalchemy.Column(sqlalchemy.Unicode(64), nullable=False)
+    hour = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, index=True)
+    count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    # The sum of the sale amounts and of their squares
+    total = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+    total_squares = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+    # The sum of the squares of the amounts less `minimum`, which keeps
+    # its precision where `total_squares` is swamped by a large mean.
+    # NULL for buckets written before this column existed.
+    minimum_squares = sqlalchemy.Column(sqlalchemy.Float)
+    minimum = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+    maximum = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+    # `poefixer.postprocess.sketch.QuantileSketch.to_bytes` of the prices
+    sketch = sqlalchemy.Column(sqlalchemy.LargeBinary)
+    updated_at = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('name', 'currency', 'league', 'hour'),)
+
+    def __repr__(self):
+        return "<PriceBucket(%s in %s, %s at %s: count=%s)>" % (
+            self.name, self.currency, self.league, self.hour, self.count)
+
+
+class ProcessingWatermark(PoeDbBase):
+    """
+    How far through the item table (in `updated_at`, `id` order) a named
+    postprocessor has got. It is updated in the same transaction as the
+    work it records, so an interrupted run resumes exactly where it
+    stopped.
+    """
+
+    __tablename__ = 'processing_watermark'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    name = sqlalchemy.Column(
+        sqlalchemy.String(64), nullable=False, unique=True)
+    item_updated_at = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    item_id = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    created_at = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    updated_at = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<ProcessingWatermark(name=%r, item_updated_at=%s, item_id=%s)>" % (
+            self.name, self.item_updated_at, self.item_id)
+
+
+class ItemChange(PoeDbBase):
+    """
+    An append-only log of the items added to, removed from or changed in
+    each stash as stashes are written, for jobs that want to work from
+    what has changed rather than scan the item table. An item that moves
+    to another stash is logged as added to its new stash, and as removed
+    from its old one if that is written first or at the same time.
+    """
+
+    __tablename__ = 'item_change'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    item_api_id = sqlalchemy.Column(
+        sqlalchemy.String(255), nullable=False, index=True)
+    stash_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey("stash.id"),
+        nullable=False, index=True)
+    change = sqlalchemy.Column(
+        sqlalchemy.Enum(
+            'added', 'removed', 'changed', name='item_change_type'),
+        nullable=False)
+    created_at = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<ItemChange(item_api_id=%s, stash_id=%s, change=%s)>" % (
+            self.item_api_id, self.stash_id, self.change)
+
+
 class PoeDb:
     """
     This is the wrapper for the item/stash database. All you need to
@@ -228,6 +386,23 @@ class PoeDb:
             for stash in api.get_next():
                 db.insert_api_stash(stash, with_items=True)
 
+    or, to write a whole page of stashes with batched upserts:
+
+        while True:
+            db.insert_api_stashes(api.get_next(), with_items=True)
+
+    If a `price_parser` is given, it is called on each item's note and
+    stash name as items are written, and should return an (amount,
+    currency) tuple, (None, None) for no price, or None for a price in
+    a currency that it doesn't know (see
+    `poefixer.postprocess.notes.PriceNoteParser.ingest_price`). The
+    result is stored in the item's `price_*` columns so that
+    postprocessing need not parse notes again, except for those with
+    unknown currencies, which are left for it to parse.
+
+    When a stash is written with its items, items that are no longer in
+    it are marked inactive and, unless `track_changes` is turned off,
+    the items added, removed and changed are logged to `item_change`.
     """
 
     db_connect = 'sqlite:///poetest.db'
@@ -235,6 +410,8 @@ class PoeDb:
     _session = None
     _engine = None
     _session_maker = None
+    price_parser = None
+    track_changes = True
 
     stash_simple_fields = [
         "accountName", "lastCharacterName", "stash", "stashType",
@@ -251,6 +428,8 @@ class PoeDb:
         "secDescrText", "shaper", "sockets",
         "stackSize", "support", "talismanTier", "typeLine",
         "utilityMods", "verified"]
+    price_fields = ["price_amount", "price_currency", "price_source"]
+    category_fields = ["category_root", "is_currency"]
 
     def insert_api_stash(self, stash, with_items=False, keep_items=False):
         """
@@ -259,32 +438,385 @@ class PoeDb:
         An optional `with_items` boolean may be set to true in order
         to recurse into the items in the given stash and insert/update
         them as well. The `keep_items` flag tells the insert to not
-        mark all items associated with this insert as inactive.
+        mark items that are no longer in the stash as inactive.
         """
 
         dbstash = self._insert_or_update_row(
             Stash, stash, self.stash_simple_fields)
 
         if with_items:
-            # For now, it seems stashes are immutable anyway
-            #if not keep_items:
-            #    self._invalidate_stash_items(dbstash)
             self.session.flush()
             self.session.refresh(dbstash)
             self.logger.debug(
                 "Injecting %s items for stash: %s",
                 stash.api_item_count, stash.id)
+            stored = self._stored_stash_items([dbstash.id])
+            incoming = {}
             for item in stash.items:
-                self._insert_or_update_row(
+                row = self._insert_or_update_row(
                     Item, item, self.item_simple_fields, stash=dbstash)
+                incoming[item.id] = (dbstash.id, row.content_hash)
+            if keep_items:
+                stored = dict(
+                    (api_id, value) for api_id, value in stored.items()
+                    if api_id in incoming)
+            self._apply_stash_diff(stored, incoming)
+
+    def insert_api_stashes(self, stashes, with_items=False, batch_size=None):
+        """
+        Bulk version of `insert_api_stash` for a whole page of stashes
 
-    def _invalidate_stash_items(self, dbstash):
-        """Mark all items in this stash as inactive, pending update"""
+        Rather than querying for and adding each row through the ORM,
+        stashes (and, if `with_items` is set, their items) are written
+        with one batched upsert per table. The upsert is dialect-aware
+        (see `upsert_rows`). Returns a tuple of the number of stashes
+        and items written.
 
-        update = sqlalchemy.sql.expression.update(Item)
-        update = update.where(Item.stash_id == dbstash.id)
-        update = update.values(active=False)
-        self.session.execute(update)
+        If `batch_size` is set, rows are written every `batch_size`
+        stashes instead of once per page, so that a streamed page (see
+        `PoeApi(streaming=True)`) is never held in memory all at once.
+        """
+
+        stash_count = item_count = 0
+        batch = []
+        for stash in stashes:
+            batch.append(stash)
+            if batch_size and len(batch) >= batch_size:
+                counts = self._insert_stash_batch(batch, with_items)
+                stash_count += counts[0]
+                item_count += counts[1]
+                batch = []
+        if batch:
+            counts = self._insert_stash_batch(batch, with_items)
+            stash_count += counts[0]
+            item_count += counts[1]
+        return (stash_count, item_count)
+
+    def _insert_stash_batch(self, stashes, with_items):
+        if with_items:
+            return self._insert_stash_items(stashes)
+
+        now = int(time.time())
+        stash_rows = self._changed_rows(Stash, self._stash_rows(stashes, now))
+        self.upsert_rows(
+            Stash, stash_rows,
+            ['updated_at', 'content_hash'] + self.stash_simple_fields)
+        return (len(stash_rows), 0)
+
+    def _insert_stash_items(self, stashes):
+        """
+        Write `stashes` and their items with batched upserts. Stashes and
+        items whose `content_hash` has not changed are left alone.
+        Returns a tuple of the number of stashes and items written.
+        """
+
+        now = int(time.time())
+        stash_rows = self._stash_rows(stashes, now)
+        changed_stashes = self._changed_rows(Stash, stash_rows)
+        self.upsert_rows(
+            Stash, changed_stashes,
+            ['updated_at', 'content_hash'] + self.stash_simple_fields)
+        pairs = [(stash, item) for stash in stashes for item in stash.items]
+
+        # Emptied stashes still need their old items diffed away
+        stash_ids = self._api_ids_to_ids(Stash, list(stash_rows.keys()))
+        item_rows = collections.OrderedDict()
+        prices = self._page_item_prices(pairs) if pairs else []
+        for (stash, item), price in zip(pairs, prices):
+            row = self._api_row(item, self.item_simple_fields, now)
+            row['content_hash'] = self._item_hash(row, stash.id, stash.stash)
+            row.update(zip(self.price_fields, price))
+            row.update(zip(
+                self.category_fields, self.category_columns(row['category'])))
+            row['shard_key'] = self.shard_key(row['league'], row['typeLine'])
+            row['stash_id'] = stash_ids[stash.id]
+            row['active'] = True
+            # Later copies of an item in the same page win
+            item_rows.pop(item.id, None)
+            item_rows[item.id] = row
+
+        stored = self._stored_stash_items(
+            sorted(set(stash_ids[api_id] for api_id in stash_rows)))
+        changed_items = self._changed_rows(Item, item_rows)
+        self.logger.debug(
+            "Bulk injecting %s of %s items for %s of %s stashes",
+            len(changed_items), len(item_rows),
+            len(changed_stashes), len(stash_rows))
+        self.upsert_rows(
+            Item, changed_items,
+            ['stash_id', 'active', 'updated_at', 'content_hash'] +
+                self.item_simple_fields + self.price_fields +
+                self.category_fields + ['shard_key'])
+        self._apply_stash_diff(stored, dict(
+            (api_id, (row['stash_id'], row['content_hash']))
+            for api_id, row in item_rows.items()))
+
+        return (len(changed_stashes), len(changed_items))
+
+    def _stored_stash_items(self, stash_ids):
+        """
+        The active items of the stashes with the database ids
+        `stash_ids`, as a dict of api_id to (id, stash_id, content_hash).
+        """
+
+        stored = {}
+        for chunk in self._chunks(stash_ids):
+            query = self.session.query(
+                Item.api_id, Item.id, Item.stash_id, Item.content_hash)
+            query = query.filter(Item.stash_id.in_(chunk))
+            query = query.filter(Item.active == True)
+            stored.update(
+                (row.api_id, (row.id, row.stash_id, row.content_hash))
+                for row in query.all())
+        return stored
+
+    def _apply_stash_diff(self, stored, incoming):
+        """
+        Given the `stored` active items of some stashes (see
+        `_stored_stash_items`) and the items just written to them (a dict
+        of api_id to (stash_id, content_hash)), deactivate the stored
+        items that were not written and log the changes to `item_change`.
+        """
+
+        now = int(time.time())
+        gone = [
+            item_id for api_id, (item_id, _, _) in stored.items()
+            if api_id not in incoming]
+        for chunk in self._chunks(gone):
+            update = sqlalchemy.sql.expression.update(Item)
+            update = update.where(Item.id.in_(chunk))
+            update = update.values(active=False)
+            self.session.execute(update)
+
+        if not self.track_changes:
+            return
+        # Items that moved are removed from one stash and added to another
+        changes = [
+            {'item_api_id': api_id, 'stash_id': stash_id,
+                'change': 'removed', 'created_at': now}
+            for api_id, (_, stash_id, _) in stored.items()
+            if incoming.get(api_id, (None,))[0] != stash_id]
+        for api_id, (stash_id, content_hash) in incoming.items():
+            old = stored.get(api_id)
+            if old is None or old[1] != stash_id:
+                change = 'added'
+            elif old[2] != content_hash:
+                change = 'changed'
+            else:
+                continue
+            changes.append({
+                'item_api_id': api_id, 'stash_id': stash_id,
+                'change': change, 'created_at': now})
+        if changes:
+            self.session.execute(
+                sqlalchemy.sql.expression.insert(ItemChange.__table__),
+                changes)
+
+    @staticmethod
+    def _content_hash(values):
+        """A compact hash of a list of JSON-able API values"""
+
+        return hashlib.blake2b(
+            json.dumps(values).encode('utf-8'), digest_size=16).hexdigest()
+
+    def _item_hash(self, row, stash_api_id, stash_name):
+        """
+        The `content_hash` of an item, given a dict of its
+        `item_simple_fields` and its stash's API id and name. The name is
+        part of it because it can price the item, as is whether prices
+        are being parsed, so that the `price_fields` are filled in once a
+        `price_parser` is used.
+        """
+
+        values = [row[field] for field in self.item_simple_fields]
+        values.extend(
+            (stash_api_id, stash_name, self.price_parser is not None))
+        return self._content_hash(values)
+
+    def _changed_rows(self, table, rows):
+        """
+        Of `rows` (a dict of bulk-write rows by api_id), the list of those
+        that are new or whose `content_hash` differs from the database's.
+        """
+
+        stored = {}
+        api_ids = list(rows.keys())
+        for chunk in self._chunks(api_ids):
+            query = self.session.query(table.api_id, table.content_hash)
+            query = query.filter(table.api_id.in_(chunk))
+            if table == Item:
+                # Inactive items are rewritten to reactivate them
+                query = query.filter(Item.active == True)
+            stored.update(query.all())
+        return [
+            row for api_id, row in rows.items()
+            if stored.get(api_id) != row['content_hash']]
+
+    @staticmethod
+    def category_columns(category):
+        """
+        The `category_fields` values for an item's API `category`, which
+        is an object with a single key (e.g. "currency" or "armour")
+        mapping to a list of sub-categories.
+        """
+
+        if not category:
+            return (None, False)
+        return (next(iter(category)), 'currency' in category)
+
+    @staticmethod
+    def shard_key(league, type_line):
+        """
+        The `Item.shard_key` of an item in `league` with base type
+        `type_line`: all of the sales that go into a currency summary
+        (which are by name and league) have the same one.
+        """
+
+        key = "%s\0%s" % (league, type_line)
+        return zlib.crc32(key.encode('utf-8'))
+
+    def _item_price(self, note_price, stash_price):
+        """
+        The `price_fields` values for an item, given the parsed prices of
+        its note and its stash's name.
+        """
+
+        if self.price_parser is None or note_price is None:
+            return (None, None, None)
+        if note_price[0] is not None:
+            return (note_price[0], note_price[1], 'item')
+        if stash_price is None:
+            return (None, None, None)
+        if stash_price[0] is not None:
+            return (stash_price[0], stash_price[1], 'stash')
+        return (None, None, '')
+
+    def _page_item_prices(self, pairs):
+        """
+        The `price_fields` values for each of a page's (stash, item)
+        `pairs`.
+        """
+
+        if self.price_parser is None:
+            return [(None, None, None)] * len(pairs)
+        # Notes and stash names repeat, so parse each distinct one once
+        notes = DictionaryColumn.encode(
+            getattr(item, 'note', None) for _, item in pairs)
+        stash_names = DictionaryColumn.encode(stash.stash for stash, _ in pairs)
+        return [
+            self._item_price(note_price, stash_price)
+            for note_price, stash_price in zip(
+                notes.map_unique(self._parse_price),
+                stash_names.map_unique(self._parse_price))]
+
+    def _stash_rows(self, stashes, now):
+        """Bulk-write rows for `stashes`, by api_id (later copies win)"""
+
+        stash_rows = collections.OrderedDict()
+        for stash in stashes:
+            row = self._api_row(stash, self.stash_simple_fields, now)
+            row['content_hash'] = self._content_hash(
+                [row[field] for field in self.stash_simple_fields])
+            stash_rows.pop(stash.id, None)
+            stash_rows[stash.id] = row
+        return stash_rows
+
+    def upsert_rows(self, table, rows, update_fields, key='api_id'):
+        """
+        Insert `rows` (a list of dicts that all have the same keys) into
+        `table`, updating only `update_fields` where a row with the same
+        unique `key` already exists.
+
+        MySQL gets `INSERT ... ON DUPLICATE KEY UPDATE`, SQLite and
+        PostgreSQL get `INSERT ... ON CONFLICT DO UPDATE` and anything
+        else falls back to a batched UPDATE of existing keys followed
+        by a batched INSERT of the rest.
+        """
+
+        if not rows:
+            return
+
+        cmd = self._upsert_command(
+            table, update_fields, key, self.session.bind.dialect.name)
+        if cmd is None:
+            self._update_then_insert_rows(table, rows, update_fields, key)
+        else:
+            self.session.execute(cmd, rows)
+
+    @staticmethod
+    def _upsert_command(table, update_fields, key, dialect):
+        """
+        The single statement upsert of `upsert_rows` for the `dialect`
+        name, or None if it has none.
+        """
+
+        if dialect == 'mysql':
+            cmd = sqlalchemy.dialects.mysql.insert(table.__table__)
+            return cmd.on_duplicate_key_update(
+                dict((field, cmd.inserted[field]) for field in update_fields))
+        elif dialect in ('sqlite', 'postgresql'):
+            dialect_module = getattr(sqlalchemy.dialects, dialect)
+            cmd = dialect_module.insert(table.__table__)
+            return cmd.on_conflict_do_update(
+                index_elements=[key],
+                set_=dict(
+                    (field, cmd.excluded[field]) for field in update_fields))
+        return None
+
+    def _update_then_insert_rows(self, table, rows, update_fields, key):
+        """Portable, executemany-based fallback for `upsert_rows`"""
+
+        key_field = getattr(table, key)
+        existing = set()
+        keys = [row[key] for row in rows]
+        for chunk in self._chunks(keys):
+            query = self.session.query(key_field).filter(key_field.in_(chunk))
+            existing.update(row[0] for row in query.all())
+
+        updates = [row for row in rows if row[key] in existing]
+        inserts = [row for row in rows if row[key] not in existing]
+
+        if updates:
+            cmd = sqlalchemy.sql.expression.update(table.__table__)
+            cmd = cmd.where(key_field == sqlalchemy.bindparam('_key'))
+            cmd = cmd.values(dict(
+                (field, sqlalchemy.bindparam(field))
+                for field in update_fields))
+            self.session.execute(cmd, [
+                dict([('_key', row[key])] + [
+                    (field, row[field]) for field in update_fields])
+                for row in updates])
+        if inserts:
+            self.session.execute(
+                sqlalchemy.sql.expression.insert(table.__table__), inserts)
+
+    def _api_ids_to_ids(self, table, api_ids):
+        """Return a mapping of api_id to primary key id for `table`"""
+
+        mapping = {}
+        for chunk in self._chunks(api_ids):
+            query = self.session.query(table.api_id, table.id)
+            query = query.filter(table.api_id.in_(chunk))
+            mapping.update((row.api_id, row.id) for row in query.all())
+        return mapping
+
+    @staticmethod
+    def _api_row(thing, simple_fields, now):
+        """Turn an API object into a dict of column values for bulk writes"""
+
+        row = dict(
+            (field, getattr(thing, field, None)) for field in simple_fields)
+        row['api_id'] = thing.id
+        row['created_at'] = now
+        row['updated_at'] = now
+        return row
+
+    @staticmethod
+    def _chunks(values, size=500):
+        """Break up `values` for IN clauses that respect bind limits"""
+
+        for start in range(0, len(values), size):
+            yield values[start:start+size]
 
     def _insert_or_update_row(self, table, thing, simple_fields, stash=None):
         now = int(time.time())
@@ -293,6 +825,19 @@ class PoeDb:
             existing = query.filter(table.api_id == thing.id).one_or_none()
         else:
             existing = None
+
+        values = dict(
+            (field, getattr(thing, field, None)) for field in simple_fields)
+        if table == Item:
+            content_hash = self._item_hash(values, stash.api_id, stash.stash)
+        else:
+            content_hash = self._content_hash(
+                [values[field] for field in simple_fields])
+        if (existing and existing.content_hash == content_hash and
+                (table != Item or existing.active)):
+            # Nothing has changed
+            return existing
+
         if existing:
             row = existing
         else:
@@ -301,13 +846,25 @@ class PoeDb:
 
         row.api_id = thing.id
         row.updated_at = now
+        row.content_hash = content_hash
         if stash:
             row.stash_id = stash.id
         if table == Item:
             row.active = True
 
         for field in simple_fields:
-            setattr(row, field, getattr(thing, field, None))
+            setattr(row, field, values[field])
+
+        if table == Item:
+            price = self._item_price(
+                self._parse_price(row.note),
+                self._parse_price(stash.stash if stash else None))
+            for field, value in zip(self.price_fields, price):
+                setattr(row, field, value)
+            for field, value in zip(
+                    self.category_fields, self.category_columns(row.category)):
+                setattr(row, field, value)
+            row.shard_key = self.shard_key(row.league, row.typeLine)
 
         self.session.add(row)
         return row
@@ -321,15 +878,61 @@ class PoeDb:
         return self._session
 
     def create_database(self):
-        """Write a new database from our schema"""
+        """
+        Write a new database from our schema, or bring an existing one up
+        to date by adding any tables and columns that it lacks.
+        """
 
         PoeDbBase.metadata.create_all(self._engine)
+        self._add_missing_columns()
+
+    def _add_missing_columns(self):
+        """
+        `create_all` only creates missing tables, so add (nullable)
+        columns that were added to the schema since a table was created,
+        along with their indexes.
+        """
+
+        inspector = sqlalchemy.inspect(self._engine)
+        dialect = self._engine.dialect
+        quote = dialect.identifier_preparer.quote
+        for table in PoeDbBase.metadata.sorted_tables:
+            existing = set(
+                column['name'] for column in inspector.get_columns(table.name))
+            missing = [
+                column for column in table.columns
+                if column.name not in existing]
+            if not missing:
+                continue
+            with self._engine.begin() as connection:
+                for column in missing:
+                    self.logger.info(
+                        "Adding column %s.%s", table.name, column.name)
+                    connection.execute(sqlalchemy.text(
+                        "ALTER TABLE %s ADD COLUMN %s %s" % (
+                            quote(table.name), quote(column.name),
+                            column.type.compile(dialect=dialect))))
+                for index in table.indexes:
+                    if any(index.columns.contains_column(column)
+                            for column in missing):
+                        index.create(connection, checkfirst=True)
+
+    def _parse_price(self, note):
+        if self.price_parser is None or note is None:
+            return (None, None)
+        return self.price_parser(note)
 
     def _safe_uri(self, uri):
         return self._safe_uri_re.sub('******', uri)
 
-    def __init__(self, db_connect=None, echo=False, logger=logging):
+    def __init__(
+            self, db_connect=None, echo=False, price_parser=None,
+            track_changes=None, logger=logging):
         self.logger=logger
+        if price_parser is not None:
+            self.price_parser = price_parser
+        if track_changes is not None:
+            self.track_changes = track_changes
 
         if db_connect is not None:
             self.logger.debug("Connect URI: %s", self._safe_uri(db_connect))
@@ -14,3 +14,34 @@ where
 	(sale.is_currency = 1 or sale.sale_currency != 'Chaos Orb')
 order by sale.id desc
 limit 30;
+
+# Count the items up for sale in each league by category, using the
+# category_root and price columns filled in as items are written rather
+# than the raw category JSON (price_* needs the reader's --parse-prices)
+select
+	substr(item.league, 1, 10) as `league`,
+	item.category_root as `category`,
+	count(*) as `items`,
+	sum(item.is_currency) as `currency`
+from item
+where
+	item.price_amount is not null
+group by item.league, item.category_root
+order by `items` desc
+limit 30;
+
+# Hourly price history of one currency in chaos, from the price_bucket
+# rows kept by `fixer.py currency --price-buckets`
+select
+	from_unixtime(price_bucket.hour) as `hour`,
+	price_bucket.count as `sales`,
+	round(price_bucket.total/price_bucket.count,2) as `mean`,
+	round(price_bucket.minimum,2) as `low`,
+	round(price_bucket.maximum,2) as `high`
+from price_bucket
+where
+	price_bucket.name = 'Exalted Orb' and
+	price_bucket.currency = 'Chaos Orb' and
+	price_bucket.league = 'Standard'
+order by price_bucket.hour desc
+limit 48;
@@ -0,0 +1,226 @@
+"""
+A local stand-in for the public stash tab API, for load testing
+
+`MockStashServer` serves `SyntheticPages` (see `poefixer.extra.synthetic`)
+over HTTP at the same path as the real API, optionally with added
+latency and rate limits. Point a `PoeApi` at it with `api_root`:
+
+    with MockStashServer(pages=SyntheticPages(seed=1)) as server:
+        api = PoeApi(api_root=server.api_root, rate=0)
+        stashes = list(api.get_next())
+
+Or run `scripts/mock_stash_server.py` to serve it from the command line.
+"""
+
+
+import time
+import logging
+import threading
+import collections
+import http.server
+import urllib.parse
+
+from .synthetic import SyntheticPages
+
+
+API_PATH = '/api/public-stash-tabs'
+
+
+class _StashApiHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the pages of the `MockStashServer` in `self.server.mock`"""
+
+    # Keep connections open, as the real API does
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so don't let Nagle's
+    # algorithm hold the body back waiting for an ACK.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        mock = self.server.mock
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.rstrip('/') != API_PATH:
+            self._send(404, b'{"error": {"message": "Not found"}}')
+            return
+        change_id = urllib.parse.parse_qs(url.query).get('id', [None])[0]
+
+        if mock.latency:
+            time.sleep(mock.latency)
+        status, headers = mock.check_rate_limit()
+        if status != 200:
+            self._send(status, b'{"error": {"message": "Rate limited"}}', headers)
+            return
+        try:
+            body = mock.page(change_id)
+        except ValueError:
+            self._send(400, b'{"error": {"message": "Invalid query"}}', headers)
+            return
+        self._send(200, body, headers)
+
+    def _send(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        self.server.mock.logger.debug(format, *args)
+
+
+class MockStashServer:
+    """
+    A threaded HTTP server for synthetic stash API pages.
+
+    * `pages` - The `SyntheticPages` to serve (a default set if not given).
+    * `host`, `port` - Where to listen. Port 0 picks a free port.
+    * `latency` - Seconds (float) to wait before answering each request.
+    * `max_pages` - After this many pages, the chain ends: requests for
+                    later change ids get an empty page that points back
+                    to itself, as the real API does when you catch up.
+    * `rate_limit` - A list of `(hits, period, penalty)` limits to send in
+                     the `X-Rate-Limit-Ip` headers and enforce with 429s.
+    * `cache_size` - The number of generated pages to keep, so that
+                     several clients reading the same chain are cheap.
+    """
+
+    host = '127.0.0.1'
+    port = 0
+    latency = 0
+    max_pages = None
+    rate_limit = None
+    cache_size = 16
+
+    def __init__(
+            self, pages=None, host=None, port=None, latency=None,
+            max_pages=None, rate_limit=None, cache_size=None,
+            logger=logging):
+        self.pages = pages or SyntheticPages()
+        if host is not None:
+            self.host = host
+        if port is not None:
+            self.port = port
+        if latency is not None:
+            self.latency = latency
+        if max_pages is not None:
+            self.max_pages = max_pages
+        if rate_limit is not None:
+            self.rate_limit = rate_limit
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.logger = logger
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._hits = collections.deque()
+        self._blocked_until = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def api_root(self):
+        """The `api_root` to give to `PoeApi`"""
+
+        return 'http://%s:%s%s' % (self.host, self.port, API_PATH)
+
+    def start(self):
+        """Start serving in a background thread"""
+
+        self._server = http.server.ThreadingHTTPServer(
+            (self.host, self.port), _StashApiHandler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self.logger.info("Mock stash API listening at %s", self.api_root)
+        return self
+
+    def serve_forever(self):
+        """Serve in the calling thread until interrupted"""
+
+        self.start()
+        try:
+            while self._thread.is_alive():
+                self._thread.join(1)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop serving"""
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def page(self, change_id):
+        """The raw page for `change_id`, from the cache if possible"""
+
+        with self._lock:
+            self.requests += 1
+        if self.max_pages is not None:
+            page_no = self.pages.page_number(change_id)
+            if page_no >= self.max_pages:
+                return (
+                    '{"next_change_id": "%s", "stashes": []}' %
+                    self.pages.change_id(page_no)).encode('utf-8')
+        with self._lock:
+            if change_id in self._cache:
+                self._cache.move_to_end(change_id)
+                return self._cache[change_id]
+        body = self.pages.page(change_id)
+        with self._lock:
+            self._cache[change_id] = body
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return body
+
+    def check_rate_limit(self):
+        """
+        Count a request against the rate limits and return a tuple of the
+        HTTP status to respond with and the rate limit headers.
+        """
+
+        if not self.rate_limit:
+            return (200, [])
+        now = time.time()
+        with self._lock:
+            longest = max(period for _, period, _ in self.rate_limit)
+            while self._hits and self._hits[0] <= now - longest:
+                self._hits.popleft()
+            self._hits.append(now)
+            states = []
+            status = 200
+            for hits, period, penalty in self.rate_limit:
+                current = sum(1 for hit in self._hits if hit > now - period)
+                if current > hits and now >= self._blocked_until:
+                    self._blocked_until = now + penalty
+                restricted = max(0, int(round(self._blocked_until - now)))
+                if current > hits or restricted:
+                    status = 429
+                states.append('%d:%d:%d' % (current, period, restricted))
+            if status == 429:
+                self.throttled += 1
+        headers = [
+            ('X-Rate-Limit-Rules', 'Ip'),
+            ('X-Rate-Limit-Ip', ','.join(
+                '%d:%d:%d' % limit for limit in self.rate_limit)),
+            ('X-Rate-Limit-Ip-State', ','.join(states))]
+        if status == 429:
+            headers.append((
+                'Retry-After', str(max(1, int(self._blocked_until - now)))))
+        return (status, headers)
+
+
+# vim: et:sw=4:sts=4:ai:
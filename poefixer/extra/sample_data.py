@@ -1,5 +1,37 @@
 """Sample data to be used for testing"""
 
+import copy
+
+import rapidjson as json
+
+
+def sample_pages(count):
+    """
+    Return a dict of change id -> raw (bytes) API page for `count` pages
+    chained from the first request (change id None) through 'page-1',
+    'page-2' and so on. Each page holds a renumbered copy of
+    `sample_stash_data`.
+    """
+
+    pages = {}
+    serial = 0
+    change_id = None
+    for page_no in range(count):
+        stashes = copy.deepcopy(sample_stash_data())
+        for stash in stashes:
+            serial += 1
+            stash['id'] = '%064x' % serial
+            for item in stash['items']:
+                serial += 1
+                item['id'] = '%064x' % serial
+        next_id = 'page-%d' % (page_no + 1)
+        # rapidjson doesn't tell python what its methods are...
+        # pylint: disable=c-extension-no-member
+        pages[change_id] = json.dumps(
+            {'next_change_id': next_id, 'stashes': stashes}).encode('utf-8')
+        change_id = next_id
+    return pages
+
 def sample_stash_data():
     return [
         {'id': '227fb59f186902743142e4f2e26f8cb3b9583e38bcab49ed802d5793667c45bc', 'public': True, 'accountName': 'ACCOUNT1',
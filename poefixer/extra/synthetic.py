@@ -0,0 +1,267 @@
+"""
+Deterministic synthetic stash API pages, for load testing
+
+`SyntheticPages` builds pages that look like the output of the public
+stash API: a mix of leagues, stackable currency priced in other
+currencies, divination cards, gems and gear of various sizes, item notes
+and stash-wide prices. The same seed and change id always produce the
+same page, so a run can be repeated exactly, and pages are chained by
+`next_change_id` just like the real thing.
+
+    pages = SyntheticPages(seed=1, stashes_per_page=50)
+    raw = pages.page(None)          # The first page, as JSON bytes
+    next_id = pages.next_change_id(None)
+
+See `poefixer.extra.mock_server` to serve them over HTTP.
+"""
+
+
+import random
+import bisect
+import itertools
+
+import rapidjson as json
+
+
+def _weighted(choices):
+    """Turn [(value, weight), ...] into a callable of a `random.Random`"""
+
+    values = [value for value, _ in choices]
+    cumulative = list(itertools.accumulate(weight for _, weight in choices))
+
+    def choose(rng):
+        return values[
+            bisect.bisect(cumulative, rng.random() * cumulative[-1])]
+    return choose
+
+
+# Most trading happens in the current temporary league
+LEAGUES = _weighted([
+    ('Incursion', 60), ('Hardcore Incursion', 15),
+    ('Standard', 20), ('Hardcore', 5)])
+
+# (name, abbreviation used in notes, typical value in chaos, stack size)
+CURRENCIES = [
+    ('Chaos Orb', 'chaos', 1.0, 10),
+    ('Exalted Orb', 'exa', 80.0, 10),
+    ('Divine Orb', 'divine', 15.0, 10),
+    ('Orb of Alchemy', 'alch', 0.3, 10),
+    ('Orb of Alteration', 'alt', 0.07, 20),
+    ('Orb of Fusing', 'fuse', 0.5, 20),
+    ('Chromatic Orb', 'chrom', 0.12, 20),
+    ('Jeweller\'s Orb', 'jew', 0.1, 20),
+    ('Regal Orb', 'regal', 0.8, 10),
+    ('Vaal Orb', 'vaal', 1.1, 10),
+    ('Orb of Regret', 'regret', 0.7, 40),
+    ('Orb of Scouring', 'scour', 0.5, 30),
+    ('Gemcutter\'s Prism', 'gcp', 1.2, 20),
+    ('Cartographer\'s Chisel', 'chisel', 0.3, 20),
+    ('Blessed Orb', 'blessed', 0.4, 20),
+    ('Orb of Chance', 'chance', 0.15, 20),
+    ('Mirror of Kalandra', 'mirror', 9000.0, 10),
+]
+# Cheap currency is much more common than expensive currency
+CURRENCY = _weighted([
+    (currency, 1.0 / (currency[2] ** 0.5)) for currency in CURRENCIES])
+# What people ask for in return
+ASKING = _weighted([
+    (CURRENCIES[0], 70), (CURRENCIES[1], 15), (CURRENCIES[2], 5),
+    (CURRENCIES[3], 4), (CURRENCIES[5], 3), (CURRENCIES[4], 3)])
+
+CARDS = [
+    ('The Wrath', 8, 3.0), ('Abandoned Wealth', 5, 50.0),
+    ('The Valkyrie', 8, 20.0), ('Rain of Chaos', 8, 0.2),
+    ('Humility', 9, 1.0), ('The Doctor', 8, 3000.0)]
+
+GEMS = ['Power Siphon', 'Vaal Ground Slam', 'Fireball', 'Cyclone',
+        'Added Fire Damage Support', 'Multistrike Support', 'Raise Zombie']
+
+# (category, base type, width, height)
+GEAR = [
+    ({'accessories': ['belt']}, 'Leather Belt', 2, 1),
+    ({'accessories': ['ring']}, 'Two-Stone Ring', 1, 1),
+    ({'accessories': ['amulet']}, 'Onyx Amulet', 1, 1),
+    ({'armour': ['helmet']}, 'Hubris Circlet', 2, 2),
+    ({'armour': ['chest']}, 'Vaal Regalia', 2, 3),
+    ({'armour': ['shield']}, 'Plank Kite Shield', 2, 3),
+    ({'weapons': ['bow']}, 'Thicket Bow', 2, 4),
+    ({'weapons': ['twosword']}, 'Reaver Sword', 2, 4),
+    ({'jewels': []}, 'Cobalt Jewel', 1, 1)]
+
+# frameType: 0 normal, 1 magic, 2 rare, 3 unique
+GEAR_FRAME = _weighted([(0, 20), (1, 25), (2, 45), (3, 10)])
+
+KINDS = _weighted([
+    ('currency', 40), ('card', 10), ('gem', 15), ('gear', 35)])
+
+# Stash tab names, most of them not prices
+STASH_NAMES = ['Sell', '$', 'dump', 'maps', 'trade', '1', '2', 'Currency']
+
+
+class SyntheticPages:
+    """
+    A deterministic, endless chain of synthetic API pages.
+
+    * `seed` - Pages with the same seed (and change id) are identical.
+    * `stashes_per_page` - The number of stashes on each page.
+    * `items_per_stash` - The average number of items in a stash.
+    * `item_note_rate` - The fraction of items with their own price note.
+    * `stash_price_rate` - The fraction of stashes with a stash-wide price.
+    * `private_rate` - The fraction of stashes that have gone private.
+    """
+
+    seed = 0
+    stashes_per_page = 50
+    items_per_stash = 12
+    item_note_rate = 0.35
+    stash_price_rate = 0.15
+    private_rate = 0.05
+    # Accounts trade in a pool of stashes that update over and over
+    stash_pool = 20000
+
+    def __init__(
+            self, seed=None, stashes_per_page=None, items_per_stash=None,
+            item_note_rate=None, stash_price_rate=None, private_rate=None):
+        if seed is not None:
+            self.seed = seed
+        if stashes_per_page is not None:
+            self.stashes_per_page = stashes_per_page
+        if items_per_stash is not None:
+            self.items_per_stash = items_per_stash
+        if item_note_rate is not None:
+            self.item_note_rate = item_note_rate
+        if stash_price_rate is not None:
+            self.stash_price_rate = stash_price_rate
+        if private_rate is not None:
+            self.private_rate = private_rate
+
+    def change_id(self, page_no):
+        """The change id of page number `page_no` (0 is None)"""
+
+        if page_no == 0:
+            return None
+        return '%d-%d' % (self.seed, page_no)
+
+    def page_number(self, change_id):
+        """The page number for `change_id`; raises ValueError if not ours"""
+
+        if not change_id:
+            return 0
+        seed, page_no = change_id.split('-', 1)
+        if int(seed) != self.seed:
+            raise ValueError("Change id %r is for another seed" % change_id)
+        return int(page_no)
+
+    def next_change_id(self, change_id):
+        """The change id of the page that follows `change_id`"""
+
+        return self.change_id(self.page_number(change_id) + 1)
+
+    def page(self, change_id):
+        """The raw (JSON bytes) page for `change_id`"""
+
+        # rapidjson doesn't tell python what its methods are...
+        # pylint: disable=c-extension-no-member
+        return json.dumps({
+            'next_change_id': self.next_change_id(change_id),
+            'stashes': self.stashes(change_id)}).encode('utf-8')
+
+    def stashes(self, change_id):
+        """The list of stash data dicts for `change_id`"""
+
+        page_no = self.page_number(change_id)
+        rng = random.Random('%s:%s' % (self.seed, page_no))
+        return [
+            self._stash(rng, page_no, index)
+            for index in range(self.stashes_per_page)]
+
+    def _stash(self, rng, page_no, index):
+        stash_no = rng.randrange(self.stash_pool)
+        league = LEAGUES(rng)
+        if rng.random() < self.stash_price_rate:
+            name = self._price_note(rng, rng.lognormvariate(0, 1.5))
+        else:
+            name = rng.choice(STASH_NAMES)
+        public = rng.random() >= self.private_rate
+        items = []
+        if public:
+            count = rng.randint(0, 2 * self.items_per_stash)
+            items = [
+                self._item(rng, league, page_no, index, item_no)
+                for item_no in range(count)]
+        return {
+            'id': '%064x' % (self.seed * self.stash_pool + stash_no),
+            'accountName': 'account%d' % stash_no,
+            'lastCharacterName': 'character%d' % stash_no,
+            'stash': name,
+            'stashType': 'PremiumStash',
+            'public': public,
+            'items': items}
+
+    def _item(self, rng, league, page_no, stash_index, item_no):
+        kind = KINDS(rng)
+        item = {
+            # Unique per page position, so that replays update in place
+            'id': '%032x%016x%08x%08x' % (
+                self.seed, page_no, stash_index, item_no),
+            'league': league, 'verified': False, 'identified': True,
+            'ilvl': 0, 'name': '', 'x': rng.randrange(12),
+            'y': rng.randrange(12), 'inventoryId': 'Stash%d' % (item_no + 1),
+            'icon': 'http://web.poecdn.com/image/%s.png' % kind}
+        if kind == 'currency':
+            name, _, value, stack = CURRENCY(rng)
+            size = rng.randint(1, stack)
+            item.update({
+                'typeLine': name, 'frameType': 5, 'w': 1, 'h': 1,
+                'stackSize': size, 'maxStackSize': stack,
+                'category': {'currency': []},
+                'properties': [{
+                    'name': 'Stack Size', 'displayMode': 0,
+                    'values': [['%d/%d' % (size, stack), 0]]}]})
+        elif kind == 'card':
+            name, stack, value = rng.choice(CARDS)
+            item.update({
+                'typeLine': name, 'frameType': 6, 'w': 1, 'h': 1,
+                'stackSize': rng.randint(1, stack), 'maxStackSize': stack,
+                'category': {'cards': []}, 'artFilename': name.replace(' ', '')})
+        elif kind == 'gem':
+            value = rng.lognormvariate(0, 1.2)
+            item.update({
+                'typeLine': rng.choice(GEMS), 'frameType': 4, 'w': 1, 'h': 1,
+                'support': rng.random() < 0.4,
+                'corrupted': rng.random() < 0.1,
+                'category': {'gems': ['activegem']}})
+        else:
+            category, base, width, height = rng.choice(GEAR)
+            frame = GEAR_FRAME(rng)
+            value = rng.lognormvariate(0, 2) * (1 + 10 * (frame == 3))
+            item.update({
+                'typeLine': base, 'frameType': frame, 'w': width, 'h': height,
+                'ilvl': rng.randint(1, 86), 'category': category,
+                'identified': frame == 0 or rng.random() < 0.9,
+                'corrupted': rng.random() < 0.15,
+                'explicitMods': ['+%d to maximum Life' % rng.randint(10, 120)]})
+            if frame >= 2:
+                item['name'] = '<<set:MS>><<set:M>><<set:S>>Item %d' % (
+                    rng.randrange(500))
+        if rng.random() < self.item_note_rate:
+            item['note'] = self._price_note(rng, value)
+        return item
+
+    @staticmethod
+    def _price_note(rng, value):
+        """A note pricing something worth `value` chaos, in some currency"""
+
+        _, abbrev, unit_value, _ = ASKING(rng)
+        amount = value * rng.lognormvariate(0, 0.2) / unit_value
+        if amount < 1 and rng.random() < 0.5:
+            price = '1/%d' % max(1, round(1 / amount))
+        elif amount < 10:
+            price = '%.1f' % amount
+        else:
+            price = '%d' % round(amount)
+        return '~%s %s %s' % (
+            rng.choice(('price', 'price', 'b/o')), price, abbrev)
+
+
+# vim: et:sw=4:sts=4:ai:
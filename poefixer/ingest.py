@@ -0,0 +1,301 @@
+"""
+A pipelined reader/writer for the stash API.
+
+`PoeApi.get_next` followed by `PoeDb.insert_api_stash` does everything
+on one thread, so the network sits idle while we write and the database
+sits idle while we wait on the rate limiter. `IngestPipeline` splits the
+work into fetch, decode and write stages that run concurrently and are
+connected by bounded queues:
+
+    api = PoeApi(next_id=next_id)
+    db = PoeDb(db_connect=dsn)
+    IngestPipeline(api, db).run()
+
+The fetch and decode stages run in background threads. The write stage
+runs in the calling thread so that the database session never crosses
+threads. When the writer falls behind, the queues fill and the upstream
+stages block, which keeps memory bounded.
+"""
+
+
+import time
+import queue
+import logging
+import threading
+import concurrent.futures
+
+from .stashapi import NoMorePages
+
+
+class StageStats:
+    """Throughput counters for one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.pages = 0
+        self.stashes = 0
+        self.items = 0
+        self.bytes = 0
+        # Seconds spent doing work, as opposed to waiting on a queue
+        self.busy = 0.0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, busy, pages=1, stashes=0, items=0, nbytes=0):
+        """Add one unit of completed work to the counters"""
+
+        with self._lock:
+            self.busy += busy
+            self.pages += pages
+            self.stashes += stashes
+            self.items += items
+            self.bytes += nbytes
+
+    def summary(self):
+        """A one-line human-readable summary of this stage's throughput"""
+
+        elapsed = max(time.time() - self.started, 1e-6)
+        return (
+            "%s: %s pages (%.2f/s) %s stashes (%.1f/s) "
+            "%s items (%.1f/s) %.1f MB (%.2f MB/s) busy %.0f%%") % (
+            self.name,
+            self.pages, self.pages / elapsed,
+            self.stashes, self.stashes / elapsed,
+            self.items, self.items / elapsed,
+            self.bytes / 1e6, self.bytes / 1e6 / elapsed,
+            100 * self.busy / elapsed)
+
+
+# Returned by queue reads when the pipeline is shutting down
+_STOPPED = object()
+
+
+class _StageFailure:
+    """Passed downstream in place of data when a stage dies"""
+
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.error = error
+
+
+class IngestPipeline:
+    """
+    Run the fetch, decode and write stages of API ingest concurrently.
+
+    Parameters:
+
+    * `api` - A `PoeApi` whose `next_id` is the first page to fetch.
+    * `db` - A `PoeDb` to write to.
+    * `queue_size` - Maximum number of pages waiting between two stages.
+    * `per_row` - Use `insert_api_stash` instead of the bulk writer.
+    * `max_pages` - Stop after this many pages (default: run forever).
+    * `report_every` - Log stage throughput every N written pages.
+    * `fetchers` - Number of requests that may be in flight at once. With
+                   more than one, the next request goes out as soon as
+                   the current response's next_change_id has arrived.
+    """
+
+    _poll = 0.5 # Seconds between checks for shutdown while blocked
+
+    def __init__(
+            self, api, db,
+            queue_size=4, per_row=False, max_pages=None, report_every=10,
+            fetchers=2, logger=logging):
+        self.api = api
+        self.db = db
+        self.per_row = per_row
+        self.max_pages = max_pages
+        self.fetchers = fetchers
+        self.report_every = report_every
+        self.logger = logger
+        self.stats = dict(
+            (name, StageStats(name)) for name in ('fetch', 'decode', 'write'))
+        # The change id to resume from after the last committed page
+        self.last_written_id = api.next_id
+
+        # Change ids are only known one page at a time, so this never
+        # holds more than one real id
+        self._next_ids = queue.Queue()
+        self._fetch_lock = threading.Lock()
+        self._fetched = 0
+        self._raw_pages = queue.Queue(maxsize=queue_size)
+        self._pages = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+
+    def run(self):
+        """Start the pipeline and write pages until it is done or fails"""
+
+        stages = [('fetch', self._fetch_stage, self._raw_pages)] * self.fetchers
+        stages.append(('decode', self._decode_stage, self._pages))
+        threads = [
+            threading.Thread(
+                target=self._stage, name='poefixer-' + name,
+                args=(name, target, output), daemon=True)
+            for name, target, output in stages]
+        self._next_ids.put(self.api.next_id)
+        for thread in threads:
+            thread.start()
+        try:
+            self._write_stage()
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        self.report()
+
+    def report(self):
+        """Log the throughput of every stage"""
+
+        for stats in self.stats.values():
+            self.logger.info("%s", stats.summary())
+        self.logger.info("%s", self.api.rate_limiter.metrics.summary())
+
+    def _stage(self, name, target, output):
+        try:
+            target()
+        except Exception as e:
+            self.logger.exception("Ingest %s stage failed", name)
+            self._put(output, _StageFailure(name, e))
+
+    def _fetch_stage(self):
+        """
+        One of `fetchers` concurrent fetch loops. A fetcher takes the next
+        change id, reserves that page's place in the decode queue and
+        then downloads it. The body is streamed so that the following id
+        can be handed to another fetcher as soon as it arrives, rather
+        than after the whole page has been downloaded and decoded.
+        """
+
+        while True:
+            next_id = self._get(self._next_ids)
+            with self._fetch_lock:
+                if next_id is _STOPPED or self._limit_reached():
+                    # Let the other fetchers know, too
+                    self._next_ids.put(_STOPPED)
+                    return
+                self._fetched += 1
+                last = self._limit_reached()
+            # Decoding happens in request order, not completion order
+            slot = concurrent.futures.Future()
+            if not self._put(self._raw_pages, (next_id, slot)):
+                return
+            if last:
+                self._put(self._raw_pages, None)
+
+            announced = []
+
+            def on_next_id(early_id):
+                announced.append(early_id)
+                self._next_ids.put(early_id)
+
+            self.api.rate_wait()
+            start = time.time()
+            try:
+                raw = self.api.fetch_raw(
+                    next_id=next_id, slow=self.api.slow, on_next_id=on_next_id)
+            except NoMorePages:
+                # A finite source (e.g. an archive replay) has run dry
+                self.logger.info("No more pages after %s", next_id)
+                slot.set_result((None, []))
+                self._next_ids.put(_STOPPED)
+                return
+            except Exception as e:
+                slot.set_exception(e)
+                raise
+            self.stats['fetch'].record(time.time() - start, nbytes=len(raw))
+            slot.set_result((raw, announced))
+
+    def _limit_reached(self):
+        return self.max_pages is not None and self._fetched >= self.max_pages
+
+    def _decode_stage(self):
+        while True:
+            page = self._get(self._raw_pages)
+            if page is _STOPPED:
+                return
+            if page is None or isinstance(page, _StageFailure):
+                self._put(self._pages, page)
+                return
+            change_id, slot = page
+            raw, announced = self._wait_for(slot)
+            if raw is _STOPPED:
+                return
+            if raw is None:
+                self._put(self._pages, None)
+                return
+            start = time.time()
+            data, next_id = self.api.decode_page(raw)
+            if not announced:
+                # No early id was found, so the fetchers are waiting on us
+                self._next_ids.put(next_id)
+            elif announced[0] != next_id:
+                raise ValueError(
+                    "Early next_change_id %r does not match page's %r" % (
+                        announced[0], next_id))
+            stashes = list(self.api.stash_generator(data))
+            self.stats['decode'].record(
+                time.time() - start,
+                stashes=len(stashes), nbytes=len(raw))
+            if not self._put(self._pages, (change_id, next_id, stashes)):
+                return
+
+    def _wait_for(self, slot):
+        """Wait for a fetcher to fill in `slot`, re-raising its errors"""
+
+        while not self._stop.is_set():
+            try:
+                return slot.result(timeout=self._poll)
+            except concurrent.futures.TimeoutError:
+                continue
+        return (_STOPPED, None)
+
+    def _write_stage(self):
+        while True:
+            page = self._get(self._pages)
+            if page is None or page is _STOPPED:
+                return
+            if isinstance(page, _StageFailure):
+                raise RuntimeError(
+                    "Ingest %s stage failed: %s" % (
+                        page.stage, page.error)) from page.error
+            change_id, next_id, stashes = page
+            start = time.time()
+            if self.per_row:
+                items = 0
+                for stash in stashes:
+                    self.db.insert_api_stash(stash, with_items=True)
+                    items += stash.api_item_count
+            else:
+                _, items = self.db.insert_api_stashes(stashes, with_items=True)
+            self.db.session.commit()
+            self.last_written_id = next_id
+            stats = self.stats['write']
+            stats.record(
+                time.time() - start, stashes=len(stashes), items=items)
+            self.logger.debug("Wrote page %s", change_id)
+            if self.report_every and stats.pages % self.report_every == 0:
+                self.report()
+
+    def _put(self, target, value):
+        """Put `value` on `target`, giving up if the pipeline is stopping"""
+
+        while not self._stop.is_set():
+            try:
+                target.put(value, timeout=self._poll)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source):
+        """Get a value from `source`, or _STOPPED if the pipeline is stopping"""
+
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=self._poll)
+            except queue.Empty:
+                continue
+        return _STOPPED
+
+
+# vim: et:sw=4:sts=4:ai:
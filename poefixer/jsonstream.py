@@ -0,0 +1,175 @@
+"""
+Incremental decoding of stash API pages.
+
+A page from the stash API looks like this:
+
+    {"next_change_id": "...", "stashes": [{...}, {...}, ...]}
+
+and can run to several megabytes. Rather than reading the whole body and
+decoding it in one go, `StashStreamDecoder` is fed the body a chunk at a
+time and hands back each stash as a dict as soon as its closing brace
+has arrived. Only the stash currently being read is kept in memory.
+
+The price of that is speed: the page structure is scanned in Python, so
+this is several times slower than `rapidjson.loads` on the whole page,
+for around a tenth of the peak memory (`scripts/benchmark.py decode`).
+`PoeApi` only uses it when asked to stream.
+
+Example:
+
+    decoder = StashStreamDecoder()
+    for chunk in chunks:
+        for stash in decoder.feed(chunk):
+            print(stash['id'])
+    decoder.close()
+    print(decoder.next_change_id)
+"""
+
+
+import re
+import rapidjson as json
+
+
+# Outside of a stash, we need to see punctuation to track top-level keys
+_SHALLOW_RE = re.compile(rb'[{}\[\]",:]')
+# Inside of a stash, only nesting and strings matter
+_DEEP_RE = re.compile(rb'[{}\[\]"]')
+# The rest of a string, starting just after its opening quote
+_STRING_TAIL_RE = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"')
+
+_QUOTE = ord('"')
+_OPENERS = (ord('{'), ord('['))
+_CLOSERS = (ord('}'), ord(']'))
+_OPEN_OBJECT = ord('{')
+_CLOSE_ARRAY = ord(']')
+_OPEN_ARRAY = ord('[')
+_COLON = ord(':')
+_COMMA = ord(',')
+
+# Nesting depth of the stash objects: page -> stashes list -> stash
+_STASH_DEPTH = 3
+
+
+class StashStreamDecoder:
+    """
+    Push-style decoder for one stash API page. See the module
+    documentation for usage.
+
+    After `close`, `next_change_id` holds the page's next change id (it is
+    usually available much earlier, since the API sends it first).
+    """
+
+    def __init__(self):
+        self.next_change_id = None
+        self._buffer = bytearray()
+        self._pos = 0
+        self._depth = 0
+        self._key = None
+        self._expect_key = False
+        self._in_stashes = False
+        self._stash_start = None
+
+    def feed(self, chunk):
+        """Add `chunk` (bytes) and return the list of stashes it completed"""
+
+        self._buffer += chunk
+        stashes = list(self._scan())
+        self._trim()
+        return stashes
+
+    def close(self):
+        """Signal the end of the page, raising ValueError if it was cut short"""
+
+        if self._depth != 0 or self._stash_start is not None:
+            raise ValueError("Stash page ended inside a JSON value")
+        if self.next_change_id is None:
+            raise KeyError(
+                'next_change_id required field not present in response')
+
+    def _scan(self):
+        buf = self._buffer
+        pos = self._pos
+        while True:
+            if self._depth >= _STASH_DEPTH:
+                match = _DEEP_RE.search(buf, pos)
+            else:
+                match = _SHALLOW_RE.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            index = match.start()
+            char = buf[index]
+            if char == _QUOTE:
+                tail = _STRING_TAIL_RE.match(buf, index + 1)
+                if not tail:
+                    # Incomplete string: wait for more data
+                    pos = index
+                    break
+                pos = tail.end()
+                if self._depth == 1:
+                    self._top_level_string(bytes(buf[index:pos]))
+                continue
+            pos = index + 1
+            if char in _OPENERS:
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = True
+                elif (
+                        self._depth == 2 and char == _OPEN_ARRAY and
+                        self._key == 'stashes'):
+                    self._in_stashes = True
+                elif (
+                        self._depth == _STASH_DEPTH and
+                        char == _OPEN_OBJECT and self._in_stashes):
+                    self._stash_start = index
+            elif char in _CLOSERS:
+                self._depth -= 1
+                if self._depth == _STASH_DEPTH - 1 and self._stash_start is not None:
+                    # rapidjson doesn't tell python what its methods are...
+                    # pylint: disable=c-extension-no-member
+                    stash = json.loads(bytes(buf[self._stash_start:pos]))
+                    self._stash_start = None
+                    self._pos = pos
+                    yield stash
+                elif self._depth == 1 and char == _CLOSE_ARRAY:
+                    self._in_stashes = False
+            elif self._depth == 1:
+                if char == _COLON:
+                    self._expect_key = False
+                elif char == _COMMA:
+                    self._expect_key = True
+        self._pos = pos
+
+    def _top_level_string(self, raw):
+        # pylint: disable=c-extension-no-member
+        value = json.loads(raw)
+        if self._expect_key:
+            self._key = value
+        elif self._key == 'next_change_id':
+            self.next_change_id = value
+
+    def _trim(self):
+        """Drop everything we no longer need from the front of the buffer"""
+
+        keep = self._pos if self._stash_start is None else self._stash_start
+        if keep:
+            del self._buffer[:keep]
+            self._pos -= keep
+            if self._stash_start is not None:
+                self._stash_start -= keep
+
+
+def iter_stash_stream(chunks):
+    """
+    Decode an iterable of raw page chunks (e.g. from `PoeApi.fetch_chunks`
+    or a file) into a generator of stash dicts.
+    """
+
+    decoder = StashStreamDecoder()
+    for chunk in chunks:
+        for stash in decoder.feed(chunk):
+            yield stash
+    decoder.close()
+
+
+# vim: et:sw=4:sts=4:ai:
@@ -0,0 +1,277 @@
+"""
+Hourly rollups of sale prices, for cheap windowed statistics.
+
+A currency summary is a weighted mean over every sale in the last
+`relevant` seconds, which can be thousands of rows. `PriceBuckets` keeps
+the count, sum, sums of squares, minimum and maximum of the sale prices
+of each (name, currency, league) for each hour in the `price_bucket`
+table,
+so that a summary needs at most one row per hour of the window, and the
+same rows give an hourly price history (see `history`). Each bucket also
+has a `QuantileSketch` of its prices, and the window's sketches merge
+into one for the robust statistics of a summary (see `sketch`).
+
+Buckets are kept up to date by telling `PriceBuckets` about the sales
+being written (and, before they are rewritten, the sales that they
+replace): each bucket that they fall into is recomputed from the sale
+table on the next `flush`.
+"""
+
+
+import time
+import logging
+
+import numpy
+import sqlalchemy
+
+import poefixer
+from .stats import bucket_price_stats
+from .sketch import QuantileSketch
+
+
+class PriceBuckets:
+    """
+    The `price_bucket` rows for the sales in a `PoeDb`.
+
+    * `db` - The `PoeDb` whose sales are summarized.
+    * `bucket_seconds` - The length of a bucket.
+    """
+
+    bucket_seconds = 3600
+
+    def __init__(self, db, bucket_seconds=None, logger=logging):
+        self.db = db
+        if bucket_seconds is not None:
+            self.bucket_seconds = bucket_seconds
+        self.logger = logger
+        # (name, currency, league, hour) of buckets to recompute
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self._dirty)
+
+    def hour_of(self, when):
+        """The start of the bucket that the Unix time `when` falls in"""
+
+        return when - when % self.bucket_seconds
+
+    def touch(self, name, currency, league, when):
+        """Note that a sale at `when` has been (or is about to be) written"""
+
+        self._dirty.add((name, currency, league, self.hour_of(when)))
+
+    def touch_sales(self, item_ids):
+        """
+        Note the buckets of the sales of `item_ids` as they are now, before
+        they are rewritten (possibly into other buckets).
+        """
+
+        Sale = poefixer.Sale
+        Item = poefixer.Item
+        item_ids = list(item_ids)
+        for start in range(0, len(item_ids), 500):
+            query = self.db.session.query(
+                Sale.name, Sale.sale_currency, Item.league,
+                Sale.item_updated_at)
+            query = query.join(Item, Sale.item_id == Item.id)
+            query = query.filter(Sale.item_id.in_(item_ids[start:start+500]))
+            for row in query.all():
+                self.touch(*row)
+
+    def flush(self):
+        """
+        Recompute the buckets that have been touched since the last
+        flush from the sale table (not committed).
+        """
+
+        if not self._dirty:
+            return
+        dirty = self._dirty
+        self._dirty = set()
+        Sale = poefixer.Sale
+        rows = []
+        # Read just the sales of each dirty bucket: a repriced sale's old
+        # bucket may be days before the rest
+        keys = sorted(dirty)
+        for start in range(0, len(keys), 100):
+            query = self._sale_query()
+            query = query.filter(sqlalchemy.or_(*[
+                sqlalchemy.and_(
+                    Sale.name == name,
+                    Sale.sale_currency == currency,
+                    poefixer.Item.league == league,
+                    Sale.item_updated_at >= hour,
+                    Sale.item_updated_at < hour + self.bucket_seconds)
+                for name, currency, league, hour in keys[start:start+100]]))
+            rows.extend(self._bucket_rows(query.all()))
+
+        table = poefixer.PriceBucket.__table__
+        cmd = sqlalchemy.sql.expression.delete(table)
+        for column in ('name', 'currency', 'league', 'hour'):
+            cmd = cmd.where(
+                table.c[column] == sqlalchemy.bindparam('_' + column))
+        self.db.session.execute(cmd, [
+            {'_name': name, '_currency': currency, '_league': league,
+                '_hour': hour}
+            for name, currency, league, hour in dirty])
+        if rows:
+            self.db.session.execute(
+                sqlalchemy.sql.expression.insert(table), rows)
+        self.logger.debug(
+            "Recomputed %s price buckets, %s with sales", len(dirty), len(rows))
+
+    def rebuild(self):
+        """Recompute every bucket from the sale table (not committed)"""
+
+        self._dirty.clear()
+        table = poefixer.PriceBucket.__table__
+        self.db.session.execute(sqlalchemy.sql.expression.delete(table))
+        # Read in bucket order, so that only one kind of sale's prices are
+        # held in memory at a time, and all of the buckets before writing
+        # any, so as not to write while a stream of results is open
+        Sale = poefixer.Sale
+        query = self._sale_query().order_by(
+            Sale.name, Sale.sale_currency, poefixer.Item.league,
+            Sale.item_updated_at)
+        rows = list(self._bucket_rows(query.yield_per(10000), ordered=True))
+        for start in range(0, len(rows), 1000):
+            self.db.session.execute(
+                sqlalchemy.sql.expression.insert(table),
+                rows[start:start+1000])
+        self.logger.info("Wrote %s price buckets", len(rows))
+
+    def stats(
+            self, name, currency, league, sale_time, relevant,
+            weight_increment, now=None):
+        """
+        The weighted statistics of the sales in the last `relevant`
+        seconds as of a sale at `sale_time`, from the buckets (see
+        `poefixer.postprocess.stats.bucket_price_stats`). The sales in a
+        bucket are all weighted as if they were made in the middle of it,
+        and no more than half a bucket before `sale_time`, so this is an
+        approximation of the weighting of the sale table's
+        `weight_increment` divided by each sale's age.
+        """
+
+        self.flush()
+        now = int(time.time()) if now is None else now
+        bucket = poefixer.PriceBucket
+        query = self.db.session.query(
+            bucket.hour, bucket.count, bucket.total, bucket.minimum_squares,
+            bucket.minimum, bucket.maximum, bucket.total_squares)
+        query = query.filter(bucket.name == name)
+        query = query.filter(bucket.currency == currency)
+        query = query.filter(bucket.league == league)
+        query = query.filter(bucket.hour >= self.hour_of(now - relevant))
+        values = numpy.array(query.all(), dtype=numpy.float64)
+        if len(values) == 0:
+            return (None, None, None, None)
+        (hours, counts, totals, squares, minimums, maximums, old_squares) = \
+            values.T
+        # Buckets from before `minimum_squares` (NULL, so NaN) have it
+        # worked out, less precisely, from `total_squares`
+        old = numpy.isnan(squares)
+        squares[old] = (
+            old_squares - 2 * minimums * totals + counts * minimums**2)[old]
+        half = self.bucket_seconds / 2
+        ages = numpy.maximum(half, sale_time - (hours + half))
+        return bucket_price_stats(
+            counts, totals, squares, minimums, maximums,
+            weight_increment / ages, label="%s->%s" % (name, currency),
+            logger=self.logger)
+
+    def history(self, name, currency, league, start=None, end=None):
+        """
+        The price history of `name` in `currency` in `league`, as a list
+        of (hour, count, mean, minimum, maximum) tuples in time order,
+        for the buckets from `start` until before `end` (Unix times).
+        """
+
+        bucket = poefixer.PriceBucket
+        query = self.db.session.query(
+            bucket.hour, bucket.count, bucket.total, bucket.minimum,
+            bucket.maximum)
+        query = query.filter(bucket.name == name)
+        query = query.filter(bucket.currency == currency)
+        query = query.filter(bucket.league == league)
+        if start is not None:
+            query = query.filter(bucket.hour >= self.hour_of(start))
+        if end is not None:
+            query = query.filter(bucket.hour < end)
+        query = query.order_by(bucket.hour)
+        return [
+            (row.hour, row.count, row.total / row.count, row.minimum,
+                row.maximum)
+            for row in query.all()]
+
+    def sketch(self, name, currency, league, relevant, now=None):
+        """
+        A `poefixer.postprocess.sketch.QuantileSketch` of the prices of
+        the sales in the last `relevant` seconds, merged from the
+        sketches of the buckets.
+        """
+
+        self.flush()
+        now = int(time.time()) if now is None else now
+        bucket = poefixer.PriceBucket
+        query = self.db.session.query(bucket.sketch)
+        query = query.filter(bucket.name == name)
+        query = query.filter(bucket.currency == currency)
+        query = query.filter(bucket.league == league)
+        query = query.filter(bucket.hour >= self.hour_of(now - relevant))
+        query = query.filter(bucket.sketch.isnot(None))
+        sketch = QuantileSketch()
+        for row in query.all():
+            sketch.merge(QuantileSketch.from_bytes(row.sketch))
+        return sketch
+
+    def _sale_query(self):
+        Sale = poefixer.Sale
+        Item = poefixer.Item
+        query = self.db.session.query(
+            Sale.name, Sale.sale_currency, Item.league, Sale.item_updated_at,
+            Sale.sale_amount)
+        query = query.join(Item, Sale.item_id == Item.id)
+        return query.filter(Sale.sale_amount.isnot(None))
+
+    def _bucket_rows(self, sales, ordered=False):
+        """
+        Yield a `price_bucket` row for each bucket of `sales` (rows from
+        `_sale_query`), once all of its sales have been seen. If `sales`
+        are `ordered` by bucket, only the buckets of one (name, currency,
+        league) are held at a time.
+        """
+
+        now = int(time.time())
+        buckets = {}
+        for sale in sales:
+            key = (
+                sale.name, sale.sale_currency, sale.league,
+                self.hour_of(sale.item_updated_at))
+            amounts = buckets.get(key)
+            if amounts is None:
+                if (ordered and buckets and
+                        key[:3] != next(iter(buckets))[:3]):
+                    # Sorted input has moved on to the next kind of sale
+                    yield from self._finish_buckets(buckets, now)
+                    buckets = {}
+                amounts = buckets[key] = []
+            amounts.append(sale.sale_amount)
+        yield from self._finish_buckets(buckets, now)
+
+    def _finish_buckets(self, buckets, now):
+        for (name, currency, league, hour), amounts in buckets.items():
+            amounts = numpy.array(amounts, dtype=numpy.float64)
+            yield {
+                'name': name, 'currency': currency, 'league': league,
+                'hour': int(hour), 'count': len(amounts),
+                'total': float(amounts.sum()),
+                'total_squares': float((amounts**2).sum()),
+                'minimum_squares': float(((amounts - amounts.min())**2).sum()),
+                'minimum': float(amounts.min()),
+                'maximum': float(amounts.max()),
+                'sketch': QuantileSketch(amounts).to_bytes(),
+                'updated_at': now}
+
+
+# vim: et:sw=4:sts=4:ai:
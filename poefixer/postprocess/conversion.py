@@ -0,0 +1,154 @@
+"""
+An in-memory graph of currency conversions, for pricing in Chaos Orbs.
+
+Each `currency_summary` row is an edge from one currency to another with
+a conversion rate (its mean) and a confidence (its weight). The value of
+a currency in Chaos is found along the path whose weakest edge has the
+highest weight, of up to `max_hops` edges. `ConversionGraph` loads each
+league's edges once, applies changes as summaries are written, and
+recomputes the best paths for the whole league only when something has
+changed, so that looking up a value is just a dictionary lookup.
+"""
+
+
+import time
+import logging
+
+import poefixer
+
+
+class _LeagueGraph:
+    """The edges and best paths to the target for one league"""
+
+    def __init__(self, edges, loaded_at):
+        # from_currency -> {to_currency: (mean, weight)}
+        self.edges = edges
+        self.loaded_at = loaded_at
+        # currency -> (weight, conversion, hops)
+        self.best = {}
+        self.dirty = True
+
+
+class ConversionGraph:
+    """
+    Best conversions from each currency to `target`, by league.
+
+    * `db` - The `PoeDb` to read `currency_summary` from.
+    * `max_hops` - The longest conversion path to consider.
+    * `refresh` - Seconds after which a league's edges are re-read from
+                  the database, to see summaries written by others.
+    """
+
+    target = 'Chaos Orb'
+    max_hops = 2
+    refresh = 60
+
+    def __init__(self, db, max_hops=None, refresh=None, logger=logging):
+        self.db = db
+        if max_hops is not None:
+            self.max_hops = max_hops
+        if refresh is not None:
+            self.refresh = refresh
+        self.logger = logger
+        self._leagues = {}
+
+    def value_of(self, name, league):
+        """
+        The value of one `name` in `target` in `league`, or None if there
+        is no known conversion. If there is no path from `name` to
+        `target`, the inverse of a direct `target` -> `name` conversion
+        is used.
+        """
+
+        if name == self.target:
+            return 1.0
+        graph = self._league(league)
+        if graph.dirty:
+            self._solve(graph)
+        best = graph.best.get(name)
+        if best is not None:
+            return best[1]
+        inverse = graph.edges.get(self.target, {}).get(name)
+        if inverse is not None and inverse[0]:
+            self.logger.debug(
+                "Falling back on inverse %s -> %s pricing: %s",
+                self.target, name, 1.0/inverse[0])
+            return 1.0/inverse[0]
+        return None
+
+    def update(self, league, from_currency, to_currency, mean, weight):
+        """Apply a `currency_summary` row that has been written"""
+
+        graph = self._leagues.get(league)
+        if graph is None:
+            # Not loaded yet, so it will be read from the database
+            return
+        graph.edges.setdefault(from_currency, {})[to_currency] = (mean, weight)
+        graph.dirty = True
+
+    def invalidate(self, league=None):
+        """Re-read `league` (or all leagues) from the database when next used"""
+
+        if league is None:
+            self._leagues.clear()
+        else:
+            self._leagues.pop(league, None)
+
+    def _league(self, league):
+        now = time.time()
+        graph = self._leagues.get(league)
+        if graph is None or (
+                self.refresh is not None and
+                now - graph.loaded_at > self.refresh):
+            summary = poefixer.CurrencySummary
+            query = self.db.session.query(
+                summary.from_currency, summary.to_currency,
+                summary.mean, summary.weight)
+            query = query.filter(summary.league == league)
+            edges = {}
+            for row in query.all():
+                edges.setdefault(row.from_currency, {})[row.to_currency] = (
+                    row.mean, row.weight)
+            graph = _LeagueGraph(edges, now)
+            self._leagues[league] = graph
+        return graph
+
+    def _solve(self, graph):
+        """
+        Find the widest path (the one whose weakest edge has the highest
+        weight) to `target` from every currency, of at most `max_hops`
+        edges, by relaxing every edge once per hop. Shorter paths win ties,
+        as do paths whose first edges have higher weight.
+        """
+
+        target = self.target
+        # Edges in descending weight order, so that ties go to the path
+        # with the strongest first edge
+        edges = sorted(
+            ((weight, from_currency, to_currency, mean)
+                for from_currency, targets in graph.edges.items()
+                if from_currency != target
+                for to_currency, (mean, weight) in targets.items()),
+            key=lambda edge: -edge[0])
+        reached = {target: (float('inf'), 1.0, 0)}
+        best = {}
+        for hops in range(1, self.max_hops + 1):
+            found = {}
+            for weight, from_currency, to_currency, mean in edges:
+                via = reached.get(to_currency)
+                if via is None or via[2] != hops - 1:
+                    continue
+                score = min(weight, via[0])
+                current = best.get(from_currency) or found.get(from_currency)
+                if current is None or score > current[0]:
+                    found[from_currency] = (score, mean * via[1], hops)
+            if not found:
+                break
+            best.update(found)
+            # Only paths that are new at this length can be extended
+            reached = found
+        graph.best = best
+        graph.dirty = False
+
+
+# vim: et:sw=4:sts=4:ai:
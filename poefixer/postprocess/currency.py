@@ -8,17 +8,23 @@ sales data and currency summaries.
 
 
 import time
-import math
 import numpy
 import logging
 import datetime
+import multiprocessing
+import concurrent.futures
 
 import sqlalchemy
 
 import poefixer
-from .currency_names import \
-    PRICE_RE, PRICE_WITH_SPACE_RE, \
-    OFFICIAL_CURRENCIES, UNOFFICIAL_CURRENCIES
+from poefixer.batch import DictionaryColumn
+from .stats import weighted_price_stats, grouped_weighted_price_stats
+from .sale_window import SaleWindowStore
+from .conversion import ConversionGraph
+from .notes import PriceNoteParser, learned_currencies
+from .revalue import SaleRevaluer
+from .buckets import PriceBuckets
+from .sketch import QuantileSketch
 
 
 class CurrencyPostprocessor:
@@ -33,7 +39,6 @@ class CurrencyPostprocessor:
     start_time = None
     logger = None
     limit = None
-    actual_currencies = {}
     # How long can we go considering an existing calculation "close enough"
     # This is a performance tuning parameter. Intger number of mintues
     recent = None
@@ -41,17 +46,61 @@ class CurrencyPostprocessor:
     relevant = int(datetime.timedelta(days=15).total_seconds())
     # Weight the data we do consider based on an increment of a half-day
     weight_increment = int(datetime.timedelta(hours=12).total_seconds())
+    # Our row in the processing_watermark table
+    watermark_name = 'currency'
+    # Number of item rows read per block
+    block_size = 1000
+    # Seconds before the watermark to read again on resuming. Item times
+    # are whole seconds set by the writer, so rows that share the
+    # watermark's second (with a lower id) or that a writer commits late
+    # can land behind it.
+    watermark_slack = 60
 
     def __init__(self, db, start_time,
             continuous=False,
             recent=600, # Number of seconds, timedelta or None for caching
             limit=None, # Max number of rows to process
+            sale_windows=True, # Keep recent sales in memory
+            max_hops=None, # Longest currency conversion path
+            deferred=False, # Write and summarize sales once per block
+            currency_only=False, # Skip items that are not currency
+            workers=None, # Number of processes to shard each pass over
+            shard=None, # (index, count) of the shard that we process
+            price_buckets=False, # Keep hourly price buckets of sales
             logger=logging):
         self.db = db
         self.start_time = start_time
         self.continuous = continuous
         self.limit = limit
         self.logger = logger
+        self.deferred = deferred
+        self.currency_only = currency_only
+        self.workers = workers
+        self.shard = shard
+        if shard is not None:
+            self.watermark_name = self._shard_watermark_name(*shard)
+        # Passed on to shard processes. Not `limit`: a shard must finish
+        # its part of a pass before the pass can be recorded as done.
+        self._settings = dict(
+            recent=recent, sale_windows=sale_windows,
+            max_hops=max_hops, deferred=deferred,
+            currency_only=currency_only, price_buckets=price_buckets)
+        self._dirty = {}
+        self._pending = []
+        # (key, prices and times) of the sales last read from the sale
+        # table by `_get_mean_and_std`
+        self._recent_prices = (None, None)
+        # Existing sales for the current block, by item id
+        self._existing_sales = None
+        self.conversions = ConversionGraph(db, max_hops=max_hops, logger=logger)
+        self.note_parser = PriceNoteParser(logger=logger)
+        self.sale_windows = None
+        if sale_windows:
+            self.sale_windows = SaleWindowStore(
+                db, self.relevant, self.weight_increment, logger=logger)
+        self.price_buckets = None
+        if price_buckets:
+            self.price_buckets = PriceBuckets(db, logger=logger)
         if recent is None or isinstance(recent, int):
             self.recent = recent
         elif isinstance(recent, datetime.timedelta):
@@ -66,86 +115,129 @@ class CurrencyPostprocessor:
     def get_actual_currencies(self):
         """Get the currencies in the DB and create abbreviation mappings"""
 
-        def get_full_names():
-            query = self.db.session.query(poefixer.CurrencySummary)
-            query = query.add_columns(poefixer.CurrencySummary.from_currency)
-            query = query.distinct()
+        return learned_currencies(self.db, logger=self.logger)
 
-            for row in query.all():
-                yield row.from_currency
+    @property
+    def actual_currencies(self):
+        """The currency names seen in the data, by lowercased abbreviation"""
 
-        def dashed(name):
-            return name.replace(' ', '-')
+        return self.note_parser.actual_currencies
 
-        def dashed_clean(name):
-            return dashed(name).replace("'", "")
+    @actual_currencies.setter
+    def actual_currencies(self, mapping):
+        self.note_parser.set_actual_currencies(mapping)
 
-        full_names = list(get_full_names())
-        low = lambda name: name.lower()
-        mapping = dict((low(name), name) for name in full_names)
-        mapping.update(
-            dict((dashed(low(name)), name) for name in full_names))
-        mapping.update(
-            dict((dashed_clean(low(name)), name) for name in full_names))
-
-        self.logger.debug("Mapping of currencies: %r", mapping)
-
-        return mapping
-
-    def parse_note(self, note, regex=None):
+    def parse_note(self, note):
         """
         The 'note' is a user-edited field that sets pricing on an item or
         whole stash tab.
 
         Our goal is to parse out the sale price, if any, and return it or
-        to returm None if there was no valid price.
-        """
-
-        if note is not None:
-            match = (regex or PRICE_RE).search(note)
-            if match:
-                try:
-                    (sale_type, amt, currency) = match.groups()
-                    low_cur = currency.lower()
-                    if '/' in amt:
-                        num, den = amt.split('/', 1)
-                        amt = float(num) / float(den)
-                    else:
-                        amt = float(amt)
-                    if  low_cur in OFFICIAL_CURRENCIES:
-                        return (amt, OFFICIAL_CURRENCIES[low_cur])
-                    elif low_cur in UNOFFICIAL_CURRENCIES:
-                        return (amt, UNOFFICIAL_CURRENCIES[low_cur])
-                    elif low_cur in self.actual_currencies:
-                        return (amt, self.actual_currencies[low_cur])
-                    elif currency:
-                        if regex is None:
-                            # Try with spaces and report the longer name
-                            # if present
-                            return self.parse_note(
-                                note, regex=PRICE_WITH_SPACE_RE)
-                        self.logger.warning(
-                            "Currency note: %r has unknown currency abbrev %s",
-                            note, currency)
-                except ValueError as e:
-                    # If float() fails it raises ValueError
-                    if 'float' in str(e):
-                        self.logger.debug("Invalid price: %r" % note)
-                    else:
-                        raise
-        return (None, None)
-
-    def _currency_query(self, start, block_size, offset):
+        to returm None if there was no valid price. Results are cached by
+        `note_parser`, see `poefixer.postprocess.notes.PriceNoteParser`.
+        """
+
+        return self.note_parser.parse(note)
+
+    def parse_notes(self, notes):
+        """
+        Parse a whole column of notes at once: `notes` is a
+        `poefixer.batch.DictionaryColumn` or an iterable of notes. Returns
+        a list of the `parse_note` results, in order, having parsed each
+        distinct note only once.
+        """
+
+        if not isinstance(notes, DictionaryColumn):
+            notes = DictionaryColumn.encode(notes)
+        return notes.map_unique(self.parse_note)
+
+    def batch_prices(self, batch):
+        """
+        Price every item in a `poefixer.batch.ItemBatch`, falling back to
+        the stash's price where the item has none. Returns a tuple of an
+        array of amounts (NaN where there is no price) and a list of the
+        currency names (None where there is no price).
+        """
+
+        prices = self.parse_notes(batch['note'])
+        stash_prices = self.parse_notes(batch['stash'])
+        amounts = numpy.full(len(batch), numpy.nan)
+        currencies = [None] * len(batch)
+        for index, (price, stash_price) in enumerate(
+                zip(prices, stash_prices)):
+            amount, currency = price if price[0] is not None else stash_price
+            if amount is not None:
+                amounts[index] = amount
+                currencies[index] = currency
+        return (amounts, currencies)
+
+    def _backfill_categories(self, rows):
+        """
+        Items written before `category_root` and `is_currency` were
+        derived at ingest have them set from `category` (read for just
+        those items), to be saved along with the block's sales.
+        """
+
+        legacy = dict(
+            (row.Item.id, row.Item) for row in rows
+            if row.Item.is_currency is None)
+        if not legacy:
+            return
+        item_ids = list(legacy)
+        for start in range(0, len(item_ids), 500):
+            query = self.db.session.query(
+                poefixer.Item.id, poefixer.Item.category)
+            query = query.filter(
+                poefixer.Item.id.in_(item_ids[start:start+500]))
+            for item_id, category in query.all():
+                item = legacy[item_id]
+                (item.category_root, item.is_currency) = \
+                    self.db.category_columns(category)
+        self.logger.debug("Backfilled categories of %s items", len(legacy))
+
+    def _block_prices(self, rows):
+        """
+        The (item price, stash price) pair for each of a block of rows
+        from `_currency_query`. Items priced at ingest use their stored
+        price and the rest have their notes parsed.
+        """
+
+        unparsed = [row for row in rows if row.Item.price_source is None]
+        # Notes repeat a lot, so parse each distinct one once per block
+        parsed = zip(
+            self.parse_notes(row.Item.note for row in unparsed),
+            self.parse_notes(row.stash for row in unparsed))
+        prices = []
+        for row in rows:
+            if row.Item.price_source is None:
+                prices.append(next(parsed))
+            else:
+                prices.append((
+                    (row.Item.price_amount, row.Item.price_currency),
+                    (None, None)))
+        return prices
+
+    def _currency_query(self, start, block_size, after=None, until=None):
         """
         Get a query from Item (linked to Stash) that have been updated since the
         last processed time given by `start`.
 
-        Return a query that will fetch `block_size` rows starting at `offset`.
+        Return a query that will fetch the next `block_size` rows in
+        (`updated_at`, `id`) order that come after the (`updated_at`, `id`)
+        key `after`. Seeking past a key rather than using an OFFSET means
+        that every block costs the same, no matter how far in we are.
+        If `until` is given, rows after that key are left alone. If we
+        are one `shard` of a pass, only that shard's items are read.
         """
 
         Item = poefixer.Item
 
         query = self.db.session.query(poefixer.Item)
+        # Only load what we use: the JSON columns are costly to decode
+        query = query.options(sqlalchemy.orm.load_only(
+            Item.id, Item.api_id, Item.typeLine, Item.name, Item.note,
+            Item.league, Item.updated_at, Item.is_currency,
+            Item.price_amount, Item.price_currency, Item.price_source))
         query = query.join(
             poefixer.Stash,
             poefixer.Stash.id == poefixer.Item.stash_id)
@@ -161,17 +253,37 @@ class CurrencyPostprocessor:
         # Not currently in use
         #query = query.filter(poefixer.Item.active == True)
         query = query.filter(poefixer.Stash.public == True)
-        #query = query.filter(sqlalchemy.func.json_contains_path(
-        #    poefixer.Item.category, 'all', '$.currency') == 1)
+        if self.currency_only:
+            query = query.filter(sqlalchemy.or_(
+                Item.is_currency == True, Item.is_currency.is_(None)))
+        if self.shard is not None:
+            (index, count) = self.shard
+            query = query.filter(Item.shard_key % count == index)
+
+        # Items priced at ingest (see `PoeDb(price_parser=...)`) only need
+        # to be read if they have a price
+        query = query.filter(sqlalchemy.or_(
+            Item.price_source.is_(None), Item.price_amount.isnot(None)))
 
         if start is not None:
             query = query.filter(poefixer.Item.updated_at >= start)
+        if after is not None:
+            (after_updated_at, after_id) = after
+            query = query.filter(sqlalchemy.or_(
+                Item.updated_at > after_updated_at,
+                sqlalchemy.and_(
+                    Item.updated_at == after_updated_at,
+                    Item.id > after_id)))
+        if until is not None:
+            (until_updated_at, until_id) = until
+            query = query.filter(sqlalchemy.or_(
+                Item.updated_at < until_updated_at,
+                sqlalchemy.and_(
+                    Item.updated_at == until_updated_at,
+                    Item.id <= until_id)))
 
         # Tried streaming, but the result is just too large for that.
-        query = query.order_by(
-            Item.updated_at, Item.created_at, Item.id).limit(block_size)
-        if offset:
-            query = query.offset(offset)
+        query = query.order_by(Item.updated_at, Item.id).limit(block_size)
 
         return query
 
@@ -202,20 +314,30 @@ class CurrencyPostprocessor:
         This used to be done in the DB, but doing math in the database is
         a pain, and not very portable. Numpy lets us be pretty efficient,
         so we're not losing all that much.
-        """
 
-        def calc_mean_std(values, weights):
-            mean = numpy.average(values, weights=weights)
-            variance = numpy.average((values-mean)**2, weights=weights)
-            stddev = math.sqrt(variance)
+        If we are keeping a `SaleWindowStore` (the default), the sales
+        come from there rather than from the sale table. Otherwise, if we
+        are keeping `PriceBuckets`, the statistics are approximated from
+        the hourly buckets of sales. Their outlier recalibration can only
+        drop whole buckets, those entirely more than two standard
+        deviations from the mean, so a troll listing in the same hour as
+        fair sales stays in.
+        """
 
-            return (mean, stddev)
+        if self.sale_windows is not None:
+            return self.sale_windows.stats(name, currency, league, sale_time)
+        if self.price_buckets is not None:
+            return self.price_buckets.stats(
+                name, currency, league, sale_time, self.relevant,
+                self.weight_increment)
 
         now = int(time.time())
 
         # This may be DB-specific. Eventually getting it into a
         # pure-SQLAlchemy form would be good...
-        query = self.db.session.query(poefixer.Sale)
+        query = self.db.session.query(
+            poefixer.Sale.sale_amount,
+            poefixer.Sale.item_updated_at)
         query = query.join(
             poefixer.Item, poefixer.Sale.item_id == poefixer.Item.id)
         query = query.filter(poefixer.Sale.name == name)
@@ -226,39 +348,39 @@ class CurrencyPostprocessor:
         # mirrors move fast enough for a month to be sufficient.
         query = query.filter(
             poefixer.Sale.item_updated_at > (now-self.relevant))
-        query = query.add_columns(
-            poefixer.Sale.sale_amount,
-            poefixer.Sale.item_updated_at)
 
-        values = numpy.array([(
-            row.sale_amount,
-            self.weight_increment/max(1,sale_time-row.item_updated_at))
-            for row in query.all()])
+        values = numpy.array(query.all(), dtype=numpy.float64)
+        # Kept for the sketch of the same sales (see `_get_price_sketch`)
+        self._recent_prices = ((name, currency, league), values)
         if len(values) == 0:
             return (None, None, None, None)
-        prices = values[:,0]
-        weights = values[:,1]
-        mean, stddev = calc_mean_std(prices, weights)
-        count = len(prices)
-        total_weight = weights.sum()
+        weights = self.weight_increment / numpy.maximum(
+            1, sale_time - values[:,1])
+        return weighted_price_stats(
+            values[:,0], weights, label="%s->%s" % (name, currency),
+            logger=self.logger)
 
-        if count > 3 and stddev > mean/2:
-            self.logger.debug(
-                "%s->%s: Large stddev=%s vs mean=%s, recalibrating",
-                name, currency, stddev, mean)
-            # Throw out values outside of 2 stddev and try again
-            prices_ok = numpy.absolute(prices-mean) <= stddev*2
-            prices = numpy.extract(prices_ok, prices)
-            weights = numpy.extract(prices_ok, weights)
-            mean, stddev = calc_mean_std(prices, weights)
-            count2 = len(prices)
-            total_weight = weights.sum()
-            self.logger.debug(
-                "Recalibration ignored %s rows, final stddev=%s, mean=%s",
-                count - count2, stddev, mean)
-            count = count2
+    def _get_price_sketch(self, name, currency, league):
+        """
+        A `QuantileSketch` of the prices of the same recent sales as
+        `_get_mean_and_std`, from the sale window, the price buckets or
+        the sale table, whichever we are using.
+        """
 
-        return (float(mean), float(stddev), float(total_weight), count)
+        if self.sale_windows is not None:
+            return self.sale_windows.sketch(name, currency, league)
+        if self.price_buckets is not None:
+            return self.price_buckets.sketch(
+                name, currency, league, self.relevant)
+
+        # The prices that `_get_mean_and_std` has just read
+        (key, values) = self._recent_prices
+        self._recent_prices = (None, None)
+        if key != (name, currency, league):
+            self._get_mean_and_std(name, currency, league, int(time.time()))
+            (_, values) = self._recent_prices
+            self._recent_prices = (None, None)
+        return QuantileSketch(values[:,0] if len(values) else [])
 
     def _update_currency_summary(
             self, name, currency, league, price, sale_time):
@@ -290,6 +412,8 @@ class CurrencyPostprocessor:
             name, currency, weighted_stddev)
         if weighted_stddev is None:
             return None
+        (median, spread, trimmed_mean) = self._get_price_sketch(
+            name, currency, league).robust_stats()
 
         if existing:
             cmd = sqlalchemy.sql.expression.update(poefixer.CurrencySummary)
@@ -312,8 +436,13 @@ class CurrencyPostprocessor:
             mean=weighted_mean,
             weight=weight,
             standard_dev=weighted_stddev,
+            median=median,
+            interquartile_range=spread,
+            trimmed_mean=trimmed_mean,
             updated_at=int(time.time()), **add_values)
         self.db.session.execute(cmd)
+        self.conversions.update(
+            league, name, currency, weighted_mean, weight)
 
     def find_value_of(self, name, league, price):
         """
@@ -323,94 +452,53 @@ class CurrencyPostprocessor:
 
         Our primitive way of doing this for now is to say that the
         highest weighted conversion wins, presuming that that means
-        the most stable sample, and we only try to follow the exchange
-        to two levels down. Thus, we look for `X -> chaos` and
-        `X -> Y -> chaos` and take whichever of those has the
-        highest weighted sales (the weight of sales of
-        `X -> Y -> chaos` being `min(weight(X->Y), weight(Y->chaos))`
+        the most stable sample. We look for `X -> chaos`,
+        `X -> Y -> chaos` and so on, up to `max_hops` steps, and take
+        whichever has the highest weighted sales (the weight of sales of
+        `X -> Y -> chaos` being `min(weight(X->Y), weight(Y->chaos))`).
 
         If all of that fails, we look for transactions going the other
         way (`chaos -> X`). This is less reliable, since it's a
         supply vs. demand side order, but if it's all we have, we
         roll with it.
+
+        The paths are kept in a `ConversionGraph` (see
+        `poefixer.postprocess.conversion`), so this is a lookup rather
+        than a query.
         """
 
         if name == 'Chaos Orb':
             # The value of a chaos orb is always 1 chaos orb
             return price
 
-        from_currency_field = poefixer.CurrencySummary.from_currency
-        to_currency_field = poefixer.CurrencySummary.to_currency
-        league_field = poefixer.CurrencySummary.league
-
-        query = self.db.session.query(poefixer.CurrencySummary)
-        query = query.filter(from_currency_field == name)
-        query = query.filter(league_field == league)
-        query = query.order_by(poefixer.CurrencySummary.weight.desc())
-        high_score = None
-        conversion = None
-        for row in query.all():
-            target = row.to_currency
-            if target == 'Chaos Orb':
-                if not high_score or row.weight >= high_score:
-                    self.logger.debug(
-                        "Conversion discovered %s -> Chaos = %s",
-                        name, row.mean)
-                    high_score = row.weight
-                    conversion = row.mean
-                break
-            if high_score and row.weight <= high_score:
-                # Can't get better than the high score
-                continue
-
-            query2 = self.db.session.query(poefixer.CurrencySummary)
-            query2 = query2.filter(from_currency_field == target)
-            query2 = query2.filter(to_currency_field == 'Chaos Orb')
-            query2 = query2.filter(league_field == league)
-            row2 = query2.one_or_none()
-            if row2:
-                score = min(row.weight, row2.weight)
-                if (not high_score) or score > high_score:
-                    high_score = score
-                    conversion = row.mean * row2.mean
-                    self.logger.debug(
-                        "Conversion discovered %s -> %s (%s) -> Chaos (%s) = %s",
-                        name, target, row.mean, row2.mean, conversion)
-
-        if high_score:
-            return conversion * price
-        else:
-            query = self.db.session.query(poefixer.CurrencySummary)
-            query = query.filter(from_currency_field == 'Chaos Orb')
-            query = query.filter(to_currency_field == name)
-            query = query.filter(league_field == league)
-            row = query.one_or_none()
-
-            if row:
-                inverse = 1.0/row.mean
-                if row:
-                    self.logger.debug(
-                        "Falling back on inverse Chaos -> %s pricing: %s",
-                        name, inverse)
-                    return inverse * price
+        conversion = self.conversions.value_of(name, league)
+        if conversion is None:
+            return None
+        self.logger.debug(
+            "Conversion discovered %s -> Chaos = %s", name, conversion)
+        return conversion * price
 
-        return None
+    def _process_sale(self, row, prices=None):
+        """
+        Record the sale (if any) of the item in `row`. `prices` may be a
+        tuple of the already-parsed item and stash notes.
+        """
 
-    def _process_sale(self, row):
         if not (
                 (row.Item.note and row.Item.note.startswith('~')) or
                 row.stash.startswith('~')):
             # No sale
             return None
-        is_currency = 'currency' in row.Item.category
+        is_currency = row.Item.is_currency
         if is_currency:
             name = row.Item.typeLine
         else:
             name = (row.Item.name + " " + row.Item.typeLine).strip()
         pricing = row.Item.note
         stash_pricing = row.stash
-        stash_price, stash_currency = self.parse_note(stash_pricing)
-        price, currency = self.parse_note(pricing)
+        if prices is None:
+            prices = (self.parse_note(pricing), self.parse_note(stash_pricing))
+        (price, currency), (stash_price, stash_currency) = prices
         if price is None:
             # No item price, so fall back to stash
             price, currency = (stash_price, stash_currency)
@@ -424,8 +512,43 @@ class CurrencyPostprocessor:
         #        name,
         #        ("(currency) " if is_currency else ""),
         #        price, currency))
-        existing = self.db.session.query(poefixer.Sale).filter(
-            poefixer.Sale.item_id == row.Item.id).one_or_none()
+        league = row.Item.league
+        now = int(time.time())
+
+        if self.deferred:
+            # The sale is written, summarized and valued at the end of the
+            # block, in `_flush_deferred`
+            sale = {
+                'item_id': row.Item.id,
+                'item_api_id': row.Item.api_id,
+                'name': name,
+                'is_currency': is_currency,
+                'sale_currency': currency,
+                'sale_amount': price,
+                'sale_amount_chaos': None,
+                'valuation_version': None,
+                'created_at': now,
+                'item_updated_at': row.Item.updated_at,
+                'updated_at': now}
+            if self.sale_windows is not None:
+                self.sale_windows.record(
+                    row.Item.id, name, currency, league, price,
+                    row.Item.updated_at)
+            if self.price_buckets is not None:
+                self.price_buckets.touch(
+                    name, currency, league, row.Item.updated_at)
+            if is_currency:
+                key = (name, currency, league)
+                self._dirty[key] = max(
+                    self._dirty.get(key, 0), row.Item.updated_at)
+            self._pending.append((sale, currency, league, price))
+            return row.Item.id
+
+        if self._existing_sales is not None:
+            existing = self._existing_sales.get(row.Item.id)
+        else:
+            existing = self.db.session.query(poefixer.Sale).filter(
+                poefixer.Sale.item_id == row.Item.id).one_or_none()
 
         if not existing:
             existing = poefixer.Sale(
@@ -436,20 +559,34 @@ class CurrencyPostprocessor:
                 sale_currency=currency,
                 sale_amount=price,
                 sale_amount_chaos=None,
-                created_at=int(time.time()),
+                created_at=now,
                 item_updated_at=row.Item.updated_at,
-                updated_at=int(time.time()))
+                updated_at=now)
         else:
+            if self.price_buckets is not None:
+                # The sale may be moving out of its old bucket
+                self.price_buckets.touch(
+                    existing.name, existing.sale_currency, league,
+                    existing.item_updated_at)
+            existing.name = name
+            existing.is_currency = is_currency
             existing.sale_currency = currency
             existing.sale_amount = price
             existing.sale_amount_chaos = None
+            existing.valuation_version = None
             existing.item_updated_at = row.Item.updated_at
-            existing.updated_at = int(time.time())
+            existing.updated_at = now
 
         # Add it so we can re-calc values...
         self.db.session.add(existing)
 
-        league = row.Item.league
+        if self.sale_windows is not None:
+            self.sale_windows.record(
+                existing.item_id, existing.name, existing.sale_currency,
+                league, existing.sale_amount, existing.item_updated_at)
+        if self.price_buckets is not None:
+            self.price_buckets.touch(
+                name, currency, league, existing.item_updated_at)
 
         amount_chaos = self._update_currency_pricing(
             name, currency, league, price, row.Item.updated_at, is_currency)
@@ -464,6 +601,63 @@ class CurrencyPostprocessor:
 
         return existing.id
 
+    def _prefetch_sales(self, rows):
+        """
+        Load the existing sales for a block of item rows with one query
+        per 500 items, as a dict by item id.
+        """
+
+        item_ids = [row.Item.id for row in rows]
+        existing = {}
+        for start in range(0, len(item_ids), 500):
+            query = self.db.session.query(poefixer.Sale)
+            query = query.filter(
+                poefixer.Sale.item_id.in_(item_ids[start:start+500]))
+            existing.update((sale.item_id, sale) for sale in query.all())
+        return existing
+
+    def _flush_deferred(self):
+        """
+        In `deferred` mode, write all of the block's sales with one
+        batched upsert, recompute each currency summary touched by the
+        block once, then fill in the chaos values of the sales with one
+        batched update.
+        """
+
+        sales = [sale for sale, _, _, _ in self._pending]
+        if self.price_buckets is not None:
+            # The buckets that rewritten sales are moving out of
+            self.price_buckets.touch_sales(sale['item_id'] for sale in sales)
+        self.db.upsert_rows(
+            poefixer.Sale, sales,
+            ['name', 'is_currency', 'sale_currency', 'sale_amount',
+                'sale_amount_chaos', 'valuation_version', 'item_updated_at',
+                'updated_at'],
+            key='item_api_id')
+
+        for (name, currency, league), sale_time in self._dirty.items():
+            self._update_currency_summary(
+                name, currency, league, None, sale_time)
+        self._dirty.clear()
+        if not self._pending:
+            return
+
+        values = []
+        for sale, currency, league, price in self._pending:
+            amount_chaos = self.find_value_of(currency, league, price)
+            if amount_chaos is not None:
+                values.append(
+                    {'_key': sale['item_api_id'], 'chaos': amount_chaos})
+        self.logger.debug(
+            "Valued %s of %s sales in chaos", len(values), len(self._pending))
+        self._pending = []
+        if values:
+            table = poefixer.Sale.__table__
+            cmd = sqlalchemy.sql.expression.update(table)
+            cmd = cmd.where(table.c.item_api_id == sqlalchemy.bindparam('_key'))
+            cmd = cmd.values(sale_amount_chaos=sqlalchemy.bindparam('chaos'))
+            self.db.session.execute(cmd, values)
+
     def get_last_processed_time(self):
         """
         Get the item update time relevant to the most recent sale
@@ -485,6 +679,35 @@ class CurrencyPostprocessor:
         return None
 
 
+    def get_watermark(self):
+        """
+        Return the (`updated_at`, `id`) key of the last item processed,
+        as saved by a previous pass, or None.
+        """
+
+        query = self.db.session.query(poefixer.ProcessingWatermark)
+        query = query.filter(
+            poefixer.ProcessingWatermark.name == self.watermark_name)
+        watermark = query.one_or_none()
+        if watermark:
+            return (watermark.item_updated_at, watermark.item_id)
+        return None
+
+    def _set_watermark(self, key):
+        """Record `key` as the last item processed (not committed)"""
+
+        now = int(time.time())
+        query = self.db.session.query(poefixer.ProcessingWatermark)
+        query = query.filter(
+            poefixer.ProcessingWatermark.name == self.watermark_name)
+        watermark = query.one_or_none()
+        if not watermark:
+            watermark = poefixer.ProcessingWatermark(
+                name=self.watermark_name, created_at=now)
+        (watermark.item_updated_at, watermark.item_id) = key
+        watermark.updated_at = now
+        self.db.session.add(watermark)
+
     def do_currency_postprocessor(self):
         """Process all of the currency data we've seen to date."""
 
@@ -501,67 +724,376 @@ class CurrencyPostprocessor:
 
         create_table(poefixer.Sale, "Sale")
         create_table(poefixer.CurrencySummary, "Currency Summary")
-
-        prev = None
+        create_table(poefixer.ProcessingWatermark, "Processing Watermark")
+        if self.price_buckets is not None:
+            create_table(poefixer.PriceBucket, "Price Bucket")
+        # Tables that already existed don't get new indexes automatically
+        for index in poefixer.Item.__table__.indexes:
+            if index.name == 'ix_item_updated_at_id':
+                index.create(bind=self.db.session.bind, checkfirst=True)
+
+        start_time = self.start_time
         while True:
             # Get all known currency names
             self.actual_currencies = self.get_actual_currencies()
 
-            # Track what the most recently processed transaction was
-            start = self.start_time or self.get_last_processed_time()
-            if start:
+            # Pick up where the last pass left off, unless we were told
+            # where to start. Rows up to `watermark_slack` seconds before
+            # the watermark are read again, but only those that don't
+            # have an up to date sale are processed (see `_unpriced`).
+            seen = None
+            start = start_time
+            if start is None:
+                seen = self.get_watermark()
+                if seen is None:
+                    # Sales written before there were watermarks
+                    start = self.get_last_processed_time()
+                else:
+                    start = seen[0] - self.watermark_slack
+            start_time = None
+            if seen:
+                when = time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(seen[0]))
+                self.logger.info("Resuming after item %s (%s)", seen[1], when)
+            elif start:
                 when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))
                 self.logger.info("Starting from %s", when)
             else:
                 self.logger.info("Starting from beginning of item data.")
 
             # Actually process all outstading sale records
-            (rows_done, last_row) = self._currency_processor_single_pass(start)
-
-            # Pause if no processing was done
-            if not prev or last_row != prev:
-                prev = last_row
+            if self.workers and self.workers > 1:
+                # Each shard keeps its own sale windows, for one pass
+                (rows_done, last_row) = self._parallel_pass(start, seen)
+            else:
+                if self.sale_windows is not None:
+                    # Another process may have written sales since
+                    self.sale_windows.reconcile()
+                (rows_done, last_row) = self._currency_processor_single_pass(
+                    start, seen=seen)
+
+            # Pause if no processing was done. Re-reading behind the
+            # watermark means that a pass always reads rows, but once we
+            # have caught up it processes none of them.
+            if rows_done:
                 self.logger.info("Processed %s rows in a pass", rows_done)
+                self.logger.debug(
+                    "Price note cache: %r", self.note_parser.cache_info())
             elif self.continuous:
                 time.sleep(1)
 
             if not self.continuous:
                 break
 
-    def _currency_processor_single_pass(self, start):
+    def do_currency_rebuild(self):
+        """
+        Recompute every currency summary from the sale table in one
+        vectorized pass, rather than replaying the sales one at a time,
+        then revalue every sale in Chaos Orbs using the new summaries
+        (see `poefixer.postprocess.revalue`). Price buckets, if we keep
+        them, are rebuilt too.
+
+        Each summary comes out as `_update_currency_summary` would have
+        left it after the latest currency sale of its (name, currency,
+        league): the `weighted_price_stats` of the sales in the last
+        `relevant` seconds, weighted by their age as of that sale. Kinds
+        of sale with no currency sales in that time keep the summary that
+        they had, if any, so the sales that it values keep their values.
+        """
+
+        Sale = poefixer.Sale
+        Item = poefixer.Item
+        now = int(time.time())
+        self.db.create_database()
+
+        query = self.db.session.query(
+            Sale.name, Sale.sale_currency, Item.league, Sale.sale_amount,
+            Sale.item_updated_at, Sale.is_currency)
+        query = query.join(Item, Sale.item_id == Item.id)
+        query = query.filter(Sale.item_updated_at > (now-self.relevant))
+        query = query.filter(Sale.sale_amount.isnot(None))
+        keys = {}
+        codes = []
+        amounts = []
+        times = []
+        flags = []
+        for row in query.yield_per(10000):
+            key = (row.name, row.sale_currency, row.league)
+            codes.append(keys.setdefault(key, len(keys)))
+            amounts.append(row.sale_amount)
+            times.append(row.item_updated_at)
+            flags.append(bool(row.is_currency))
+        self.logger.info(
+            "Rebuilding summaries from %s recent sales of %s kinds",
+            len(codes), len(keys))
+
+        groups = numpy.array(codes, dtype=numpy.int64)
+        amounts = numpy.array(amounts, dtype=numpy.float64)
+        times = numpy.array(times, dtype=numpy.int64)
+        is_currency = numpy.array(flags, dtype=bool)
+        # When each summary was last updated: its latest currency sale
+        sale_time = numpy.full(len(keys), -1, dtype=numpy.int64)
+        numpy.maximum.at(sale_time, groups[is_currency], times[is_currency])
+        weights = self.weight_increment / numpy.maximum(
+            1, sale_time[groups] - times)
+        (mean, stddev, weight, count) = grouped_weighted_price_stats(
+            groups, amounts, weights, len(keys))
+        # Each group's prices, in one sorted array, for its sketch
+        order = numpy.argsort(groups, kind='stable')
+        ends = numpy.cumsum(numpy.bincount(groups, minlength=len(keys)))
+        sorted_amounts = amounts[order]
+
+        def robust_stats(code):
+            start = ends[code-1] if code else 0
+            return QuantileSketch(
+                sorted_amounts[start:ends[code]]).robust_stats()
+
+        summaries = []
+        for (name, currency, league), code in keys.items():
+            if sale_time[code] < 0:
+                continue
+            (median, spread, trimmed_mean) = robust_stats(code)
+            summaries.append({
+                'from_currency': name, 'to_currency': currency,
+                'league': league, 'count': int(count[code]),
+                'mean': float(mean[code]), 'weight': float(weight[code]),
+                'standard_dev': float(stddev[code]), 'median': median,
+                'interquartile_range': spread, 'trimmed_mean': trimmed_mean,
+                'created_at': now, 'updated_at': now})
+        table = poefixer.CurrencySummary.__table__
+        if summaries:
+            # Replace only the summaries that we have rewritten
+            cmd = sqlalchemy.sql.expression.delete(table).where(
+                sqlalchemy.and_(
+                    table.c.from_currency == sqlalchemy.bindparam('_from'),
+                    table.c.to_currency == sqlalchemy.bindparam('_to'),
+                    table.c.league == sqlalchemy.bindparam('_league')))
+            self.db.session.execute(cmd, [
+                {'_from': summary['from_currency'],
+                    '_to': summary['to_currency'],
+                    '_league': summary['league']}
+                for summary in summaries])
+            self.db.session.execute(
+                sqlalchemy.sql.expression.insert(table), summaries)
+        self.conversions.invalidate()
+        if self.sale_windows is not None:
+            self.sale_windows.invalidate()
+        self.logger.info("Wrote %s currency summaries", len(summaries))
+        if self.price_buckets is not None:
+            self.price_buckets.rebuild()
+
+        self.db.session.commit()
+        SaleRevaluer(
+            self.db, max_hops=self.conversions.max_hops,
+            logger=self.logger).revalue(force=True)
+
+    @classmethod
+    def _shard_watermark_name(cls, index, count):
+        return "%s:%d/%d" % (cls.watermark_name, index, count)
+
+    def _backfill_shard_keys(self, start):
+        """
+        Set the `shard_key` of items since `start` that were written
+        before it was derived at ingest, so that shards can select their
+        items in SQL.
+        """
+
+        Item = poefixer.Item
+        query = self.db.session.query(Item.id, Item.league, Item.typeLine)
+        query = query.filter(Item.shard_key.is_(None))
+        if start is not None:
+            query = query.filter(Item.updated_at >= start)
+        keys = [
+            {'_id': row.id, 'shard_key': self.db.shard_key(
+                row.league, row.typeLine)}
+            for row in query.all()]
+        if not keys:
+            return
+        cmd = sqlalchemy.sql.expression.update(Item.__table__)
+        cmd = cmd.where(Item.__table__.c.id == sqlalchemy.bindparam('_id'))
+        cmd = cmd.values(shard_key=sqlalchemy.bindparam('shard_key'))
+        for chunk in range(0, len(keys), 10000):
+            self.db.session.execute(cmd, keys[chunk:chunk+10000])
+        self.logger.info("Backfilled shard keys of %s items", len(keys))
+
+    def _last_item_key(self):
+        """The (`updated_at`, `id`) key of the most recently updated item"""
+
+        Item = poefixer.Item
+        query = self.db.session.query(Item.updated_at, Item.id)
+        query = query.order_by(Item.updated_at.desc(), Item.id.desc())
+        last = query.first()
+        return tuple(last) if last else None
+
+    def _parallel_pass(self, start, seen):
+        """
+        Process everything since `start` up to the most recently updated
+        item, split over `workers` processes, each with its own database
+        connection. Items are split by their `shard_key` (of league and
+        base type) in each shard's query, so that all of the sales that
+        go into a summary or a sale window are in one shard. Items up to
+        the key `seen` are only processed if they have no up to date sale
+        (see `_unpriced`).
+
+        This is meant for a database server. SQLite lets one connection
+        write at a time, so its workers mostly wait on each other.
+
+        Each shard keeps its own watermark, so an interrupted pass picks
+        up where each shard left off. Once every shard has finished, the
+        shared watermark moves to the end of the pass and the shard
+        watermarks are dropped.
+        """
+
+        dsn = self.db.db_connect
+        if ':memory:' in dsn:
+            raise ValueError("Cannot share an in-memory database with workers")
+        Watermark = poefixer.ProcessingWatermark
+        query = self.db.session.query(Watermark.name)
+        query = query.filter(Watermark.name.like(self.watermark_name + ':%'))
+        leftover = [row.name for row in query.all()]
+        for name in leftover:
+            if not name.endswith('/%d' % self.workers):
+                raise ValueError(
+                    "An interrupted pass left shard watermark %r: finish it "
+                    "with the same number of workers" % name)
+
+        until = self._last_item_key()
+        if until is None or (seen is not None and until <= seen):
+            return (0, None)
+        if self.db.session.bind.dialect.name == 'sqlite':
+            self.logger.warning(
+                "SQLite allows one writer at a time: workers won't help")
+        self._backfill_shard_keys(start)
+        # Workers don't share our logging setup, just its level
+        level = logging.WARNING
+        if isinstance(self.logger, logging.Logger):
+            level = self.logger.getEffectiveLevel()
+        self.logger.info(
+            "Processing through item %s with %s workers",
+            until[1], self.workers)
+        self.db.session.commit()
+
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context) as pool:
+            futures = [
+                pool.submit(
+                    _process_currency_shard, dsn, (index, self.workers),
+                    start, seen, until, self.block_size, self._settings,
+                    level)
+                for index in range(self.workers)]
+            results = [future.result() for future in futures]
+
+        self._set_watermark(until)
+        query = self.db.session.query(Watermark)
+        query = query.filter(Watermark.name.like(self.watermark_name + ':%'))
+        query.delete(synchronize_session=False)
+        self.db.session.commit()
+        # The shards have written summaries that we have not seen
+        self.conversions.invalidate()
+
+        rows_done = sum(rows for rows, _ in results)
+        last_rows = [last_row for _, last_row in results if last_row]
+        return (rows_done, max(last_rows) if last_rows else None)
+
+    def process_shard(self, start, seen, until):
+        """
+        Process our `shard` of the items since `start` (or after our
+        shard's own watermark, if an earlier try at this pass got that
+        far) up to and including `until`. Items up to the key `seen` were
+        read by earlier passes (see `_unpriced`).
+        """
+
+        self.actual_currencies = self.get_actual_currencies()
+        return self._currency_processor_single_pass(
+            start, after=self.get_watermark(), until=until, seen=seen)
+
+    def _unpriced(self, rows, seen):
+        """
+        Of `rows`, drop those at or before the key `seen` whose item
+        already has a sale from its current `updated_at`: they were
+        processed by an earlier pass.
+        """
+
+        old = [
+            row.Item.id for row in rows
+            if (row.Item.updated_at, row.Item.id) <= seen]
+        if not old:
+            return rows
+        priced = {}
+        for start in range(0, len(old), 500):
+            query = self.db.session.query(
+                poefixer.Sale.item_id, poefixer.Sale.item_updated_at)
+            query = query.filter(poefixer.Sale.item_id.in_(old[start:start+500]))
+            priced.update(query.all())
+        return [
+            row for row in rows
+            if priced.get(row.Item.id, -1) != row.Item.updated_at]
+
+    def _currency_processor_single_pass(
+            self, start, after=None, until=None, seen=None):
+        """
+        Process the items since `start` and after the key `after`, up to
+        the key `until`, a block at a time, returning a tuple of the
+        number of rows processed and the id of the last sale. Items at or
+        before the key `seen` (the watermark of the last pass) are only
+        processed if they have no up to date sale.
+        """
 
-        offset = 0
         count = 0
         all_processed = 0
         todo = True
-        block_size = 1000 # Number of rows per block
+        block_size = self.block_size
         last_row = None
 
         while todo:
-            query = self._currency_query(start, block_size, offset)
+            query = self._currency_query(start, block_size, after, until)
 
             # Stashes are named with a conventional pricing descriptor and
             # items can have a note in the same format. The price of an item
             # is the item price with the stash price as a fallback.
             count = 0
-            for row in query.all():
+            rows = query.all()
+            block = rows
+            if seen is not None:
+                block = self._unpriced(block, seen)
+            self._backfill_categories(block)
+            if self.currency_only:
+                # Items from before `is_currency` are only known once
+                # their categories have been backfilled
+                block = [row for row in block if row.Item.is_currency]
+            if not self.deferred:
+                self._existing_sales = self._prefetch_sales(block)
+            prices = self._block_prices(block)
+            for row, row_prices in zip(block, prices):
                 if not (row.Item.note or row.stash):
                     continue
-                max_id = row.Item.id
                 count += 1
                 self.logger.debug("Row in %s" % row.Item.id)
                 if count % 1000 == 0:
                     self.logger.info(
                         "%s rows in... (%s)",
-                        count + offset, row.Item.updated_at)
+                        count + all_processed, row.Item.updated_at)
 
-                row_id = self._process_sale(row)
+                row_id = self._process_sale(row, prices=row_prices)
 
                 if row_id:
                     last_row = row_id
 
-            todo = count == block_size
-            offset += count
+            if self.deferred:
+                self._flush_deferred()
+            if self.price_buckets is not None:
+                self.price_buckets.flush()
+            self._existing_sales = None
+            todo = len(rows) == block_size
+            if self.sale_windows is not None:
+                self.sale_windows.evict()
+            if rows:
+                after = (rows[-1].Item.updated_at, rows[-1].Item.id)
+                # Saved with the block's sales, so a restart resumes here.
+                # Re-reading behind the last watermark doesn't move it back.
+                if seen is None or after > seen:
+                    self._set_watermark(after)
             self.db.session.commit()
             all_processed += count
             if self.limit and all_processed > self.limit:
@@ -569,4 +1101,21 @@ class CurrencyPostprocessor:
 
         return (all_processed, last_row)
 
+
+def _process_currency_shard(
+        dsn, shard, start, seen, until, block_size, settings, level):
+    """
+    Run one shard of `CurrencyPostprocessor._parallel_pass` in a worker
+    process, returning its (rows processed, last row) tuple.
+    """
+
+    from poefixer.extra.logger import get_poefixer_logger
+
+    logger = get_poefixer_logger(level)
+    db = poefixer.PoeDb(db_connect=dsn, logger=logger)
+    processor = CurrencyPostprocessor(
+        db, start_time=None, shard=shard, logger=logger, **settings)
+    processor.block_size = block_size
+    return processor.process_shard(start, seen, until)
+
 # vim: et:sw=4:sts=4:ai:
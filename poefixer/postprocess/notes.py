@@ -0,0 +1,162 @@
+"""
+Parsing of the price notes that users put on items and stash tabs.
+
+The same notes turn up over and over again (every item in a tab named
+`~price 1 chaos` carries that stash name), so `PriceNoteParser` keeps
+the results for recently seen notes in an LRU cache, and looks
+currency names up in a single dictionary built from the official and
+unofficial abbreviations and the names that we have seen in the data.
+"""
+
+
+import logging
+import functools
+
+import poefixer
+from .currency_names import \
+    PRICE_RE, PRICE_WITH_SPACE_RE, \
+    OFFICIAL_CURRENCIES, UNOFFICIAL_CURRENCIES
+
+
+def learned_currencies(db, logger=logging):
+    """
+    Map the lowercased, dashed and dashed-without-apostrophes forms of
+    the name of every currency in the `currency_summary` table of `db`
+    to the name, for `PriceNoteParser.set_actual_currencies`.
+    """
+
+    def get_full_names():
+        query = db.session.query(poefixer.CurrencySummary)
+        query = query.add_columns(poefixer.CurrencySummary.from_currency)
+        query = query.distinct()
+
+        for row in query.all():
+            yield row.from_currency
+
+    def dashed(name):
+        return name.replace(' ', '-')
+
+    def dashed_clean(name):
+        return dashed(name).replace("'", "")
+
+    full_names = list(get_full_names())
+    low = lambda name: name.lower()
+    mapping = dict((low(name), name) for name in full_names)
+    mapping.update(
+        dict((dashed(low(name)), name) for name in full_names))
+    mapping.update(
+        dict((dashed_clean(low(name)), name) for name in full_names))
+
+    logger.debug("Mapping of currencies: %r", mapping)
+
+    return mapping
+
+
+class PriceNoteParser:
+    """
+    Turn a note into an (amount, currency name) tuple, or (None, None)
+    if it does not set a price.
+
+    * `actual_currencies` - Lowercased names (and dashed forms of names)
+                            seen in the data, mapped to the names.
+    * `cache_size` - The number of distinct notes to remember.
+    """
+
+    cache_size = 10000
+
+    def __init__(self, actual_currencies=None, cache_size=None,
+            logger=logging):
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.logger = logger
+        self.actual_currencies = {}
+        self.currencies = {}
+        self.parse = functools.lru_cache(maxsize=self.cache_size)(self._parse)
+        self.set_actual_currencies(actual_currencies or {})
+
+    def set_actual_currencies(self, actual_currencies):
+        """
+        Use a new mapping of the currency names seen in the data. Cached
+        results are thrown out if it is not the same as the old one.
+        """
+
+        if actual_currencies == self.actual_currencies and self.currencies:
+            return
+        self.actual_currencies = dict(actual_currencies)
+        # Later updates win, so official names take precedence over
+        # unofficial ones, and both over the names seen in the data
+        currencies = dict(self.actual_currencies)
+        currencies.update(UNOFFICIAL_CURRENCIES)
+        currencies.update(OFFICIAL_CURRENCIES)
+        self.currencies = currencies
+        self.parse.cache_clear()
+
+    def cache_info(self):
+        """The `functools.lru_cache` statistics for the note cache"""
+
+        return self.parse.cache_info()
+
+    def ingest_price(self, note):
+        """
+        As `parse`, but None if `note` sets a price in a currency that we
+        don't know (yet), rather than (None, None). This is the
+        `price_parser` for `poefixer.PoeDb`, which leaves such items to be
+        parsed again once more currencies have been seen.
+        """
+
+        price = self.parse(note)
+        if price[0] is None and note is not None and any(
+                self._unknown_currency(note, regex)
+                for regex in (PRICE_RE, PRICE_WITH_SPACE_RE)):
+            return None
+        return price
+
+    def _unknown_currency(self, note, regex):
+        match = regex.search(note)
+        return bool(match) and match.group(3).lower() not in self.currencies
+
+    def _parse(self, note):
+        if note is None:
+            return (None, None)
+        try:
+            price = self._lookup(note, PRICE_RE)
+            if price is None:
+                # Try with spaces and report the longer name if present
+                price = self._lookup(note, PRICE_WITH_SPACE_RE, warn=True)
+        except ValueError as e:
+            # If float() fails it raises ValueError
+            if 'float' in str(e):
+                self.logger.debug("Invalid price: %r" % note)
+            else:
+                raise
+            return (None, None)
+        return price or (None, None)
+
+    def _lookup(self, note, regex, warn=False):
+        """
+        Match `note` against `regex` and return the price if its currency
+        is known. Returns None if the currency is not known, and (None,
+        None) if the note does not match at all.
+        """
+
+        match = regex.search(note)
+        if not match:
+            return (None, None)
+        (sale_type, amt, currency) = match.groups()
+        if '/' in amt:
+            num, den = amt.split('/', 1)
+            amt = float(num) / float(den)
+        else:
+            amt = float(amt)
+        name = self.currencies.get(currency.lower())
+        if name is not None:
+            return (amt, name)
+        if warn:
+            self.logger.warning(
+                "Currency note: %r has unknown currency abbrev %s",
+                note, currency)
+            return (None, None)
+        return None
+
+
+# vim: et:sw=4:sts=4:ai:
@@ -0,0 +1,133 @@
+"""
+Revaluation of sales in Chaos Orbs as conversion rates change.
+
+The currency postprocessor values each sale in Chaos Orbs as it writes
+it, with whatever conversions it knows of at the time, so sales written
+before a conversion was known have no value and older values never
+improve. `SaleRevaluer` keeps the value of each (currency, league) that
+it last used in the `currency_valuation` table, with a version that goes
+up when the value changes, and revalues only the sales that were valued
+from an older version (or not at all). All of a (currency, league)'s
+sales are revalued by the database, in one batched UPDATE for all of
+them, so it is cheap to run alongside the postprocessor:
+
+    SaleRevaluer(db, continuous=True).do_revaluation()
+"""
+
+
+import time
+import logging
+
+import sqlalchemy
+
+import poefixer
+from .conversion import ConversionGraph
+
+
+class SaleRevaluer:
+    """
+    Bring `sale.sale_amount_chaos` up to date with the current
+    conversions (see `poefixer.postprocess.conversion`).
+
+    * `continuous` - Keep revaluing, every `interval` seconds.
+    * `max_hops` - The longest conversion path to use.
+    * `tolerance` - The relative change in value below which a
+                    currency's sales are not revalued.
+    """
+
+    interval = 60
+    tolerance = 0.001
+
+    def __init__(
+            self, db, continuous=False, max_hops=None, tolerance=None,
+            interval=None, logger=logging):
+        self.db = db
+        self.continuous = continuous
+        if tolerance is not None:
+            self.tolerance = tolerance
+        if interval is not None:
+            self.interval = interval
+        self.logger = logger
+        self.conversions = ConversionGraph(
+            db, max_hops=max_hops, refresh=None, logger=logger)
+
+    def do_revaluation(self):
+        """Revalue stale sales, once or (if `continuous`) forever"""
+
+        self.db.create_database()
+        while True:
+            self.revalue()
+            if not self.continuous:
+                break
+            time.sleep(self.interval)
+
+    def revalue(self, force=False):
+        """
+        Revalue the sales whose (currency, league) has changed in value
+        since they were last valued, and those never valued here. With
+        `force`, revalue every sale. Returns the number of (currency,
+        league) pairs whose value changed.
+        """
+
+        now = int(time.time())
+        # See the latest summaries
+        self.conversions.invalidate()
+        valuations = dict(
+            ((valuation.currency, valuation.league), valuation)
+            for valuation in self.db.session.query(poefixer.CurrencyValuation))
+
+        Item = poefixer.Item
+        sale = poefixer.Sale.__table__
+        query = self.db.session.query(sale.c.sale_currency, Item.league)
+        query = query.join(Item, sale.c.item_id == Item.id).distinct()
+        values = []
+        changed = 0
+        for currency, league in query.all():
+            value = self.conversions.value_of(currency, league)
+            valuation = valuations.get((currency, league))
+            if valuation is None:
+                valuation = poefixer.CurrencyValuation(
+                    currency=currency, league=league, value=value, version=1,
+                    created_at=now, updated_at=now)
+                self.db.session.add(valuation)
+                changed += 1
+            elif self._changed(valuation.value, value):
+                valuation.value = value
+                valuation.version += 1
+                valuation.updated_at = now
+                changed += 1
+            values.append({
+                '_currency': currency, '_league': league,
+                '_version': valuation.version, 'value': value})
+        self.db.session.flush()
+
+        if values:
+            league_items = sqlalchemy.select(Item.id).where(
+                Item.league == sqlalchemy.bindparam('_league'))
+            cmd = sqlalchemy.sql.expression.update(sale)
+            cmd = cmd.where(
+                sale.c.sale_currency == sqlalchemy.bindparam('_currency'))
+            cmd = cmd.where(sale.c.item_id.in_(league_items.scalar_subquery()))
+            if not force:
+                cmd = cmd.where(sqlalchemy.or_(
+                    sale.c.valuation_version.is_(None),
+                    sale.c.valuation_version <
+                        sqlalchemy.bindparam('_version')))
+            cmd = cmd.values(
+                sale_amount_chaos=sale.c.sale_amount *
+                    sqlalchemy.bindparam('value', type_=sqlalchemy.Float),
+                valuation_version=sqlalchemy.bindparam('_version'))
+            self.db.session.execute(cmd, values)
+        self.db.session.commit()
+        self.logger.info(
+            "Revalued sales: %s of %s currencies and leagues changed value",
+            changed, len(values))
+        return changed
+
+    def _changed(self, old, new):
+        if old is None or new is None:
+            return old is not new
+        return abs(new - old) > self.tolerance * abs(old)
+
+
+# vim: et:sw=4:sts=4:ai:
@@ -0,0 +1,338 @@
+"""
+An in-memory window of recent sales for the currency postprocessor.
+
+Computing a currency summary needs the price and time of every recent
+sale of that currency for that price currency in that league. Rather
+than reading them all back from the sale table for every new sale,
+`SaleWindowStore` reads them once per (name, currency, league), keeps
+them in a NumPy ring buffer (`SaleWindow`), adds each sale as it is
+processed and drops sales once they are older than the window. Each
+window also keeps a `QuantileSketch` of each hour of its sales, added to
+as sales are recorded, so that a window's sketch is merged from them
+rather than built from every price.
+
+A window is only right while every sale that goes into it passes through
+`record`. Sales written by anyone else (another currency postprocessor
+on the same database) are caught by `reconcile`, which the postprocessor
+calls before each pass: it drops the windows they went into, to be read
+again. Revaluing sales (`poefixer.postprocess.revalue`, or
+`CurrencyPostprocessor.do_currency_rebuild`) only changes their Chaos
+values, which windows don't keep.
+"""
+
+
+import math
+import time
+import logging
+
+import numpy
+
+import poefixer
+from .stats import weighted_price_stats
+from .sketch import QuantileSketch
+
+
+class SaleWindow:
+    """
+    A ring buffer of (sale id, amount, time) for one (name, currency,
+    league), oldest first. When a sale is updated, its old entry is
+    marked dead in place and the new version appended.
+    """
+
+    __slots__ = ('ids', 'amounts', 'times', 'live', 'head', 'size')
+
+    def __init__(self, capacity=64):
+        self.ids = numpy.zeros(capacity, dtype=numpy.int64)
+        self.amounts = numpy.zeros(capacity, dtype=numpy.float64)
+        self.times = numpy.zeros(capacity, dtype=numpy.int64)
+        self.live = numpy.zeros(capacity, dtype=bool)
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, sale_id, amount, when):
+        """Add a sale and return the slot that it was stored in"""
+
+        if self.size == len(self.ids):
+            self._grow()
+        slot = (self.head + self.size) % len(self.ids)
+        self.ids[slot] = sale_id
+        self.amounts[slot] = amount
+        self.times[slot] = when
+        self.live[slot] = True
+        self.size += 1
+        return slot
+
+    def kill(self, slot, sale_id):
+        """Mark the sale in `slot` dead, if it is still `sale_id`'s"""
+
+        if self.live[slot] and self.ids[slot] == sale_id:
+            self.live[slot] = False
+
+    def evict(self, cutoff):
+        """
+        Drop dead sales and sales at or before `cutoff` from the head of
+        the buffer, and return the ids of live sales that were dropped.
+        """
+
+        evicted = []
+        capacity = len(self.ids)
+        while self.size and (
+                not self.live[self.head] or self.times[self.head] <= cutoff):
+            if self.live[self.head]:
+                evicted.append(int(self.ids[self.head]))
+                self.live[self.head] = False
+            self.head = (self.head + 1) % capacity
+            self.size -= 1
+        return evicted
+
+    def prices(self, cutoff):
+        """Arrays of the amounts and times of live sales after `cutoff`"""
+
+        slots = (self.head + numpy.arange(self.size)) % len(self.ids)
+        times = self.times[slots]
+        keep = self.live[slots] & (times > cutoff)
+        return (self.amounts[slots][keep], times[keep])
+
+    def _grow(self):
+        slots = (self.head + numpy.arange(self.size)) % len(self.ids)
+        capacity = 2 * max(1, len(self.ids))
+        for name in ('ids', 'amounts', 'times', 'live'):
+            old = getattr(self, name)
+            new = numpy.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[slots]
+            setattr(self, name, new)
+        self.head = 0
+
+
+class SaleWindowStore:
+    """
+    The recent sales of each (name, currency, league), by `SaleWindow`.
+
+    A window is read from the database the first time its statistics are
+    asked for, and from then on `record` must be told about every sale
+    that is written, so that it stays in step with the sale table.
+    Between the calls to `reconcile`, this process should be the only
+    writer of sales.
+
+    * `db` - The `PoeDb` to load windows from.
+    * `relevant` - Seconds of history to keep.
+    * `weight_increment` - Sales are weighted by `weight_increment`
+                           divided by their age in seconds.
+    """
+
+    # Seconds of sales in each of a window's sketches
+    sketch_seconds = 3600
+
+    def __init__(self, db, relevant, weight_increment, logger=logging):
+        self.db = db
+        self.relevant = relevant
+        self.weight_increment = weight_increment
+        self.logger = logger
+        self.windows = {}
+        # Sale (item) id -> (key, slot) of its live entry
+        self._slots = {}
+        # Key -> the start of each hour of its window -> a sketch of the
+        # hour's sales, for the hours after the window's cutoff
+        self._sketches = {}
+        # What we recorded of each sale since `_checked`, and in the
+        # period before that: sale times are whole seconds, so the two
+        # periods overlap by a second
+        self._checked = int(time.time())
+        self._recorded = {}
+        self._last_recorded = {}
+
+    def __len__(self):
+        return len(self.windows)
+
+    def record(self, sale_id, name, currency, league, amount, when):
+        """Record a sale that has been written, or rewritten"""
+
+        key = (name, currency, league)
+        self._recorded[sale_id] = (key, amount, when)
+        old = self._slots.pop(sale_id, None)
+        if old is not None:
+            old_key, old_slot = old
+            if old_key in self.windows:
+                old_window = self.windows[old_key]
+                # A sketch can't take a sale out, so its hour is redone
+                self._sketches.get(old_key, {}).pop(
+                    self._hour_of(old_window.times[old_slot]), None)
+                old_window.kill(old_slot, sale_id)
+        window = self.windows.get(key)
+        if window is None:
+            # Not loaded yet, so it will be read from the database
+            return
+        self._slots[sale_id] = (key, window.append(sale_id, amount, when))
+        sketch = self._sketches.get(key, {}).get(self._hour_of(when))
+        if sketch is not None:
+            sketch.add(amount)
+
+    def stats(self, name, currency, league, sale_time, now=None):
+        """
+        The weighted statistics of the window as of a sale at `sale_time`
+        (see `poefixer.postprocess.stats.weighted_price_stats`).
+        """
+
+        amounts, times = self._prices(name, currency, league, now)
+        weights = self.weight_increment / numpy.maximum(1, sale_time - times)
+        return weighted_price_stats(
+            amounts, weights, label="%s->%s" % (name, currency),
+            logger=self.logger)
+
+    def sketch(self, name, currency, league, now=None):
+        """
+        A `poefixer.postprocess.sketch.QuantileSketch` of the prices in
+        the window, merged from the sketches of its hours. Only the hours
+        that are new, that have had a sale rewritten or that the window's
+        cutoff falls in are sketched from their prices.
+        """
+
+        now = int(time.time()) if now is None else now
+        amounts, times = self._prices(name, currency, league, now)
+        # Sales in the cutoff's hour may be gone by the next time
+        partial = self._hour_of(now - self.relevant)
+        sketches = self._sketches.setdefault((name, currency, league), {})
+        for hour in [hour for hour in sketches if hour <= partial]:
+            del sketches[hour]
+        hours = times - times % self.sketch_seconds
+        parts = []
+        for hour in numpy.unique(hours):
+            sketch = sketches.get(hour)
+            if sketch is None:
+                sketch = QuantileSketch(amounts[hours == hour])
+                if hour > partial:
+                    sketches[hour] = sketch
+            parts.append(sketch)
+        return QuantileSketch.merged(parts)
+
+    def _prices(self, name, currency, league, now):
+        now = int(time.time()) if now is None else now
+        cutoff = now - self.relevant
+        key = (name, currency, league)
+        window = self.windows.get(key)
+        if window is None:
+            window = self._load(key, cutoff)
+        else:
+            self._forget(window.evict(cutoff))
+        return window.prices(cutoff)
+
+    def evict(self, now=None):
+        """Drop old sales from every window, and any windows left empty"""
+
+        now = int(time.time()) if now is None else now
+        cutoff = now - self.relevant
+        for key, window in list(self.windows.items()):
+            self._forget(window.evict(cutoff))
+            if not len(window):
+                del self.windows[key]
+                self._sketches.pop(key, None)
+
+    def reconcile(self, now=None):
+        """
+        Drop the windows of sales that another writer has written since
+        the last call (sales that are not as we last recorded them), so
+        that they are read from the database again, and return how many
+        windows were dropped.
+        """
+
+        now = int(time.time()) if now is None else now
+        query = self.db.session.query(
+            poefixer.Sale.item_id,
+            poefixer.Sale.name,
+            poefixer.Sale.sale_currency,
+            poefixer.Item.league,
+            poefixer.Sale.sale_amount,
+            poefixer.Sale.item_updated_at)
+        query = query.join(
+            poefixer.Item, poefixer.Sale.item_id == poefixer.Item.id)
+        query = query.filter(poefixer.Sale.updated_at >= self._checked)
+        stale = set()
+        for row in query.all():
+            key = (row.name, row.sale_currency, row.league)
+            ours = self._recorded.get(row.item_id)
+            if ours is None:
+                ours = self._last_recorded.get(row.item_id)
+            if not self._as_recorded(ours, key, row):
+                stale.add(key)
+                if ours is not None:
+                    # The window that we put it in is wrong too
+                    stale.add(ours[0])
+        (self._checked, self._last_recorded) = (now, self._recorded)
+        self._recorded = {}
+
+        dropped = 0
+        for key in stale & set(self.windows):
+            self.invalidate(key)
+            dropped += 1
+        if dropped:
+            self.logger.info(
+                "Dropped %s sale windows written to by another process",
+                dropped)
+        return dropped
+
+    @staticmethod
+    def _as_recorded(ours, key, row):
+        if ours is None or row.sale_amount is None:
+            return False
+        (our_key, amount, when) = ours
+        # Amounts may come back from a single precision column
+        return (
+            our_key == key and when == row.item_updated_at and
+            math.isclose(amount, row.sale_amount, rel_tol=1e-6))
+
+    def invalidate(self, key=None):
+        """
+        Drop the window of the (name, currency, league) `key`, or every
+        window, so that it is read from the database again.
+        """
+
+        keys = list(self.windows) if key is None else [key]
+        for key in keys:
+            window = self.windows.pop(key, None)
+            self._sketches.pop(key, None)
+            if window is not None:
+                slots = (window.head + numpy.arange(window.size)) % len(
+                    window.ids)
+                self._forget(
+                    int(sale_id) for sale_id in window.ids[slots][
+                        window.live[slots]])
+
+    def _hour_of(self, when):
+        return int(when) - int(when) % self.sketch_seconds
+
+    def _forget(self, sale_ids):
+        for sale_id in sale_ids:
+            self._slots.pop(sale_id, None)
+
+    def _load(self, key, cutoff):
+        name, currency, league = key
+        query = self.db.session.query(
+            poefixer.Sale.item_id,
+            poefixer.Sale.sale_amount,
+            poefixer.Sale.item_updated_at)
+        query = query.join(
+            poefixer.Item, poefixer.Sale.item_id == poefixer.Item.id)
+        query = query.filter(poefixer.Sale.name == name)
+        query = query.filter(poefixer.Item.league == league)
+        query = query.filter(poefixer.Sale.sale_currency == currency)
+        query = query.filter(poefixer.Sale.item_updated_at > cutoff)
+        query = query.order_by(poefixer.Sale.item_updated_at)
+        rows = query.all()
+
+        window = SaleWindow(capacity=max(64, 2 * len(rows)))
+        for row in rows:
+            self._slots[row.item_id] = (
+                key,
+                window.append(
+                    row.item_id, row.sale_amount, row.item_updated_at))
+        self.windows[key] = window
+        self.logger.debug(
+            "Loaded %s recent sales of %s->%s in %s",
+            len(rows), name, currency, league)
+        return window
+
+
+# vim: et:sw=4:sts=4:ai:
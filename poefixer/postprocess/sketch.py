@@ -0,0 +1,199 @@
+"""
+A compact, mergeable sketch of a distribution of prices.
+
+Weighted means are easily dragged about by troll listings (an Exalted Orb
+for sale at 1 chaos, or at 10,000), so currency summaries also record the
+median, interquartile range and a trimmed mean of recent prices. These
+come from a `QuantileSketch`, a merging t-digest: the prices are kept as
+a bounded number of centroids (a mean and a weight each), small in the
+tails where precision matters and large in the middle. A sketch takes
+the same few kilobytes however many prices it has seen, and sketches
+(of different shards, or different hours, see
+`poefixer.postprocess.buckets`) can be merged into a sketch of all of
+their prices.
+"""
+
+
+import math
+
+import numpy
+
+
+class QuantileSketch:
+    """
+    Approximate quantiles of a stream of values.
+
+    * `compression` - Roughly the number of centroids kept. Higher is
+                      more accurate and larger.
+    """
+
+    compression = 100
+
+    def __init__(self, values=None, compression=None):
+        if compression is not None:
+            self.compression = compression
+        self.means = numpy.zeros(0)
+        self.weights = numpy.zeros(0)
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self._buffer = []
+        if values is not None:
+            self.extend(values)
+
+    def __len__(self):
+        """The number of values (the total weight) seen"""
+
+        self._flush()
+        return int(round(self.weights.sum()))
+
+    def add(self, value, weight=1.0):
+        """Add one value to the sketch"""
+
+        self._buffer.append((value, weight))
+        if len(self._buffer) >= 5 * self.compression:
+            self._flush()
+
+    def extend(self, values):
+        """Add an array (or iterable) of values to the sketch"""
+
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if len(values):
+            self._compress(
+                numpy.concatenate([self.means, values]),
+                numpy.concatenate([self.weights, numpy.ones(len(values))]))
+
+    def merge(self, other):
+        """Add all of the values of another sketch to this one"""
+
+        other._flush()
+        if len(other.weights):
+            self._flush()
+            self._compress(
+                numpy.concatenate([self.means, other.means]),
+                numpy.concatenate([self.weights, other.weights]),
+                other.minimum, other.maximum)
+        return self
+
+    @classmethod
+    def merged(cls, sketches, compression=None):
+        """
+        A new sketch of all of the values of `sketches`, which are left
+        as they are. Merging many sketches at once only compresses their
+        centroids once.
+        """
+
+        sketch = cls(compression=compression)
+        sketches = [other for other in sketches if len(other)]
+        if sketches:
+            sketch._compress(
+                numpy.concatenate([other.means for other in sketches]),
+                numpy.concatenate([other.weights for other in sketches]),
+                min(other.minimum for other in sketches),
+                max(other.maximum for other in sketches))
+        return sketch
+
+    def quantile(self, q):
+        """
+        The approximate value below which a fraction `q` of the values
+        lie, or None if the sketch is empty. Values are interpolated
+        between the centroids, and the ends are the exact extremes.
+        """
+
+        self._flush()
+        if not len(self.weights):
+            return None
+        total = self.weights.sum()
+        # Each centroid sits at the middle of the weight that it covers
+        centers = numpy.cumsum(self.weights) - self.weights / 2
+        positions = numpy.concatenate([[0], centers, [total]])
+        values = numpy.concatenate(
+            [[self.minimum], self.means, [self.maximum]])
+        return float(numpy.interp(q * total, positions, values))
+
+    def trimmed_mean(self, low, high):
+        """
+        The mean of the values from `low` to `high`, or None if none of
+        the centroids are in that range.
+        """
+
+        self._flush()
+        keep = (self.means >= low) & (self.means <= high)
+        weight = self.weights[keep].sum()
+        if not weight:
+            return None
+        return float((self.means[keep] * self.weights[keep]).sum() / weight)
+
+    def robust_stats(self):
+        """
+        A tuple of the median, interquartile range and the mean of the
+        values within 1.5 interquartile ranges of the quartiles (Tukey's
+        fences), or a tuple of Nones if the sketch is empty.
+        """
+
+        median = self.quantile(0.5)
+        if median is None:
+            return (None, None, None)
+        lower = self.quantile(0.25)
+        upper = self.quantile(0.75)
+        spread = upper - lower
+        trimmed = self.trimmed_mean(lower - 1.5 * spread, upper + 1.5 * spread)
+        return (median, spread, trimmed if trimmed is not None else median)
+
+    def to_bytes(self):
+        """The sketch as bytes, for `from_bytes`"""
+
+        self._flush()
+        return numpy.concatenate([
+            [self.compression, self.minimum, self.maximum],
+            self.means, self.weights]).astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """A sketch from the result of `to_bytes`"""
+
+        values = numpy.frombuffer(data, dtype='<f8')
+        sketch = cls(compression=int(values[0]))
+        (sketch.minimum, sketch.maximum) = (float(values[1]), float(values[2]))
+        size = (len(values) - 3) // 2
+        sketch.means = values[3:3+size].copy()
+        sketch.weights = values[3+size:].copy()
+        return sketch
+
+    def _flush(self):
+        if self._buffer:
+            buffered = numpy.array(self._buffer, dtype=numpy.float64)
+            self._buffer = []
+            self._compress(
+                numpy.concatenate([self.means, buffered[:,0]]),
+                numpy.concatenate([self.weights, buffered[:,1]]))
+
+    def _compress(self, means, weights, minimum=None, maximum=None):
+        """
+        Merge sorted centroids into as few as the scale function allows:
+        a centroid may cover a span of quantiles no wider than one step of
+        `compression / (2 * pi) * asin(2q - 1)`, so centroids are
+        smallest at the ends. The centroids that start in the same step
+        are merged, all at once.
+        """
+
+        order = numpy.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+        self.minimum = min(
+            self.minimum, means[0], math.inf if minimum is None else minimum)
+        self.maximum = max(
+            self.maximum, means[-1], -math.inf if maximum is None else maximum)
+
+        total = weights.sum()
+        scale = self.compression / (2 * math.pi)
+        # The quantile at the start of each centroid, and its step
+        starts = (numpy.cumsum(weights) - weights) / total
+        steps = numpy.floor(
+            scale * numpy.arcsin(numpy.clip(2 * starts - 1, -1.0, 1.0)))
+        groups = numpy.concatenate(
+            [[0], numpy.cumsum(steps[1:] != steps[:-1])])
+        self.weights = numpy.bincount(groups, weights=weights)
+        self.means = numpy.bincount(
+            groups, weights=weights * means) / self.weights
+
+# vim: et:sw=4:sts=4:ai:
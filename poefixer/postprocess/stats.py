@@ -0,0 +1,152 @@
+"""
+Statistics shared by the postprocessors
+"""
+
+
+import math
+import logging
+
+import numpy
+
+
+def weighted_mean_std(values, weights):
+    """Return the weighted mean and standard deviation of `values`"""
+
+    mean = numpy.average(values, weights=weights)
+    variance = numpy.average((values-mean)**2, weights=weights)
+    stddev = math.sqrt(variance)
+
+    return (mean, stddev)
+
+def weighted_price_stats(prices, weights, label=None, logger=logging):
+    """
+    Given NumPy arrays of `prices` and their `weights`, return a tuple of
+    the weighted mean, weighted standard deviation, total weight and
+    count of the prices considered, or a tuple of Nones if there are no
+    prices.
+
+    If there are more than three prices and the standard deviation is more
+    than half of the mean, prices more than two standard deviations from
+    the mean are thrown out and the figures recalculated. `label` names
+    the prices in log messages.
+    """
+
+    if len(prices) == 0:
+        return (None, None, None, None)
+    mean, stddev = weighted_mean_std(prices, weights)
+    count = len(prices)
+    total_weight = weights.sum()
+
+    if count > 3 and stddev > mean/2:
+        logger.debug(
+            "%s: Large stddev=%s vs mean=%s, recalibrating",
+            label, stddev, mean)
+        # Throw out values outside of 2 stddev and try again
+        prices_ok = numpy.absolute(prices-mean) <= stddev*2
+        prices = numpy.extract(prices_ok, prices)
+        weights = numpy.extract(prices_ok, weights)
+        mean, stddev = weighted_mean_std(prices, weights)
+        count2 = len(prices)
+        total_weight = weights.sum()
+        logger.debug(
+            "Recalibration ignored %s rows, final stddev=%s, mean=%s",
+            count - count2, stddev, mean)
+        count = count2
+
+    return (float(mean), float(stddev), float(total_weight), count)
+
+def bucket_price_stats(
+        counts, totals, squares, minimums, maximums, weights,
+        label=None, logger=logging):
+    """
+    `weighted_price_stats` from buckets of prices rather than the prices
+    themselves. Each bucket is given by NumPy arrays of its `counts`, the
+    `totals` of its prices, the `squares` of its prices less its minimum,
+    its `minimums` and `maximums`, and the weight of each of its prices,
+    `weights`. The squares are taken about the minimum so that the
+    variance of prices with a large mean and a small spread doesn't come
+    from subtracting two large, nearly equal numbers.
+
+    The outlier recalibration can't split a bucket, so it throws out the
+    buckets whose whole range of prices lies more than two standard
+    deviations to one side of the mean.
+    """
+
+    def summarize(keep):
+        bucket_weights = weights[keep] * counts[keep]
+        total_weight = bucket_weights.sum()
+        mean = (weights[keep] * totals[keep]).sum() / total_weight
+        # The squared deviations from each bucket's own mean, then those
+        # of the bucket means from the overall mean
+        deviations = totals[keep] - counts[keep] * minimums[keep]
+        within = numpy.maximum(
+            0.0, squares[keep] - deviations**2 / counts[keep])
+        between = counts[keep] * (totals[keep] / counts[keep] - mean)**2
+        variance = (weights[keep] * (within + between)).sum() / total_weight
+        stddev = math.sqrt(max(0.0, variance))
+        return (mean, stddev, total_weight, int(counts[keep].sum()))
+
+    keep = counts > 0
+    if not keep.any():
+        return (None, None, None, None)
+    mean, stddev, total_weight, count = summarize(keep)
+
+    if count > 3 and stddev > mean/2:
+        logger.debug(
+            "%s: Large stddev=%s vs mean=%s, recalibrating",
+            label, stddev, mean)
+        keep_ok = keep & (
+            (maximums >= mean - stddev*2) & (minimums <= mean + stddev*2))
+        if keep_ok.any():
+            mean, stddev, total_weight, count2 = summarize(keep_ok)
+            logger.debug(
+                "Recalibration ignored %s rows, final stddev=%s, mean=%s",
+                count - count2, stddev, mean)
+            count = count2
+
+    return (float(mean), float(stddev), float(total_weight), count)
+
+def grouped_weighted_price_stats(groups, prices, weights, ngroups):
+    """
+    `weighted_price_stats` for many groups of prices at once. `groups`
+    is an array giving the group (from 0 to `ngroups` - 1) of each of
+    `prices` and `weights`. Returns arrays of the weighted mean,
+    weighted standard deviation, total weight and count of each group,
+    after the same outlier recalibration. Groups without prices have a
+    count of zero and NaN statistics.
+    """
+
+    def summarize(keep):
+        kept_weights = numpy.where(keep, weights, 0.0)
+        total_weight = numpy.bincount(
+            groups, weights=kept_weights, minlength=ngroups)
+        count = numpy.bincount(groups, weights=keep, minlength=ngroups)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.bincount(
+                groups, weights=kept_weights * prices,
+                minlength=ngroups) / total_weight
+            variance = numpy.bincount(
+                groups, weights=kept_weights * (prices - mean[groups])**2,
+                minlength=ngroups) / total_weight
+        return (mean, numpy.sqrt(variance), total_weight, count.astype(int))
+
+    mean, stddev, total_weight, count = summarize(
+        numpy.ones(len(prices), dtype=bool))
+
+    # Throw out values outside of 2 stddev and try again, for the groups
+    # whose stddev is large compared to their mean
+    recalibrate = (count > 3) & (stddev > mean/2)
+    if recalibrate.any():
+        keep = (
+            ~recalibrate[groups] |
+            (numpy.absolute(prices - mean[groups]) <= stddev[groups]*2))
+        mean2, stddev2, total_weight2, count2 = summarize(keep)
+        mean = numpy.where(recalibrate, mean2, mean)
+        stddev = numpy.where(recalibrate, stddev2, stddev)
+        total_weight = numpy.where(recalibrate, total_weight2, total_weight)
+        count = numpy.where(recalibrate, count2, count)
+
+    return (mean, stddev, total_weight, count)
+
+
+# vim: et:sw=4:sts=4:ai:
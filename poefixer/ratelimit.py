@@ -0,0 +1,287 @@
+"""
+Rate limiting for the stash API.
+
+GGG's API describes its rate limits in the headers of every response:
+
+    X-Rate-Limit-Rules: Ip
+    X-Rate-Limit-Ip: 45:60:60,240:240:900
+    X-Rate-Limit-Ip-State: 1:60:0,1:240:0
+
+Each rule is a comma-separated list of `hits:period:penalty` limits (at
+most `hits` requests per `period` seconds, or be locked out for
+`penalty` seconds) and its state header gives the server's count of
+requests in each period and any lockout currently in force. A throttled
+request gets a 429 response and a Retry-After header.
+
+`TokenBucketLimiter` keeps a token bucket per limit, follows the headers
+as they change and can be shared by several `PoeApi` objects and
+threads. `FixedRateLimiter` is the old fixed-delay behavior. Both keep
+a `RateLimitMetrics` of every wait and throttle.
+"""
+
+
+import time
+import logging
+import threading
+
+
+class RateLimitMetrics:
+    """Counters for the time we spend waiting on the rate limit"""
+
+    def __init__(self):
+        self.requests = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.throttles = 0
+        self.throttle_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_request(self, waited):
+        """A request was allowed through after waiting `waited` seconds"""
+
+        with self._lock:
+            self.requests += 1
+            if waited > 0:
+                self.waits += 1
+                self.wait_seconds += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def record_throttle(self, seconds):
+        """The server told us to back off for `seconds`"""
+
+        with self._lock:
+            self.throttles += 1
+            self.throttle_seconds += seconds
+
+    def summary(self):
+        """A one-line human-readable summary of the counters"""
+
+        return (
+            "rate limit: %s requests, %s waits (%.1fs total, %.2fs max), "
+            "%s throttles (%.1fs)") % (
+            self.requests, self.waits, self.wait_seconds, self.max_wait,
+            self.throttles, self.throttle_seconds)
+
+
+class RateLimiter:
+    """
+    The interface that `PoeApi` expects of a rate limiter. Call `wait`
+    before each request and `update` with each response's headers and
+    status code. `request_done` is called after a request completes if
+    the API is in `slow` mode.
+    """
+
+    def __init__(self, logger=logging):
+        self.logger = logger
+        self.metrics = RateLimitMetrics()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until a request may be made"""
+
+        raise NotImplementedError("wait")
+
+    def update(self, headers, status_code=200):
+        """Learn from the headers of a response"""
+
+    def request_done(self):
+        """A request has completed"""
+
+
+class FixedRateLimiter(RateLimiter):
+    """Allow one request every `interval` seconds"""
+
+    def __init__(self, interval, logger=logging):
+        super().__init__(logger=logger)
+        self.interval = interval
+        self._last_time = None
+
+    def wait(self):
+        with self._lock:
+            waited = 0.0
+            if self._last_time is not None:
+                delta = time.time() - self._last_time
+                if delta < self.interval:
+                    waited = self.interval - delta
+                    time.sleep(waited)
+            self._last_time = time.time()
+        self.metrics.record_request(waited)
+
+    def request_done(self):
+        with self._lock:
+            self._last_time = time.time()
+
+
+class _Bucket:
+    """
+    A token bucket for a limit of `hits` requests per `period` seconds.
+
+    The server counts requests over a sliding window, and a bucket that
+    holds `capacity` tokens and refills at `rate` tokens per second can
+    let through `capacity + rate * period` requests in any one window.
+    So the bucket only holds a `burst` fraction of the limit, and
+    refills at the rate that keeps the two within the limit.
+    """
+
+    def __init__(self, hits, period, burst, now):
+        self.hits = hits
+        self.period = period
+        self.capacity = max(1, int(hits * burst))
+        self.rate = float(hits - self.capacity) / period
+        if self.rate <= 0:
+            self.rate = float(hits) / period
+        self.tokens = float(self.capacity)
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self):
+        """Seconds until a whole token is available"""
+
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class TokenBucketLimiter(RateLimiter):
+    """
+    A rate limiter driven by the API's rate limit headers (see the module
+    documentation).
+
+    Until the first response arrives, requests are limited to one every
+    `default_interval` seconds (not at all if it is zero). `margin`
+    requests per limit are held in reserve so that we stay just under the
+    server's limits rather than right on them. `burst` is the fraction of
+    each limit that may be used in a burst; the rest is spread evenly over
+    the limit's period. If `min_interval` is set, there are also at least
+    that many seconds between one request completing (`request_done`) and
+    the next starting, whatever the headers allow.
+    """
+
+    def __init__(
+            self, default_interval=1.1, margin=1, burst=0.25,
+            min_interval=None, logger=logging):
+        super().__init__(logger=logger)
+        self.margin = margin
+        self.burst = burst
+        self.min_interval = min_interval
+        self._last_done = None
+        self._rules = None
+        self._buckets = []
+        if default_interval:
+            self._buckets.append(
+                _Bucket(1, default_interval, burst, time.time()))
+        self._blocked_until = 0.0
+
+    def wait(self):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                for bucket in self._buckets:
+                    bucket.refill(now)
+                delay = max(
+                    [self._blocked_until - now] +
+                    [bucket.delay() for bucket in self._buckets])
+                if self.min_interval and self._last_done is not None:
+                    delay = max(
+                        delay, self._last_done + self.min_interval - now)
+                if delay <= 0:
+                    for bucket in self._buckets:
+                        bucket.tokens -= 1
+                    break
+            # Sleep without the lock so that other threads can update us
+            self.logger.debug("Rate limit: waiting %.2fs", delay)
+            time.sleep(delay)
+            waited += delay
+        self.metrics.record_request(waited)
+
+    def request_done(self):
+        with self._lock:
+            self._last_done = time.time()
+
+    def update(self, headers, status_code=200):
+        headers = dict((key.lower(), value) for key, value in headers.items())
+        now = time.time()
+        with self._lock:
+            penalty = 0
+            rule_names = headers.get('x-rate-limit-rules')
+            if rule_names:
+                penalty = self._update_rules(headers, rule_names, now)
+            retry_after = headers.get('retry-after')
+            if retry_after:
+                try:
+                    penalty = max(penalty, float(retry_after))
+                except ValueError:
+                    pass
+            if status_code == 429 and not penalty:
+                # Throttled, but not told for how long: sit out a period
+                penalty = max(
+                    [bucket.period for bucket in self._buckets] or [60])
+            if penalty > 0:
+                self.logger.warning("Rate limited by server for %ss", penalty)
+                self.metrics.record_throttle(penalty)
+                self._blocked_until = max(self._blocked_until, now + penalty)
+
+    def _update_rules(self, headers, rule_names, now):
+        """
+        Called with the lock held to apply the rate limit headers. Returns
+        the longest lockout that the server says is in force, if any.
+        """
+
+        limits = []
+        states = []
+        for rule in rule_names.split(','):
+            rule = rule.strip().lower()
+            policy = headers.get('x-rate-limit-' + rule)
+            state = headers.get('x-rate-limit-%s-state' % rule)
+            if not policy:
+                continue
+            limits += [self._parse_triples(policy)]
+            states += [self._parse_triples(state) if state else []]
+
+        rules = [
+            (hits, period)
+            for rule_limits in limits
+            for (hits, period, _) in rule_limits]
+        if rules and rules != self._rules:
+            self.logger.info(
+                "Rate limit policy: %s",
+                ", ".join("%s/%ss" % rule for rule in rules))
+            old = dict(
+                ((bucket.hits, bucket.period), bucket)
+                for bucket in self._buckets)
+            self._buckets = [
+                old.get((hits, period)) or _Bucket(hits, period, self.burst, now)
+                for (hits, period) in rules]
+            self._rules = rules
+
+        penalty = 0
+        buckets = dict(
+            ((bucket.hits, bucket.period), bucket) for bucket in self._buckets)
+        for rule_limits, rule_states in zip(limits, states):
+            for (hits, period, _), (current, _, restricted) in zip(
+                    rule_limits, rule_states):
+                bucket = buckets[(hits, period)]
+                # The server's count is the truth, less our safety margin
+                bucket.refill(now)
+                bucket.tokens = min(
+                    bucket.tokens,
+                    hits - current - min(self.margin, hits - 1))
+                penalty = max(penalty, restricted)
+        return penalty
+
+    @staticmethod
+    def _parse_triples(header):
+        """Parse "a:b:c,d:e:f" into [(a, b, c), (d, e, f)]"""
+
+        return [
+            tuple(int(value) for value in triple.split(':'))
+            for triple in header.split(',') if triple.strip()]
+
+
+# vim: et:sw=4:sts=4:ai:
@@ -7,14 +7,15 @@ the `PoeApi` class.
 
 
 import re
-import time
 import logging
-import datetime
 import requests
 import requests.packages.urllib3.util.retry as urllib_retry
 import requests.adapters as requests_adapters
 import rapidjson as json
 
+from .jsonstream import StashStreamDecoder
+from .ratelimit import TokenBucketLimiter
+
 
 __author__ = "Aaron Sherman <ajs@ajs.com>"
 __copyright__ = "Copyright 2018, Aaron Sherman"
@@ -25,6 +26,25 @@ __email__ = "ajs@ajs.com"
 
 
 POE_STASH_API_ENDPOINT = 'http://www.pathofexile.com/api/public-stash-tabs'
+# The API sends next_change_id before the (huge) stashes list, so it
+# can be found in the first few bytes of the response body.
+NEXT_CHANGE_ID_RE = re.compile(rb'"next_change_id"\s*:\s*"([^"\\]*)"')
+
+
+def extract_next_change_id(head):
+    """
+    Find the next_change_id in the leading bytes of a raw page, without
+    decoding the rest of it. Returns None if it is not (yet) present.
+    """
+
+    match = NEXT_CHANGE_ID_RE.search(head)
+    if match:
+        return match.group(1).decode('utf-8')
+    return None
+
+
+class NoMorePages(Exception):
+    """Raised by PoeApi subclasses that have a finite supply of pages"""
 
 
 # TODO: Move this out into something more central
@@ -193,6 +213,110 @@ class ApiStash(PoeApiData):
         return len(self._data['items'])
 
 
+class CompactApiData:
+    """
+    A lighter-weight alternative to `PoeApiData` for the ingest hot loop.
+
+    Every field is resolved into a `__slots__` attribute once, at
+    construction, rather than being looked up in the underlying dict on
+    every access, and the raw data is not kept. Validation against
+    `required_fields` happens in the same pass, so the constructor
+    raises `ValueError` for invalid data and `validate` has nothing
+    left to do.
+
+    Subclasses set `fields`, `required_fields` and `__slots__` (which
+    must include the fields) and may override `_set_fields`.
+    """
+
+    __slots__ = ('_logger',)
+    fields = ()
+    required_fields = ()
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        assert cls.fields, "Incorrectly initialized CompactApiData class"
+        for field in cls.fields:
+            if field.startswith('_') or not field.isidentifier():
+                raise KeyError("Invalid field name: %s" % field)
+        # Like namedtuple, generate straight-line code for the assignments,
+        # which is several times faster than a loop over setattr.
+        source = "def _assign_fields(self, data):\n    get = data.get\n"
+        source += "".join(
+            "    self.%s = get(%r)\n" % (field, field) for field in cls.fields)
+        namespace = {}
+        exec(source, namespace)  # pylint: disable=exec-used
+        cls._assign_fields = namespace['_assign_fields']
+
+    def __init__(self, data, logger=logging):
+        self._logger = logger
+        missing = [
+            field for field in self.required_fields
+            if data.get(field, None) is None]
+        if missing:
+            raise ValueError(
+                "%s: %s is a required field" % (
+                    self.__class__.__name__, missing[0]))
+        self._set_fields(data)
+
+    def _set_fields(self, data):
+        self._assign_fields(data)
+
+    def __repr__(self):
+        return PoeApiData.__repr__(self)
+
+    def _repr_fields(self):
+        return PoeApiData._repr_fields(self)
+
+    def validate(self):
+        """Validation was done by the constructor"""
+
+
+class CompactApiItem(CompactApiData):
+    """
+    A compact `ApiItem`. `name` and `typeLine` have their markup stripped
+    once, when the item is created.
+    """
+
+    fields = ApiItem.fields
+    required_fields = ApiItem.required_fields
+    __slots__ = tuple(fields)
+
+    def _set_fields(self, data):
+        super()._set_fields(data)
+        self.name = self._clean_markup(self.name)
+        self.typeLine = self._clean_markup(self.typeLine)
+
+    @staticmethod
+    def _clean_markup(value):
+        # Most names have no markup, so skip the regex for those
+        if value and value.startswith('<<'):
+            return ApiItem.name_cleaner_re.sub('', value)
+        return value
+
+
+class CompactApiStash(CompactApiData):
+    """
+    A compact `ApiStash`. `items` is a list of `CompactApiItem`, built
+    (and validated) when the stash is created.
+    """
+
+    fields = ApiStash.fields
+    required_fields = ApiStash.required_fields
+    __slots__ = tuple(fields) + ('api_item_count',)
+
+    def _set_fields(self, data):
+        super()._set_fields(data)
+        raw_items = self.items or []
+        self.api_item_count = len(raw_items)
+        items = []
+        for item in raw_items:
+            try:
+                items.append(CompactApiItem(item, logger=self._logger))
+            except ValueError as e:
+                self._logger.warning("Invalid item: %s", str(e))
+        self.items = items
+
+
 class PoeApi:
     """
     This is the core API class. To access the PoE API, simply instantiate
@@ -213,88 +337,235 @@ class PoeApi:
 
     * `next_id` - The id of the first result to be fetched (internal to
                   the HTTP API.
-    * `rate` - The number of seconds (float) to wait between requests.
+    * `rate` - The number of seconds (float) to wait between requests
+               until the server has told us its actual rate limits.
                Defaults to 1.1. Changing this can result in server-side rate-
                limiting.
-    * `slow` - Be extra careful about issuing requests too fast by updating the
-               last request counter AFTER a request completes. Otherwise, the
-               counter is only updated BEFORE each request.
+    * `rate_limiter` - A `poefixer.ratelimit.RateLimiter` to use instead of
+                       the default header-driven `TokenBucketLimiter`. Pass
+                       the same one to several `PoeApi` objects to share a
+                       budget between them.
+    * `slow` - Be extra careful about issuing requests too fast by also
+               waiting at least `rate` seconds after each request completes
+               before starting the next, however much the server's rate
+               limit headers would allow (see the `min_interval` of
+               `TokenBucketLimiter`). Has no effect on a `rate_limiter`
+               passed in, which should be given its own `min_interval`.
     * `api_root` - The PoE stash API root. Generally don't change this unless
                    you have a mock server you use for testing.
+    * `streaming` - Decode each page incrementally as it arrives, so that
+                    `get_next` yields stashes before the page has finished
+                    downloading and only one stash is held in memory at a
+                    time. Each generator must be used up before the next
+                    call to `get_next`. Decoding is several times slower
+                    than decoding the whole page with rapidjson (the
+                    default), so only stream when memory is the limit
+                    (see `scripts/benchmark.py decode`).
+    * `recorder` - A `PageArchive` (see `poefixer.archive`) to which every
+                   raw page is appended as it is fetched.
+    * `compact` - Yield `CompactApiStash` objects (with `CompactApiItem`
+                  items) rather than `ApiStash`. They are faster to write
+                  to the database and use less memory, but hold no
+                  reference to the raw data.
     """
 
     api_root = POE_STASH_API_ENDPOINT
     next_id = None
     rate = 1.1
     slow = False
+    streaming = False
+    recorder = None
+    compact = False
+    # Bytes per read from a streamed response
+    chunk_size = 64 * 1024
+    # Stop looking for an early next_change_id after this many bytes
+    next_id_scan_limit = 4096
+    # Give up on a page after being throttled this many times in a row
+    max_throttled_attempts = 5
 
     def __init__(
             self,
-            next_id=None, rate=None, slow=None, api_root=None, logger=logging):
+            next_id=None, rate=None, slow=None, api_root=None,
+            streaming=None, recorder=None, rate_limiter=None,
+            compact=None, logger=logging):
         self.logger = logger
         self.next_id = next_id
         if rate is not None:
-            self.rate = datetime.timedelta(seconds=rate)
+            self.rate = rate
         if slow is not None:
             self.slow = slow
         if api_root is not None:
             self.api_root = api_root
-        self.last_time = None
+        if streaming is not None:
+            self.streaming = streaming
+        if recorder is not None:
+            self.recorder = recorder
+        if compact is not None:
+            self.compact = compact
+        if rate_limiter is None:
+            rate_limiter = TokenBucketLimiter(
+                default_interval=self.rate,
+                min_interval=self.rate if self.slow else None, logger=logger)
+        self.rate_limiter = rate_limiter
         self.rq_context = requests_context()
 
     def rate_wait(self):
-        """Pause for the rest of the time left in our rate limiting parameter"""
+        """Pause until the rate limiter allows another request"""
 
-        if self.last_time:
-            now = datetime.datetime.now()
-            delta = now - self.last_time
-            if delta.total_seconds() < self.rate:
-                remaining = self.rate - delta.total_seconds()
-                time.sleep(remaining)
-        self.set_last_time()
+        self.rate_limiter.wait()
 
     def set_last_time(self):
-        """Set the time of the last request for rate limiting"""
+        """Tell the rate limiter that a request has completed"""
 
-        self.last_time = datetime.datetime.now()
+        self.rate_limiter.request_done()
 
     def get_next(self):
         """Return the next stash generator"""
 
         self.rate_wait()
+        if self.streaming:
+            return self._stream_next()
         data, self.next_id = self._get_data(next_id=self.next_id, slow=self.slow)
         return self.stash_generator(data)
 
-    @staticmethod
-    def stash_generator(data):
+    def stash_generator(self, data):
         """Turn a data blob from the API into a generator of ApiStash objects"""
 
+        stash_class = CompactApiStash if self.compact else ApiStash
         for stash in data:
-            api_stash = ApiStash(stash)
             try:
+                api_stash = stash_class(stash, logger=self.logger)
                 api_stash.validate()
             except ValueError as e:
                 self.logger.warning("Invalid stash: %s", str(e))
                 continue
             yield api_stash
 
+    def stream_generator(self, chunks):
+        """
+        Like `stash_generator`, but incrementally decodes an iterable of
+        raw page chunks (bytes), such as a file read in blocks.
+        """
+
+        decoder = StashStreamDecoder()
+        for chunk in chunks:
+            for stash in self.stash_generator(decoder.feed(chunk)):
+                yield stash
+        decoder.close()
+
+    def _stream_next(self):
+        """
+        Start streaming the next page and read just far enough to learn
+        its next change id, then return a generator over its stashes.
+        """
+
+        change_id = self.next_id
+        chunks = self.fetch_chunks(next_id=change_id, slow=self.slow)
+        if self.recorder is not None:
+            chunks = self._recorded(change_id, chunks)
+        decoder = StashStreamDecoder()
+        early = []
+        for chunk in chunks:
+            early += decoder.feed(chunk)
+            if decoder.next_change_id is not None:
+                break
+        if decoder.next_change_id is None:
+            decoder.close()
+        self.next_id = decoder.next_change_id
+
+        def generate():
+            for stash in self.stash_generator(early):
+                yield stash
+            # Don't hold on to stashes that have been handed out
+            del early[:]
+            for chunk in chunks:
+                for stash in self.stash_generator(decoder.feed(chunk)):
+                    yield stash
+            decoder.close()
+
+        return generate()
+
+    def _recorded(self, change_id, chunks):
+        """Pass `chunks` through, recording the whole page at the end"""
+
+        seen = []
+        for chunk in chunks:
+            seen.append(chunk)
+            yield chunk
+        self.recorder.record(change_id, b''.join(seen))
+
     def _get_data(self, next_id=None, slow=False):
         """Actually read from the API via requests library"""
 
+        return self.decode_page(self.fetch_raw(next_id=next_id, slow=slow))
+
+    def fetch_raw(self, next_id=None, slow=False, on_next_id=None):
+        """
+        Request one page from the API and return its undecoded body as
+        bytes. Rate limiting is up to the caller (see `rate_wait`).
+
+        If `on_next_id` is given, the callable is passed the page's
+        next_change_id as soon as it has arrived, while the rest of the
+        page is still downloading. It is not called if the id is not near
+        the start of the body, in which case the caller must get it from
+        `decode_page`.
+        """
+
+        chunks = []
+        head = b'' if on_next_id is not None else None
+        for chunk in self.fetch_chunks(next_id=next_id, slow=slow):
+            chunks.append(chunk)
+            if head is None:
+                continue
+            head += chunk
+            early_id = extract_next_change_id(head)
+            if early_id is not None:
+                self.logger.debug("Early next_change_id: %s", early_id)
+                on_next_id(early_id)
+                head = None
+            elif len(head) > self.next_id_scan_limit:
+                head = None
+        self.logger.debug("Acquired stash data")
+        raw = b''.join(chunks)
+        if self.recorder is not None:
+            self.recorder.record(next_id, raw)
+        return raw
+
+    def fetch_chunks(self, next_id=None, slow=False):
+        """
+        Request one page from the API and return an iterator over the raw
+        chunks of its body as they arrive.
+        """
+
         url = self.api_root
         if next_id:
             self.logger.info("Requesting next stash set: %s" % next_id)
             url += '?id=' + next_id
         else:
             self.logger.info("Requesting first stash set")
-        req = self.rq_context.get(url)
+        attempts = 0
+        while True:
+            req = self.rq_context.get(url, stream=True)
+            self.rate_limiter.update(req.headers, req.status_code)
+            attempts += 1
+            if req.status_code != 429 or attempts >= self.max_throttled_attempts:
+                break
+            req.close()
+            self.rate_wait()
         if slow:
             self.set_last_time()
         req.raise_for_status()
-        self.logger.debug("Acquired stash data")
+        return req.iter_content(chunk_size=self.chunk_size)
+
+    def decode_page(self, raw):
+        """
+        Decode a raw page from `fetch_raw` and return a tuple of the
+        list of stash data and the next change id.
+        """
+
         # rapidjson doesn't tell python what its methods are...
         # pylint: disable=c-extension-no-member
-        data = json.loads(req.text)
+        data = json.loads(raw)
         self.logger.debug("Loaded stash data from JSON")
         if 'next_change_id' not in data:
             raise KeyError('next_change_id required field not present in response')
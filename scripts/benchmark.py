@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Rough throughput measurements for the poefixer write paths
+"""
+
+
+import copy
+import time
+import argparse
+import tracemalloc
+
+import rapidjson as json
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.extra.sample_data import sample_stash_data
+from poefixer.extra.synthetic import SyntheticPages
+from poefixer.jsonstream import iter_stash_stream
+from poefixer.postprocess.currency import CurrencyPostprocessor
+
+
+DEFAULT_DSN='sqlite:///:memory:'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-d', '--database-dsn',
+        action='store', default=DEFAULT_DSN,
+        help='Database connection string for SQLAlchemy')
+    parser.add_argument(
+        '--pages', action='store', type=int, default=5,
+        help='Number of pages to write')
+    parser.add_argument(
+        '--page-size', action='store', type=int, default=200,
+        help='Number of stashes per page')
+    parser.add_argument(
+        'mode',
+        choices=('ingest', 'records', 'sales', 'decode'),
+        nargs=1,
+        action='store', help='What to benchmark.')
+    return parser.parse_args()
+
+def synthetic_pages(pages, page_size, stash_class=poefixer.ApiStash):
+    """
+    Build `pages` lists of `page_size` ApiStash objects each, by
+    renumbering copies of the sample data so that every stash and item
+    is distinct. Pass `stash_class=None` to get the raw stash dicts.
+    """
+
+    template = sample_stash_data()
+    serial = 0
+    for _ in range(pages):
+        page = []
+        while len(page) < page_size:
+            for stash in copy.deepcopy(template):
+                serial += 1
+                stash['id'] = '%064x' % serial
+                for item in stash['items']:
+                    serial += 1
+                    item['id'] = '%064x' % serial
+                page.append(stash_class(stash) if stash_class else stash)
+        yield page[:page_size]
+
+def bench_ingest(options, logger):
+    """Compare the per-row and bulk stash writers"""
+
+    pages = list(synthetic_pages(options.pages, options.page_size))
+    items = sum(
+        stash.api_item_count for page in pages for stash in page)
+
+    def per_row(db, page):
+        for stash in page:
+            db.insert_api_stash(stash, with_items=True)
+
+    def bulk(db, page):
+        db.insert_api_stashes(page, with_items=True)
+
+    for name, writer in (('per-row', per_row), ('bulk', bulk)):
+        db = poefixer.PoeDb(db_connect=options.database_dsn, logger=logger)
+        db.create_database()
+        # Write everything twice so that the update path is measured too
+        start = time.time()
+        for _ in range(2):
+            for page in pages:
+                writer(db, page)
+                db.session.commit()
+        elapsed = time.time() - start
+        print("%-8s %8.2fs %10.1f items/s" % (
+            name, elapsed, 2 * items / elapsed))
+
+def bench_records(options, logger):
+    """
+    Compare ApiStash with CompactApiStash for the work that the ingest
+    loop does: build each stash and read every column of it and its items.
+    """
+
+    pages = list(synthetic_pages(
+        options.pages, options.page_size, stash_class=None))
+    raw_page = json.dumps(pages[0])
+    stash_fields = poefixer.PoeDb.stash_simple_fields
+    item_fields = poefixer.PoeDb.item_simple_fields
+
+    for name, stash_class in (
+            ('dict', poefixer.ApiStash), ('compact', poefixer.CompactApiStash)):
+        items = 0
+        start = time.time()
+        for page in pages:
+            for data in page:
+                stash = stash_class(data, logger=logger)
+                stash.validate()
+                row = [getattr(stash, field, None) for field in stash_fields]
+                for item in stash.items:
+                    item.validate()
+                    row = [getattr(item, field, None) for field in item_fields]
+                    items += 1
+        elapsed = time.time() - start
+
+        # Memory held by one decoded page of records. ApiStash keeps the
+        # decoded JSON alive; CompactApiStash lets it go.
+        tracemalloc.start()
+        held = [
+            stash_class(data, logger=logger)
+            for data in json.loads(raw_page)]
+        held = [(stash, list(stash.items)) for stash in held]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del held
+        print("%-8s %8.2fs %10.1f items/s %8.1f KiB/page" % (
+            name, elapsed, items / elapsed, size / 1024.0))
+
+def bench_sales(options, logger):
+    """
+    Compare writing the currency postprocessor's sales one at a time with
+    writing them once per block. Each writer runs twice over the same
+    items so that rewriting existing sales is measured too.
+    """
+
+    pages = SyntheticPages(stashes_per_page=options.page_size)
+
+    for name, deferred in (('per-sale', False), ('batched', True)):
+        db = poefixer.PoeDb(db_connect=options.database_dsn, logger=logger)
+        db.create_database()
+        change_id = None
+        for _ in range(options.pages):
+            db.insert_api_stashes(
+                [poefixer.ApiStash(stash) for stash in pages.stashes(change_id)],
+                with_items=True)
+            change_id = pages.next_change_id(change_id)
+        db.session.commit()
+
+        elapsed = 0
+        for _ in range(2):
+            cp = CurrencyPostprocessor(
+                db, start_time=0, recent=None, deferred=deferred,
+                logger=logger)
+            start = time.time()
+            cp.do_currency_postprocessor()
+            elapsed += time.time() - start
+        sales = db.session.query(poefixer.Sale).count()
+        print("%-8s %8.2fs %10.1f sales/s" % (
+            name, elapsed, 2 * sales / elapsed))
+
+def bench_decode(options, logger):
+    """
+    Compare decoding whole pages with `rapidjson.loads` (what `PoeApi`
+    does unless `streaming` is set) with the incremental
+    `StashStreamDecoder`, fed the pages in 64KiB chunks, for speed and
+    for the peak memory used to decode a page.
+    """
+
+    pages = [
+        json.dumps({'next_change_id': str(index), 'stashes': page}).encode()
+        for index, page in enumerate(synthetic_pages(
+            options.pages, options.page_size, stash_class=None))]
+    size = 64 * 1024
+
+    def whole(raw):
+        return len(json.loads(raw)['stashes'])
+
+    def streamed(raw):
+        chunks = (raw[start:start+size] for start in range(0, len(raw), size))
+        return sum(1 for _ in iter_stash_stream(chunks))
+
+    for name, decode in (('loads', whole), ('stream', streamed)):
+        start = time.time()
+        stashes = sum(decode(raw) for raw in pages)
+        elapsed = time.time() - start
+        tracemalloc.start()
+        decode(pages[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-8s %8.2fs %10.1f stashes/s %8.1f KiB peak/page" % (
+            name, elapsed, stashes / elapsed, peak / 1024.0))
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    logger = plogger.get_poefixer_logger('WARNING')
+
+    mode = options.mode[0]
+    if mode == 'ingest':
+        bench_ingest(options, logger)
+    elif mode == 'records':
+        bench_records(options, logger)
+    elif mode == 'sales':
+        bench_sales(options, logger)
+    elif mode == 'decode':
+        bench_decode(options, logger)
+
+
+# vim: et:sw=4:sts=4:ai:
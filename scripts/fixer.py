@@ -17,6 +17,7 @@ import sqlalchemy
 
 import poefixer
 import poefixer.postprocess.currency as currency
+import poefixer.postprocess.revalue as revalue
 import poefixer.extra.logger as plogger
 
 
@@ -41,7 +42,7 @@ def parse_args():
         action='store_true', help='Diagnostic code profiling mode')
     parser.add_argument(
         'mode',
-        choices=('currency',), # more to come...
+        choices=('currency', 'revalue'), # more to come...
         nargs=1,
         action='store', help='Mode to run in.')
     add_currency_arguments(parser)
@@ -59,6 +60,29 @@ def add_currency_arguments(argsparser):
     argsparser.add_argument(
         '--limit',
         action='store', type=int, help='Limit processing to this many records')
+    argsparser.add_argument(
+        '--max-hops', action='store', type=int,
+        help='Longest currency conversion path used to price in Chaos')
+    argsparser.add_argument(
+        '--deferred', action='store_true',
+        help='Update each currency summary once per block, not per sale')
+    argsparser.add_argument(
+        '--no-sale-window', action='store_true',
+        help='Read recent sales from the database for every summary')
+    argsparser.add_argument(
+        '--currency-only', action='store_true',
+        help='Only record sales of currency items')
+    argsparser.add_argument(
+        '--rebuild', action='store_true',
+        help='Recompute all summaries and sale values from the sale table')
+    argsparser.add_argument(
+        '--workers', action='store', type=int,
+        help='Split each pass over this many processes (by league and '
+             'type). For database servers, not SQLite')
+    argsparser.add_argument(
+        '--price-buckets', action='store_true',
+        help='Keep hourly price buckets (used for summaries with '
+             '--no-sale-window)')
 
 def do_fixer(db, options, logger):
     mode = options.mode
@@ -69,12 +93,29 @@ def do_fixer(db, options, logger):
         start_time = options.start_time
         continuous = options.continuous
         limit = options.limit
-        currency.CurrencyPostprocessor(
+        processor = currency.CurrencyPostprocessor(
             db=db,
             start_time=start_time,
             continuous=continuous,
             limit=limit,
-            logger=logger).do_currency_postprocessor()
+            sale_windows=not options.no_sale_window,
+            max_hops=options.max_hops,
+            deferred=options.deferred,
+            currency_only=options.currency_only,
+            workers=options.workers,
+            price_buckets=options.price_buckets,
+            logger=logger)
+        if options.rebuild:
+            processor.do_currency_rebuild()
+        else:
+            processor.do_currency_postprocessor()
+    elif mode == 'revalue':
+        # Bring sale values in Chaos up to date with the latest summaries
+        revalue.SaleRevaluer(
+            db=db,
+            continuous=options.continuous,
+            max_hops=options.max_hops,
+            logger=logger).do_revaluation()
     else:
         raise ValueError("Expected execution mode, got: " + mode)
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Serve synthetic stash API pages locally, for load testing the readers:
+
+    scripts/mock_stash_server.py --verbose --port 8080 --latency 0.2 &
+    scripts/sample_api_reader.py --rate 0 \\
+        --api-root http://127.0.0.1:8080/api/public-stash-tabs
+"""
+
+
+import logging
+import argparse
+
+import poefixer.extra.logger as plogger
+from poefixer.extra.synthetic import SyntheticPages
+from poefixer.extra.mock_server import MockStashServer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--verbose', action='store_true', help='Verbose output')
+    parser.add_argument(
+        '--debug', action='store_true', help='Debugging output')
+    parser.add_argument(
+        '--host', action='store', default='127.0.0.1',
+        help='Address to listen on')
+    parser.add_argument(
+        '--port', action='store', type=int, default=8080,
+        help='Port to listen on')
+    parser.add_argument(
+        '--seed', action='store', type=int, default=0,
+        help='Seed for the synthetic pages')
+    parser.add_argument(
+        '--page-size', action='store', type=int,
+        default=SyntheticPages.stashes_per_page,
+        help='Stashes per page')
+    parser.add_argument(
+        '--items-per-stash', action='store', type=int,
+        default=SyntheticPages.items_per_stash,
+        help='Average number of items per stash')
+    parser.add_argument(
+        '--latency', action='store', type=float, default=0,
+        help='Seconds to wait before answering each request')
+    parser.add_argument(
+        '--max-pages', action='store', type=int,
+        help='End the chain of pages after this many')
+    parser.add_argument(
+        '--rate-limit', action='store', metavar='HITS:PERIOD:PENALTY,...',
+        help='Rate limits to advertise and enforce, e.g. 45:60:60,240:240:900')
+    return parser.parse_args()
+
+def parse_rate_limit(value):
+    """Parse "a:b:c,d:e:f" into [(a, b, c), (d, e, f)]"""
+
+    if not value:
+        return None
+    return [
+        tuple(int(part) for part in limit.split(':'))
+        for limit in value.split(',')]
+
+
+if __name__ == '__main__':
+    options = parse_args()
+
+    if options.debug:
+        level = 'DEBUG'
+    elif options.verbose:
+        level = 'INFO'
+    else:
+        level = 'WARNING'
+    logging.basicConfig(level=level)
+    logger = plogger.get_poefixer_logger(level)
+
+    pages = SyntheticPages(
+        seed=options.seed,
+        stashes_per_page=options.page_size,
+        items_per_stash=options.items_per_stash)
+    server = MockStashServer(
+        pages=pages,
+        host=options.host,
+        port=options.port,
+        latency=options.latency,
+        max_pages=options.max_pages,
+        rate_limit=parse_rate_limit(options.rate_limit),
+        logger=logger)
+    # The address (with the real port, if --port 0) is logged once the
+    # server is listening; run with --verbose to see it
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+# vim: et:sw=4:sts=4:ai:
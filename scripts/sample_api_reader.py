@@ -13,9 +13,13 @@ import requests
 
 import poefixer
 import poefixer.extra.logger as plogger
+from poefixer.ingest import IngestPipeline
+from poefixer.postprocess.notes import PriceNoteParser, learned_currencies
 
 
 DEFAULT_DSN='sqlite:///:memory:'
+# Stashes per bulk write when streaming
+STREAMING_BATCH=100
 
 
 def parse_args():
@@ -31,12 +35,51 @@ def parse_args():
     parser.add_argument(
         '--most-recent', action='store_true',
         help='Consult poe.ninja to find latest ID')
+    parser.add_argument(
+        '--per-row', action='store_true',
+        help='Write each stash and item individually instead of in bulk')
+    parser.add_argument(
+        '--record', action='store', metavar='DIR',
+        help='Also append every raw page to a page archive in DIR')
+    parser.add_argument(
+        '--replay', action='store', metavar='DIR',
+        help='Read pages from the page archive in DIR instead of the API')
+    parser.add_argument(
+        '--streaming', action='store_true',
+        help='Decode and write stashes while each page is still arriving '
+             '(less memory, slower decoding)')
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='Run fetch, decode and write stages concurrently')
+    parser.add_argument(
+        '--queue-size', action='store', type=int, default=4,
+        help='Pages buffered between pipeline stages')
+    parser.add_argument(
+        '--fetchers', action='store', type=int, default=2,
+        help='Pipeline requests allowed in flight at once')
+    parser.add_argument(
+        '--api-root', action='store',
+        help='Stash API URL, such as that of scripts/mock_stash_server.py')
+    parser.add_argument(
+        '--rate', action='store', type=float,
+        help='Seconds between requests until the server sends rate limits')
+    parser.add_argument(
+        '--parse-prices', action='store_true',
+        help='Parse price notes as items are written')
+    parser.add_argument(
+        '--compact', action='store_true',
+        help='Read stashes into compact records rather than full ApiStash '
+             'objects (faster, but without the raw data)')
     parser.add_argument(
         'next_id', action='store', nargs='?',
         help='The next id to start at')
     return parser.parse_args()
 
-def pull_data(database_dsn, next_id, most_recent, logger):
+def pull_data(
+        database_dsn, next_id, most_recent, logger,
+        per_row=False, pipeline=False, queue_size=4, fetchers=2,
+        streaming=False, record=None, replay=None, api_root=None, rate=None,
+        parse_prices=False, compact=False):
     """Grab data from the API and insert into the DB"""
 
     if most_recent:
@@ -48,14 +91,46 @@ def pull_data(database_dsn, next_id, most_recent, logger):
         next_id = data['next_change_id']
 
     db = poefixer.PoeDb(db_connect=database_dsn, logger=logger)
-    api = poefixer.PoeApi(logger=logger, next_id=next_id)
+    if replay:
+        api = poefixer.ReplayPoeApi(
+            poefixer.PageArchive(replay, logger=logger),
+            logger=logger, next_id=next_id, streaming=streaming,
+            compact=compact)
+    else:
+        recorder = None
+        if record:
+            recorder = poefixer.PageArchive(record, logger=logger)
+        api = poefixer.PoeApi(
+            logger=logger, next_id=next_id, streaming=streaming,
+            recorder=recorder, compact=compact, api_root=api_root, rate=rate)
 
     db.create_database()
 
+    if parse_prices:
+        db.price_parser = PriceNoteParser(
+            actual_currencies=learned_currencies(db, logger=logger),
+            logger=logger).ingest_price
+
+    if pipeline:
+        IngestPipeline(
+            api, db, queue_size=queue_size, per_row=per_row,
+            fetchers=fetchers, logger=logger).run()
+        return
+
     while True:
-        for stash in api.get_next():
-            logger.debug("Inserting stash...")
-            db.insert_api_stash(stash, with_items=True)
+        try:
+            stashes = api.get_next()
+            if per_row:
+                for stash in stashes:
+                    logger.debug("Inserting stash...")
+                    db.insert_api_stash(stash, with_items=True)
+            else:
+                db.insert_api_stashes(
+                    stashes, with_items=True,
+                    batch_size=STREAMING_BATCH if streaming else None)
+        except poefixer.NoMorePages:
+            logger.info("Replay complete.")
+            break
         logger.info("Stash pass complete.")
         db.session.commit()
 
@@ -76,7 +151,18 @@ if __name__ == '__main__':
         database_dsn=options.database_dsn,
         next_id=options.next_id,
         most_recent=options.most_recent,
-        logger=logger)
+        logger=logger,
+        per_row=options.per_row,
+        pipeline=options.pipeline,
+        queue_size=options.queue_size,
+        fetchers=options.fetchers,
+        streaming=options.streaming,
+        record=options.record,
+        replay=options.replay,
+        api_root=options.api_root,
+        rate=options.rate,
+        parse_prices=options.parse_prices,
+        compact=options.compact)
 
 
 # vim: et:sw=4:sts=4:ai:
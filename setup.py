@@ -28,10 +28,11 @@ VERSION = None
 REQUIRED = [
     # General requirements. See requirements.txt for latest
     # tested versioning.
+    'numpy',
     'PyMySQL>=0.9',
     'python-rapidjson',
     'requests>=2.0.0',
-    'SQLAlchemy>=1.2.0',
+    'SQLAlchemy>=1.4.0',
 ]
 
 EXTRAS = { }
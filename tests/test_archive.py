@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.archive"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.extra.sample_data import sample_pages
+from poefixer.ingest import IngestPipeline
+
+
+class ChunkedApi(poefixer.PoeApi):
+    """A PoeApi that serves pre-built pages without the network"""
+
+    def __init__(self, pages, **kwargs):
+        super().__init__(rate=0, **kwargs)
+        self.pages = pages
+
+    def fetch_chunks(self, next_id=None, slow=False):
+        raw = self.pages[next_id]
+        return [raw[:100], raw[100:]]
+
+
+def page_size(change_id, raw):
+    return (change_id, len(raw))
+
+
+class TestPageArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def _get_default_db(self):
+        db = poefixer.PoeDb(db_connect='sqlite:///:memory:', logger=self.logger)
+        db.create_database()
+        return db
+
+    def _record(self, pages, count, **kwargs):
+        archive = poefixer.PageArchive(self.path, logger=self.logger, **kwargs)
+        api = ChunkedApi(pages, recorder=archive, logger=self.logger)
+        for _ in range(count):
+            list(api.get_next())
+        archive.close()
+
+    def test_record_and_replay(self):
+        pages = sample_pages(4)
+        # A tiny segment size forces one segment per page
+        self._record(pages, 4, segment_size=1)
+
+        archive = poefixer.PageArchive(self.path, logger=self.logger)
+        self.assertEqual(len(archive.segments()), 4)
+        self.assertEqual(len(archive), 4)
+        self.assertEqual(
+            [page[2] for page in archive.pages()],
+            [pages[change_id] for change_id in (None, 'page-1', 'page-2', 'page-3')])
+
+        api = poefixer.ReplayPoeApi(archive, logger=self.logger)
+        ids = []
+        while True:
+            try:
+                ids += [stash.id for stash in api.get_next()]
+            except poefixer.NoMorePages:
+                break
+        self.assertEqual(len(ids), 8)
+        self.assertEqual(api.next_id, 'page-4')
+
+    def test_record_streaming(self):
+        pages = sample_pages(2)
+        archive = poefixer.PageArchive(self.path, logger=self.logger)
+        api = ChunkedApi(
+            pages, recorder=archive, streaming=True, logger=self.logger)
+        for _ in range(2):
+            list(api.get_next())
+        archive.close()
+
+        replay = poefixer.ReplayPoeApi(
+            poefixer.PageArchive(self.path), next_id='page-1', streaming=True,
+            logger=self.logger)
+        self.assertEqual(len(list(replay.get_next())), 2)
+        self.assertEqual(replay.next_id, 'page-2')
+
+    def test_append_to_existing_archive(self):
+        pages = sample_pages(3)
+        self._record(pages, 2)
+        archive = poefixer.PageArchive(self.path, logger=self.logger)
+        archive.record('page-2', pages['page-2'])
+        archive.close()
+
+        self.assertEqual(len(archive.segments()), 1)
+        self.assertEqual(len(list(poefixer.PageArchive(self.path).pages())), 3)
+
+    def test_sidecar_index(self):
+        pages = sample_pages(3)
+        self._record(pages, 3)
+        archive = poefixer.PageArchive(self.path, logger=self.logger)
+        segment = archive.segments()[0]
+        index_path = segment[:-len('.seg')] + '.idx'
+        with open(index_path) as index:
+            self.assertEqual(len(index.readlines()), 3)
+
+        # Random access by change id, and chunked reads of the mapping
+        location = archive.locate('page-2')
+        self.assertEqual(archive.read(location), pages['page-2'])
+        self.assertEqual(
+            b''.join(archive.read_chunks(location, chunk_size=100)),
+            pages['page-2'])
+        archive.close()
+
+        # A missing or stale index is rebuilt from the segment
+        os.unlink(index_path)
+        archive = poefixer.PageArchive(self.path, logger=self.logger)
+        self.assertEqual(archive.locate('page-1').size, len(pages['page-1']))
+        self.assertTrue(os.path.exists(index_path))
+        archive.close()
+
+    def test_map_pages(self):
+        pages = sample_pages(4)
+        self._record(pages, 4)
+        archive = poefixer.PageArchive(self.path, logger=self.logger)
+
+        results = list(archive.map_pages(page_size, processes=2))
+
+        self.assertEqual(
+            results,
+            [(change_id, len(pages[change_id]))
+                for change_id in (None, 'page-1', 'page-2', 'page-3')])
+
+    def test_pipeline_replay(self):
+        self._record(sample_pages(3), 3)
+        db = self._get_default_db()
+        api = poefixer.ReplayPoeApi(
+            poefixer.PageArchive(self.path), logger=self.logger)
+        pipeline = IngestPipeline(api, db, logger=self.logger)
+
+        pipeline.run()
+
+        self.assertEqual(pipeline.last_written_id, 'page-3')
+        self.assertEqual(db.session.query(poefixer.Item).count(), 18)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.batch"""
+
+import math
+import unittest
+
+import numpy
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.batch import DictionaryColumn, ItemBatch
+from poefixer.extra.sample_data import sample_stash_data
+from poefixer.postprocess.currency import CurrencyPostprocessor
+
+
+class TestItemBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+
+    def _batch(self):
+        return ItemBatch.from_stashes(
+            poefixer.CompactApiStash(stash) for stash in sample_stash_data())
+
+    def test_dictionary_column(self):
+        column = DictionaryColumn.encode(['a', None, 'b', 'a', None])
+        self.assertEqual(len(column.values), 3)
+        self.assertEqual(column.tolist(), ['a', None, 'b', 'a', None])
+        self.assertEqual(column[3], 'a')
+        self.assertEqual(list(column.equals('a')), [1, 0, 0, 1, 0])
+        self.assertEqual(list(column.isin(['b', None])), [0, 1, 1, 0, 1])
+
+        calls = []
+        def upper(value):
+            calls.append(value)
+            return value and value.upper()
+        self.assertEqual(
+            column.map_unique(upper), ['A', None, 'B', 'A', None])
+        self.assertEqual(len(calls), 3)
+
+    def test_columns(self):
+        batch = self._batch()
+        items = [
+            item for stash in sample_stash_data() for item in stash['items']]
+        self.assertEqual(len(batch), 6)
+        self.assertEqual(batch.api_ids, [item['id'] for item in items])
+        self.assertEqual(list(batch.stash_index), [0, 0, 0, 1, 1, 1])
+        self.assertEqual(batch['ilvl'].dtype, numpy.int64)
+        self.assertEqual(
+            batch.column_list('stackSize'),
+            [item.get('stackSize') for item in items])
+        self.assertEqual(
+            batch.column_list('corrupted'),
+            [item.get('corrupted') for item in items])
+        self.assertEqual(len(batch['league'].values), 1)
+        self.assertEqual(
+            batch.column_list('stash'), ['Sell'] * 3 + ['$'] * 3)
+        self.assertEqual(
+            next(batch.rows(['x', 'note']))['note'], items[0]['note'])
+
+    def test_batch_prices(self):
+        db = poefixer.PoeDb(db_connect='sqlite:///:memory:', logger=self.logger)
+        cp = CurrencyPostprocessor(db, start_time=None, logger=self.logger)
+        amounts, currencies = cp.batch_prices(self._batch())
+        self.assertEqual(list(amounts[:5]), [3, 2, 1, 4, 50])
+        self.assertTrue(math.isnan(amounts[5]))
+        self.assertEqual(currencies[0], 'Chaos Orb')
+        self.assertIsNone(currencies[5])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
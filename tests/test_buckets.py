@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.postprocess.buckets"""
+
+import unittest
+
+import sqlalchemy
+
+import poefixer
+import poefixer.extra.logger as plogger
+from test_summary import process_currency, synthetic_db
+
+
+class TestPriceBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+        self.db = synthetic_db(5, self.logger, pages=3, item_note_rate=0.8)
+
+    def _process(self, **kwargs):
+        return process_currency(
+            self.db, self.logger, block_size=50, price_buckets=True,
+            **kwargs)
+
+    def _buckets(self):
+        query = self.db.session.query(poefixer.PriceBucket)
+        return sorted(
+            (row.name, row.currency, row.league, row.hour, row.count,
+                round(row.total, 6), round(row.total_squares, 6),
+                round(row.minimum_squares, 6), row.minimum, row.maximum)
+            for row in query.all())
+
+    def _expected(self):
+        query = self.db.session.query(poefixer.Sale, poefixer.Item.league)
+        query = query.join(
+            poefixer.Item, poefixer.Sale.item_id == poefixer.Item.id)
+        buckets = {}
+        for sale, league in query.all():
+            key = (
+                sale.name, sale.sale_currency, league,
+                sale.item_updated_at - sale.item_updated_at % 3600)
+            buckets.setdefault(key, []).append(sale.sale_amount)
+        return sorted(
+            key + (len(amounts), round(sum(amounts), 6),
+                round(sum(amount**2 for amount in amounts), 6),
+                round(sum((amount - min(amounts))**2 for amount in amounts), 6),
+                min(amounts), max(amounts))
+            for key, amounts in buckets.items())
+
+    def _reprice(self):
+        """Move a sold item to a later hour at a new price"""
+
+        Item = poefixer.Item
+        sale = self.db.session.query(poefixer.Sale).filter(
+            poefixer.Sale.is_currency == True).first()
+        latest = self.db.session.query(
+            sqlalchemy.func.max(Item.updated_at)).scalar()
+        self.db.session.execute(
+            sqlalchemy.update(Item).where(Item.id == sale.item_id).values(
+                note='~price 3 chaos', updated_at=latest + 7200))
+        self.db.session.commit()
+        return sale.item_id
+
+    def _check_maintained(self, **kwargs):
+        self._process(**kwargs)
+        buckets = self._buckets()
+        self.assertGreater(len(buckets), 10)
+        self.assertEqual(buckets, self._expected())
+
+        item_id = self._reprice()
+        self._process(**kwargs)
+        self.assertEqual(self._buckets(), self._expected())
+        sale = self.db.session.query(poefixer.Sale).filter(
+            poefixer.Sale.item_id == item_id).one()
+        self.assertEqual(
+            (sale.sale_amount, sale.sale_currency), (3.0, 'Chaos Orb'))
+
+    def test_maintained(self):
+        self._check_maintained()
+
+    def test_maintained_deferred(self):
+        self._check_maintained(deferred=True)
+
+    def test_rebuild(self):
+        processor = self._process()
+        buckets = self._buckets()
+        self.db.session.execute(
+            sqlalchemy.delete(poefixer.PriceBucket).where(
+                poefixer.PriceBucket.count > 1))
+        self.db.session.commit()
+        processor.do_currency_rebuild()
+        self.assertEqual(self._buckets(), buckets)
+
+    def test_summaries_and_history(self):
+        processor = self._process(sale_windows=False)
+        summaries = self.db.session.query(poefixer.CurrencySummary).all()
+        self.assertGreater(len(summaries), 5)
+        for summary in summaries:
+            history = processor.price_buckets.history(
+                summary.from_currency, summary.to_currency, summary.league)
+            self.assertTrue(history)
+            # The mean lies within the range of the prices
+            self.assertLessEqual(
+                min(low for _, _, _, low, _ in history),
+                summary.mean * (1 + 1e-9))
+            self.assertGreaterEqual(
+                max(high for _, _, _, _, high in history),
+                summary.mean * (1 - 1e-9))
+            self.assertEqual(
+                [hour for hour, _, _, _, _ in history],
+                sorted(hour for hour, _, _, _, _ in history))
+
+        # Buckets written before minimum_squares give the same statistics
+        summary = summaries[0]
+        args = (
+            summary.from_currency, summary.to_currency, summary.league,
+            summary.updated_at, processor.relevant,
+            processor.weight_increment)
+        stats = processor.price_buckets.stats(*args)
+        self.db.session.execute(
+            sqlalchemy.update(poefixer.PriceBucket).values(
+                minimum_squares=None))
+        for got, want in zip(processor.price_buckets.stats(*args), stats):
+            self.assertAlmostEqual(got, want)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.postprocess.conversion"""
+
+import unittest
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.postprocess.conversion import ConversionGraph
+
+
+class TestConversionGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+        self.db = poefixer.PoeDb(
+            db_connect='sqlite:///:memory:', logger=self.logger)
+        self.db.create_database()
+
+    def _summary(self, from_currency, to_currency, mean, weight,
+            league='Standard'):
+        self.db.session.add(poefixer.CurrencySummary(
+            from_currency=from_currency, to_currency=to_currency,
+            league=league, count=10, weight=weight, mean=mean,
+            standard_dev=0, created_at=0, updated_at=0))
+        self.db.session.commit()
+
+    def test_widest_path(self):
+        self._summary('Exalted Orb', 'Chaos Orb', 100, 1)
+        self._summary('Exalted Orb', 'Divine Orb', 5, 50)
+        self._summary('Divine Orb', 'Chaos Orb', 19, 40)
+        self._summary('Exalted Orb', 'Chaos Orb', 999, 100, league='Other')
+        graph = ConversionGraph(self.db, logger=self.logger)
+
+        # The two-hop path has the higher weakest weight
+        self.assertAlmostEqual(graph.value_of('Exalted Orb', 'Standard'), 95)
+        self.assertAlmostEqual(graph.value_of('Exalted Orb', 'Other'), 999)
+        self.assertEqual(graph.value_of('Chaos Orb', 'Standard'), 1)
+        self.assertIsNone(graph.value_of('Mirror of Kalandra', 'Standard'))
+
+    def test_ties_go_to_shorter_paths(self):
+        self._summary('Exalted Orb', 'Divine Orb', 5, 10)
+        self._summary('Divine Orb', 'Chaos Orb', 19, 10)
+        self._summary('Exalted Orb', 'Chaos Orb', 100, 10)
+        graph = ConversionGraph(self.db, logger=self.logger)
+        self.assertAlmostEqual(graph.value_of('Exalted Orb', 'Standard'), 100)
+
+    def test_max_hops(self):
+        self._summary('Mirror of Kalandra', 'Exalted Orb', 100, 5)
+        self._summary('Exalted Orb', 'Divine Orb', 5, 5)
+        self._summary('Divine Orb', 'Chaos Orb', 20, 5)
+
+        graph = ConversionGraph(self.db, logger=self.logger)
+        self.assertIsNone(graph.value_of('Mirror of Kalandra', 'Standard'))
+        graph = ConversionGraph(self.db, max_hops=3, logger=self.logger)
+        self.assertAlmostEqual(
+            graph.value_of('Mirror of Kalandra', 'Standard'), 10000)
+
+    def test_inverse_and_updates(self):
+        self._summary('Chaos Orb', 'Orb of Alchemy', 4, 5)
+        graph = ConversionGraph(self.db, logger=self.logger)
+        self.assertAlmostEqual(
+            graph.value_of('Orb of Alchemy', 'Standard'), 0.25)
+
+        # Changes are seen without going back to the database
+        graph.update('Standard', 'Orb of Alchemy', 'Chaos Orb', 0.3, 1)
+        self.assertAlmostEqual(
+            graph.value_of('Orb of Alchemy', 'Standard'), 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
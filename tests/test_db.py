@@ -6,6 +6,8 @@ import logging
 import unittest
 import collections
 
+import sqlalchemy
+
 import poefixer
 from poefixer.extra.sample_data import sample_stash_data
 
@@ -32,6 +34,300 @@ class TestPoefixerDb(unittest.TestCase):
         for stash in stashes:
             db.insert_api_stash(stash, with_items=True)
 
+    def test_bulk_insert_matches_per_row(self):
+        per_row_db = self._get_default_db()
+        for stash in self._sample_stashes():
+            per_row_db.insert_api_stash(stash, with_items=True)
+        per_row_db.session.commit()
+
+        bulk_db = self._get_default_db()
+        (stashes, items) = bulk_db.insert_api_stashes(
+            self._sample_stashes(), with_items=True)
+        bulk_db.session.commit()
+
+        self.assertEqual(stashes, 2)
+        self.assertEqual(items, 6)
+        self.assertEqual(
+            self._item_summary(per_row_db), self._item_summary(bulk_db))
+
+    def test_bulk_insert_updates_existing(self):
+        db = self._get_default_db()
+        db.insert_api_stashes(self._sample_stashes(), with_items=True)
+        db.session.commit()
+
+        data = sample_stash_data()
+        data[0]['items'][0]['note'] = '~price 5 chaos'
+        db.insert_api_stashes(
+            [poefixer.ApiStash(s) for s in data], with_items=True)
+        db.session.commit()
+
+        self.assertEqual(db.session.query(poefixer.Stash).count(), 2)
+        self.assertEqual(db.session.query(poefixer.Item).count(), 6)
+        item = db.session.query(poefixer.Item).filter(
+            poefixer.Item.api_id == data[0]['items'][0]['id']).one()
+        self.assertEqual(item.note, '~price 5 chaos')
+
+    def test_prices_at_ingest(self):
+        from poefixer.postprocess.notes import PriceNoteParser
+
+        def prices(db):
+            return sorted(
+                (item.api_id, item.price_amount, item.price_currency,
+                    item.price_source)
+                for item in db.session.query(poefixer.Item))
+
+        data = sample_stash_data()
+        data[0]['stash'] = '~b/o 2 chaos'
+        data[0]['items'][0]['note'] = '~price 1/2 exa'
+        data[0]['items'][1]['note'] = None
+        data[1]['stash'] = 'Not for sale'
+        stashes = [poefixer.ApiStash(s) for s in data]
+
+        unparsed_db = self._get_default_db()
+        unparsed_db.insert_api_stashes(stashes, with_items=True)
+        self.assertEqual(
+            set(price[1:] for price in prices(unparsed_db)),
+            set([(None, None, None)]))
+
+        parser = PriceNoteParser().parse
+        per_row_db = poefixer.PoeDb(
+            db_connect='sqlite:///:memory:', price_parser=parser)
+        per_row_db.create_database()
+        for stash in stashes:
+            per_row_db.insert_api_stash(stash, with_items=True)
+        bulk_db = poefixer.PoeDb(
+            db_connect='sqlite:///:memory:', price_parser=parser)
+        bulk_db.create_database()
+        bulk_db.insert_api_stashes(stashes, with_items=True)
+
+        found = prices(bulk_db)
+        self.assertEqual(found, prices(per_row_db))
+        by_id = dict((price[0], price[1:]) for price in found)
+        self.assertEqual(
+            by_id[data[0]['items'][0]['id']], (0.5, 'Exalted Orb', 'item'))
+        self.assertEqual(
+            by_id[data[0]['items'][1]['id']], (2.0, 'Chaos Orb', 'stash'))
+        self.assertEqual(by_id[data[1]['items'][2]['id']], (None, None, ''))
+
+        # A price in a currency that isn't known yet is left for the
+        # postprocessor to parse, once it may be
+        data[1]['items'][2]['note'] = '~price 3 wobbles'
+        learning = PriceNoteParser()
+        late_db = poefixer.PoeDb(
+            db_connect='sqlite:///:memory:',
+            price_parser=learning.ingest_price)
+        late_db.create_database()
+        late_db.insert_api_stashes(
+            [poefixer.ApiStash(s) for s in data], with_items=True)
+        by_id = dict((price[0], price[1:]) for price in prices(late_db))
+        self.assertEqual(
+            by_id[data[1]['items'][2]['id']], (None, None, None))
+        self.assertEqual(
+            by_id[data[0]['items'][0]['id']], (0.5, 'Exalted Orb', 'item'))
+        learning.set_actual_currencies({'wobbles': 'Wobble'})
+        self.assertEqual(
+            learning.ingest_price('~price 3 wobbles'), (3.0, 'Wobble'))
+        self.assertEqual(learning.ingest_price('~price 3 wibbles'), None)
+        self.assertEqual(learning.ingest_price('For sale'), (None, None))
+
+    def test_item_categories(self):
+        data = sample_stash_data()
+        data[0]['items'][0]['category'] = {'currency': []}
+        stashes = [poefixer.ApiStash(s) for s in data]
+
+        per_row_db = self._get_default_db()
+        for stash in stashes:
+            per_row_db.insert_api_stash(stash, with_items=True)
+        bulk_db = self._get_default_db()
+        bulk_db.insert_api_stashes(stashes, with_items=True)
+
+        def categories(db):
+            return sorted(
+                (item.api_id, item.category_root, item.is_currency)
+                for item in db.session.query(poefixer.Item))
+
+        found = categories(bulk_db)
+        self.assertEqual(found, categories(per_row_db))
+        self.assertIn((data[0]['items'][0]['id'], 'currency', True), found)
+        self.assertIn((data[1]['items'][0]['id'], 'cards', False), found)
+
+    def test_unchanged_rows_are_skipped(self):
+        def updated(db):
+            return dict(
+                (item.api_id, item.updated_at)
+                for item in db.session.query(poefixer.Item))
+
+        for bulk in (True, False):
+            db = self._get_default_db()
+
+            def write(data):
+                stashes = [poefixer.ApiStash(s) for s in data]
+                if bulk:
+                    counts = db.insert_api_stashes(stashes, with_items=True)
+                else:
+                    for stash in stashes:
+                        db.insert_api_stash(stash, with_items=True)
+                    counts = None
+                db.session.commit()
+                return counts
+
+            data = sample_stash_data()
+            write(data)
+            db.session.execute(
+                sqlalchemy.update(poefixer.Item).values(updated_at=1))
+            db.session.commit()
+
+            counts = write(data)
+            if bulk:
+                self.assertEqual(counts, (0, 0))
+            self.assertEqual(set(updated(db).values()), set([1]))
+
+            # One changed item in one stash, and a renamed stash
+            data[0]['items'][0]['note'] = '~price 5 chaos'
+            data[1]['stash'] = '~price 2 chaos'
+            counts = write(data)
+            if bulk:
+                self.assertEqual(counts, (1, 4))
+            changed = set(
+                api_id for api_id, when in updated(db).items() if when != 1)
+            self.assertEqual(
+                changed,
+                set([data[0]['items'][0]['id']] +
+                    [item['id'] for item in data[1]['items']]))
+
+    def test_stash_diff(self):
+        for bulk in (True, False):
+            db = self._get_default_db()
+
+            def write(data):
+                stashes = [poefixer.ApiStash(s) for s in data]
+                if bulk:
+                    db.insert_api_stashes(stashes, with_items=True)
+                else:
+                    for stash in stashes:
+                        db.insert_api_stash(stash, with_items=True)
+                db.session.commit()
+                # Only the changes logged by this write
+                query = db.session.query(poefixer.ItemChange)
+                query = query.filter(poefixer.ItemChange.created_at >= 0)
+                changes = sorted(
+                    (change.item_api_id, change.change)
+                    for change in query.all())
+                db.session.execute(
+                    sqlalchemy.update(poefixer.ItemChange).values(
+                        created_at=-1))
+                return changes
+
+            data = sample_stash_data()
+            gone = data[0]['items'].pop(0)
+            added = write(data)
+            self.assertEqual(len(added), 5)
+            self.assertEqual(set(change for _, change in added), set(['added']))
+
+            # Nothing changed, so nothing is logged
+            self.assertEqual(write(data), [])
+
+            # Move an item to the other stash, change one and remove one
+            moved = data[0]['items'].pop(0)
+            data[1]['items'].append(moved)
+            data[1]['items'][0]['note'] = '~price 5 chaos'
+            removed = data[1]['items'].pop(1)
+            data[0]['items'].append(gone)
+            self.assertEqual(write(data), sorted([
+                (moved['id'], 'removed'),
+                (moved['id'], 'added'),
+                (data[1]['items'][0]['id'], 'changed'),
+                (removed['id'], 'removed'),
+                (gone['id'], 'added')]))
+            active = dict(
+                (item.api_id, item.active)
+                for item in db.session.query(poefixer.Item))
+            self.assertEqual(active[removed['id']], False)
+            self.assertEqual(active[moved['id']], True)
+
+            # A removed item that comes back is reactivated
+            data[1]['items'].append(removed)
+            self.assertEqual(write(data), [(removed['id'], 'added')])
+            item = db.session.query(poefixer.Item).filter(
+                poefixer.Item.api_id == removed['id']).one()
+            self.assertTrue(item.active)
+
+            # A stash sent on its own with no items has emptied
+            emptied = [item['id'] for item in data[1]['items']]
+            data[1]['items'] = []
+            self.assertEqual(
+                write(data[1:]),
+                sorted((api_id, 'removed') for api_id in emptied))
+            active = dict(
+                (item.api_id, item.active)
+                for item in db.session.query(poefixer.Item))
+            self.assertFalse(any(active[api_id] for api_id in emptied))
+
+    def test_hashes_match_per_row(self):
+        per_row_db = self._get_default_db()
+        for stash in self._sample_stashes():
+            per_row_db.insert_api_stash(stash, with_items=True)
+        bulk_db = self._get_default_db()
+        bulk_db.insert_api_stashes(self._sample_stashes(), with_items=True)
+
+        for table in (poefixer.Stash, poefixer.Item):
+            def hashes(db):
+                return sorted(
+                    db.session.query(table.api_id, table.content_hash).all())
+            self.assertEqual(hashes(per_row_db), hashes(bulk_db))
+
+    def test_adds_missing_columns(self):
+        db = self._get_default_db()
+        with db._engine.begin() as connection:
+            for column in ('price_amount', 'price_source'):
+                connection.exec_driver_sql(
+                    "DROP INDEX ix_item_%s" % column)
+            for column in ('price_amount', 'price_currency', 'price_source'):
+                connection.exec_driver_sql(
+                    "ALTER TABLE item DROP COLUMN %s" % column)
+
+        db.create_database()
+        inspector = sqlalchemy.inspect(db._engine)
+        columns = set(
+            column['name'] for column in inspector.get_columns('item'))
+        indexes = set(index['name'] for index in inspector.get_indexes('item'))
+        self.assertIn('price_currency', columns)
+        self.assertIn('ix_item_price_amount', indexes)
+        db.insert_api_stashes(self._sample_stashes(), with_items=True)
+
+    def test_upsert_commands(self):
+        """
+        Each dialect's upsert updates only the given fields, on the given
+        key. MySQL isn't run here, so its statement is only compiled.
+        """
+
+        fields = ['sale_amount', 'updated_at']
+        mysql = poefixer.PoeDb._upsert_command(
+            poefixer.Sale, fields, 'item_api_id', 'mysql')
+        sql = str(mysql.compile(dialect=sqlalchemy.dialects.mysql.dialect()))
+        self.assertTrue(sql.startswith("INSERT INTO sale ("))
+        update = sql.split("ON DUPLICATE KEY UPDATE", 1)[1].strip()
+        self.assertEqual(
+            update,
+            "sale_amount = VALUES(sale_amount), "
+            "updated_at = VALUES(updated_at)")
+
+        sqlite = poefixer.PoeDb._upsert_command(
+            poefixer.Sale, fields, 'item_api_id', 'sqlite')
+        sql = str(sqlite.compile(dialect=sqlalchemy.dialects.sqlite.dialect()))
+        self.assertIn("ON CONFLICT (item_api_id) DO UPDATE SET", sql)
+        self.assertIsNone(poefixer.PoeDb._upsert_command(
+            poefixer.Sale, fields, 'item_api_id', 'oracle'))
+
+    def _item_summary(self, db):
+        query = db.session.query(poefixer.Item).join(
+            poefixer.Stash, poefixer.Stash.id == poefixer.Item.stash_id)
+        query = query.add_columns(poefixer.Stash.api_id)
+        return sorted(
+            (row.api_id, row.Item.api_id, row.Item.name, row.Item.note,
+                row.Item.category, row.Item.active)
+            for row in query.all())
+
     def _sample_stashes(self):
         return [poefixer.ApiStash(s) for s in sample_stash_data()]
 
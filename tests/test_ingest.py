@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.ingest"""
+
+import time
+import unittest
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.extra.sample_data import sample_pages
+from poefixer.ingest import IngestPipeline
+
+
+class CannedApi(poefixer.PoeApi):
+    """A PoeApi that serves pre-built pages instead of using the network"""
+
+    def __init__(self, pages, delay=0, **kwargs):
+        super().__init__(rate=0, **kwargs)
+        self.pages = pages
+        self.delay = delay
+        self.requested = []
+        self.events = []
+
+    def fetch_raw(self, next_id=None, slow=False, on_next_id=None):
+        self.requested.append(next_id)
+        self.events.append(('start', next_id))
+        raw = self.pages[next_id]
+        if on_next_id is not None:
+            # As if the head of the body had arrived...
+            on_next_id(poefixer.extract_next_change_id(raw[:100]))
+        # ...and the rest of it took a while
+        time.sleep(self.delay)
+        self.events.append(('done', next_id))
+        return raw
+
+
+class TestIngestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+
+    def _get_default_db(self):
+        db = poefixer.PoeDb(db_connect='sqlite:///:memory:', logger=self.logger)
+        db.create_database()
+        return db
+
+    def _run(self, pages, **kwargs):
+        db = self._get_default_db()
+        api = CannedApi(sample_pages(pages), logger=self.logger)
+        pipeline = IngestPipeline(
+            api, db, max_pages=pages, logger=self.logger, **kwargs)
+        pipeline.run()
+        return (db, api, pipeline)
+
+    def test_pipeline_writes_all_pages(self):
+        db, api, pipeline = self._run(5, queue_size=1)
+
+        self.assertEqual(
+            api.requested, [None] + ['page-%d' % n for n in range(1, 5)])
+        self.assertEqual(pipeline.last_written_id, 'page-5')
+        self.assertEqual(db.session.query(poefixer.Stash).count(), 10)
+        self.assertEqual(db.session.query(poefixer.Item).count(), 30)
+        for name in ('fetch', 'decode', 'write'):
+            self.assertEqual(pipeline.stats[name].pages, 5)
+        self.assertEqual(pipeline.stats['decode'].stashes, 10)
+        self.assertEqual(pipeline.stats['write'].items, 30)
+
+    def test_pipeline_early_next_id(self):
+        db = self._get_default_db()
+        api = CannedApi(sample_pages(3), delay=0.2, logger=self.logger)
+        IngestPipeline(api, db, max_pages=3, logger=self.logger).run()
+
+        # The second request went out before the first one finished
+        self.assertLess(
+            api.events.index(('start', 'page-1')),
+            api.events.index(('done', None)))
+        self.assertEqual(db.session.query(poefixer.Stash).count(), 6)
+
+    def test_pipeline_single_fetcher(self):
+        db, api, _ = self._run(3, fetchers=1)
+
+        self.assertEqual(api.requested, [None, 'page-1', 'page-2'])
+        self.assertEqual(db.session.query(poefixer.Stash).count(), 6)
+
+    def test_pipeline_per_row(self):
+        db, _, _ = self._run(2, per_row=True)
+
+        self.assertEqual(db.session.query(poefixer.Item).count(), 12)
+
+    def test_pipeline_fetch_failure(self):
+        db = self._get_default_db()
+        # Only one page is available, so the second fetch fails
+        api = CannedApi(sample_pages(1), logger=self.logger)
+        pipeline = IngestPipeline(api, db, max_pages=3, logger=self.logger)
+
+        with self.assertRaises(RuntimeError):
+            pipeline.run()
+        self.assertEqual(db.session.query(poefixer.Stash).count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
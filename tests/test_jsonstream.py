@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.jsonstream"""
+
+import unittest
+
+import rapidjson as json
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.extra.sample_data import sample_stash_data
+from poefixer.jsonstream import StashStreamDecoder, iter_stash_stream
+
+
+def chunked(raw, size):
+    return [raw[i:i+size] for i in range(0, len(raw), size)]
+
+
+class ChunkedApi(poefixer.PoeApi):
+    """A PoeApi that serves one pre-built page in small chunks"""
+
+    def __init__(self, raw, **kwargs):
+        super().__init__(rate=0, **kwargs)
+        self.raw = raw
+        self.chunks_read = 0
+
+    def fetch_chunks(self, next_id=None, slow=False):
+        for chunk in chunked(self.raw, 64):
+            self.chunks_read += 1
+            yield chunk
+
+
+class TestStashStreamDecoder(unittest.TestCase):
+
+    def _page(self, **extra):
+        stashes = sample_stash_data()
+        # Make sure that JSON punctuation inside of strings is ignored
+        stashes[0]['stash'] = 'a "}{][,:\\ tab'
+        page = {'next_change_id': '1-2-3', 'stashes': stashes}
+        page.update(extra)
+        return (stashes, json.dumps(page).encode('utf-8'))
+
+    def test_any_chunk_size(self):
+        stashes, raw = self._page(trailer={'x': [1, {'y': '}'}]})
+        for size in (1, 2, 3, 17, len(raw)):
+            decoder = StashStreamDecoder()
+            decoded = []
+            for chunk in chunked(raw, size):
+                decoded += decoder.feed(chunk)
+            decoder.close()
+            self.assertEqual(decoded, stashes, "chunk size %s" % size)
+            self.assertEqual(decoder.next_change_id, '1-2-3')
+
+    def test_memory_is_bounded_by_stash(self):
+        stashes, raw = self._page()
+        largest = max(len(json.dumps(stash)) for stash in stashes)
+        decoder = StashStreamDecoder()
+        for chunk in chunked(raw, 10):
+            decoder.feed(chunk)
+            self.assertLess(len(decoder._buffer), largest + 10)
+
+    def test_truncated_page(self):
+        _, raw = self._page()
+        with self.assertRaises(ValueError):
+            list(iter_stash_stream([raw[:-20]]))
+
+    def test_streaming_api(self):
+        stashes, raw = self._page()
+        api = ChunkedApi(
+            raw, streaming=True,
+            logger=plogger.get_poefixer_logger('WARNING'))
+
+        generator = api.get_next()
+        # The next id is known before the page has been read
+        self.assertEqual(api.next_id, '1-2-3')
+        self.assertLess(api.chunks_read, 3)
+        ids = [stash.id for stash in generator]
+        self.assertEqual(ids, [stash['id'] for stash in stashes])
+        self.assertEqual(api.chunks_read, len(chunked(raw, 64)))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.extra.synthetic and poefixer.extra.mock_server"""
+
+import unittest
+
+import rapidjson as json
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.ingest import IngestPipeline
+from poefixer.ratelimit import TokenBucketLimiter
+from poefixer.extra.synthetic import SyntheticPages
+from poefixer.extra.mock_server import MockStashServer
+
+
+class TestMockServer(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+
+    def _server(self, **kwargs):
+        server = MockStashServer(logger=self.logger, **kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_synthetic_pages(self):
+        pages = SyntheticPages(seed=3, stashes_per_page=20)
+        self.assertEqual(
+            pages.page('3-7'),
+            SyntheticPages(seed=3, stashes_per_page=20).page('3-7'))
+        self.assertNotEqual(pages.page('3-7'), pages.page('3-8'))
+        with self.assertRaises(ValueError):
+            pages.page('4-7')
+
+        page = json.loads(pages.page(None))
+        self.assertEqual(page['next_change_id'], '3-1')
+        self.assertEqual(len(page['stashes']), 20)
+        items = [item for stash in page['stashes'] for item in stash['items']]
+        self.assertGreater(len(set(item['league'] for item in items)), 1)
+        self.assertTrue(any(
+            'currency' in item['category'] for item in items))
+        self.assertTrue(any(
+            item.get('note', '').startswith('~') for item in items))
+
+    def test_ingest(self):
+        server = self._server(
+            pages=SyntheticPages(stashes_per_page=10), max_pages=3)
+        db = poefixer.PoeDb(db_connect='sqlite:///:memory:', logger=self.logger)
+        db.create_database()
+        api = poefixer.PoeApi(
+            api_root=server.api_root, rate=0, logger=self.logger)
+        pipeline = IngestPipeline(api, db, max_pages=4, logger=self.logger)
+
+        pipeline.run()
+
+        # The fourth page is the empty end of the chain
+        self.assertEqual(pipeline.last_written_id, '0-3')
+        self.assertGreater(db.session.query(poefixer.Item).count(), 0)
+        self.assertEqual(server.throttled, 0)
+
+    def test_rate_limit(self):
+        server = self._server(rate_limit=[(3, 1, 1)])
+        limiter = TokenBucketLimiter(default_interval=0, logger=self.logger)
+        api = poefixer.PoeApi(
+            api_root=server.api_root, rate_limiter=limiter,
+            logger=plogger.get_poefixer_logger('ERROR'))
+        for _ in range(5):
+            list(api.get_next())
+        # The first burst runs into the limit, then the advertised
+        # limits are followed
+        self.assertEqual(limiter.metrics.requests, 5 + server.throttled)
+        self.assertEqual(api.next_id, '0-5')
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.postprocess.notes"""
+
+import unittest
+
+import poefixer.extra.logger as plogger
+from poefixer.postprocess.notes import PriceNoteParser
+
+
+class TestPriceNoteParser(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+
+    def test_parse(self):
+        parser = PriceNoteParser(logger=self.logger)
+        self.assertEqual(parser.parse("~price 1 chaos"), (1.0, 'Chaos Orb'))
+        self.assertEqual(parser.parse("~b/o 1/2 exa"), (0.5, 'Exalted Orb'))
+        self.assertEqual(parser.parse("~price x chaos"), (None, None))
+        self.assertEqual(parser.parse("no price here"), (None, None))
+        self.assertEqual(parser.parse(None), (None, None))
+        # A known first word is enough, without the rest of the name
+        self.assertEqual(
+            parser.parse("~price 2 Mirror of Kalandra"),
+            (2.0, 'Mirror of Kalandra'))
+
+    def test_cache(self):
+        parser = PriceNoteParser(cache_size=2, logger=self.logger)
+        for _ in range(3):
+            parser.parse("~price 1 chaos")
+        info = parser.cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 1))
+
+        parser.parse("~price 2 chaos")
+        parser.parse("~price 3 chaos")
+        self.assertEqual(parser.cache_info().currsize, 2)
+
+    def test_learned_names(self):
+        parser = PriceNoteParser(logger=self.logger)
+        self.assertEqual(parser.parse("~price 1 my-precious"), (None, None))
+
+        parser.set_actual_currencies({'my-precious': 'My Precious'})
+        self.assertEqual(
+            parser.parse("~price 1 my-precious"), (1.0, 'My Precious'))
+        # Learning the same names again keeps the cache
+        parser.set_actual_currencies({'my-precious': 'My Precious'})
+        self.assertEqual(parser.cache_info().currsize, 1)
+
+        # Official names win over names seen in the data
+        parser.set_actual_currencies({'chaos': 'Chaos Shard'})
+        self.assertEqual(parser.parse("~price 1 chaos"), (1.0, 'Chaos Orb'))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
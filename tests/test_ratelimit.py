@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.ratelimit"""
+
+import time
+import threading
+import unittest
+import http.server
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.ratelimit import TokenBucketLimiter
+
+
+class RateLimitedHandler(http.server.BaseHTTPRequestHandler):
+    """Serve an empty page, enforcing `hits` requests per `period`"""
+
+    hits = 10
+    period = 1
+    penalty = 2
+    requests = []
+    throttled = 0
+
+    def do_GET(self):
+        now = time.time()
+        cls = self.__class__
+        cls.requests = [t for t in cls.requests if t > now - cls.period]
+        cls.requests.append(now)
+        current = len(cls.requests)
+        body = b'{"next_change_id": "1", "stashes": []}'
+        if current > cls.hits:
+            cls.throttled += 1
+            self.send_response(429)
+            self.send_header('Retry-After', str(cls.penalty))
+        else:
+            self.send_response(200)
+        self.send_header('X-Rate-Limit-Rules', 'Ip')
+        self.send_header(
+            'X-Rate-Limit-Ip', '%s:%s:%s' % (cls.hits, cls.period, cls.penalty))
+        self.send_header(
+            'X-Rate-Limit-Ip-State', '%s:%s:0' % (current, cls.period))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+        RateLimitedHandler.requests = []
+        RateLimitedHandler.throttled = 0
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), RateLimitedHandler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.api_root = 'http://127.0.0.1:%s/' % self.server.server_port
+
+    def _api(self, limiter):
+        return poefixer.PoeApi(
+            api_root=self.api_root, rate_limiter=limiter, logger=self.logger)
+
+    def test_follows_server_policy(self):
+        limiter = TokenBucketLimiter(default_interval=0.01, logger=self.logger)
+        api = self._api(limiter)
+
+        for _ in range(10):
+            list(api.get_next())
+
+        self.assertEqual(RateLimitedHandler.throttled, 0)
+        self.assertEqual(limiter.metrics.requests, 10)
+        self.assertEqual(limiter.metrics.throttles, 0)
+        self.assertGreater(limiter.metrics.waits, 0)
+
+    def test_shared_between_apis(self):
+        limiter = TokenBucketLimiter(default_interval=0.01, logger=self.logger)
+        apis = [self._api(limiter) for _ in range(3)]
+
+        def pull(api):
+            for _ in range(3):
+                list(api.get_next())
+
+        threads = [threading.Thread(target=pull, args=(api,)) for api in apis]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(RateLimitedHandler.throttled, 0)
+        self.assertEqual(limiter.metrics.requests, 9)
+
+    def test_retry_after(self):
+        limiter = TokenBucketLimiter(default_interval=0.01, logger=self.logger)
+        limiter.update({'Retry-After': '0.3'}, 429)
+
+        start = time.time()
+        limiter.wait()
+
+        self.assertGreaterEqual(time.time() - start, 0.25)
+        self.assertEqual(limiter.metrics.throttles, 1)
+        self.assertEqual(limiter.metrics.waits, 1)
+
+    def test_slow(self):
+        api = poefixer.PoeApi(
+            api_root=self.api_root, rate=0.2, slow=True, logger=self.logger)
+        self.assertEqual(api.rate_limiter.min_interval, 0.2)
+
+        list(api.get_next())
+        # The server allows far more, but we wait from the end of the last
+        # request
+        start = time.time()
+        list(api.get_next())
+        self.assertGreaterEqual(time.time() - start, 0.15)
+        self.assertEqual(RateLimitedHandler.throttled, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
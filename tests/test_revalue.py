@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.postprocess.revalue"""
+
+import unittest
+
+import sqlalchemy
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.postprocess.revalue import SaleRevaluer
+from test_summary import process_currency, synthetic_db
+
+
+class TestSaleRevaluer(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+        self.db = synthetic_db(
+            8, self.logger, stashes_per_page=60, item_note_rate=0.8)
+        process_currency(self.db, self.logger)
+
+    def _sales(self):
+        query = self.db.session.query(poefixer.Sale).join(
+            poefixer.Item, poefixer.Item.id == poefixer.Sale.item_id)
+        self.db.session.expire_all()
+        return query.add_columns(poefixer.Item.league).all()
+
+    def _set_chaos(self, sale_id, value):
+        self.db.session.execute(
+            sqlalchemy.update(poefixer.Sale).where(
+                poefixer.Sale.id == sale_id).values(sale_amount_chaos=value))
+        self.db.session.commit()
+
+    def test_revalue(self):
+        revaluer = SaleRevaluer(self.db, logger=self.logger)
+        self.db.session.execute(
+            sqlalchemy.update(poefixer.Sale).values(sale_amount_chaos=None))
+        self.assertGreater(revaluer.revalue(), 1)
+
+        sales = self._sales()
+        valued = [row for row in sales if row.Sale.sale_amount_chaos is not None]
+        self.assertGreater(len(valued), len(sales) / 2)
+        for row in sales:
+            self.assertIsNotNone(row.Sale.valuation_version)
+            value = revaluer.conversions.value_of(
+                row.Sale.sale_currency, row.league)
+            if value is None:
+                self.assertIsNone(row.Sale.sale_amount_chaos)
+            else:
+                self.assertAlmostEqual(
+                    row.Sale.sale_amount_chaos, row.Sale.sale_amount * value)
+
+        # Nothing has changed, so sales valued already are left alone
+        chaos = next(
+            row.Sale for row in valued
+            if row.Sale.sale_currency == 'Chaos Orb')
+        other = next(
+            row.Sale for row in valued
+            if row.Sale.sale_currency != 'Chaos Orb')
+        self._set_chaos(chaos.id, -1)
+        self._set_chaos(other.id, -1)
+        self.assertEqual(revaluer.revalue(), 0)
+        self.assertEqual(self._chaos_of(other.id), -1)
+
+        # A change in one currency's value revalues only its sales
+        league = self.db.session.query(poefixer.Item.league).filter(
+            poefixer.Item.id == other.item_id).scalar()
+        summary = poefixer.CurrencySummary
+        self.db.session.execute(
+            sqlalchemy.update(summary).where(
+                summary.from_currency == other.sale_currency).where(
+                summary.league == league).values(mean=summary.mean * 2))
+        self.db.session.commit()
+        self.assertGreaterEqual(revaluer.revalue(), 1)
+        self.assertGreater(self._chaos_of(other.id), 0)
+        self.assertEqual(self._chaos_of(chaos.id), -1)
+
+    def _chaos_of(self, sale_id):
+        self.db.session.expire_all()
+        return self.db.session.query(poefixer.Sale.sale_amount_chaos).filter(
+            poefixer.Sale.id == sale_id).scalar()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
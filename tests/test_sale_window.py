@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.postprocess.sale_window"""
+
+import unittest
+
+import numpy
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.postprocess.sale_window import SaleWindow, SaleWindowStore
+from poefixer.postprocess.sketch import QuantileSketch
+from test_summary import process_currency, summary_rows, synthetic_db
+
+
+class TestSaleWindow(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+
+    def test_ring_buffer(self):
+        window = SaleWindow(capacity=2)
+        slots = [window.append(sale_id, sale_id * 10.0, 100 + sale_id)
+                 for sale_id in range(3)]
+        self.assertEqual(len(window.ids), 4)
+
+        window.kill(slots[1], 1)
+        # The dead entry is dropped with the expired one in front of it
+        self.assertEqual(window.evict(cutoff=100), [0])
+        self.assertEqual(len(window), 1)
+
+        # Wrap around the end of the buffer
+        for sale_id in range(3, 6):
+            window.append(sale_id, sale_id * 10.0, 100 + sale_id)
+        amounts, times = window.prices(cutoff=103)
+        self.assertEqual(list(amounts), [40.0, 50.0])
+        self.assertEqual(list(times), [104, 105])
+
+    def _summaries(self, sale_windows):
+        db = synthetic_db(2, self.logger, pages=3, item_note_rate=0.8)
+        process_currency(
+            db, self.logger, block_size=50, sale_windows=sale_windows)
+        return summary_rows(db, ('count', 'mean', 'standard_dev'))
+
+    def test_matches_database(self):
+        summaries = self._summaries(sale_windows=True)
+        self.assertGreater(len(summaries), 5)
+        self.assertEqual(summaries, self._summaries(sale_windows=False))
+
+    def test_reconcile(self):
+        """
+        Windows that another writer's sales went into are read again, and
+        our own sales leave them alone.
+        """
+
+        db = synthetic_db(3, self.logger, item_note_rate=0.8)
+        store = process_currency(db, self.logger).sale_windows
+        self.assertGreater(len(store), 1)
+        self.assertEqual(store.reconcile(), 0)
+
+        # Another process rewrites a sale
+        sale = db.session.query(poefixer.Sale).join(
+            poefixer.Item, poefixer.Sale.item_id == poefixer.Item.id).filter(
+                poefixer.Item.id.in_(
+                    [int(sale_id) for sale_id in store._slots])).first()
+        league = db.session.get(poefixer.Item, sale.item_id).league
+        key = (sale.name, sale.sale_currency, league)
+        sale.sale_amount *= 100
+        sale.updated_at = store._checked
+        db.session.commit()
+
+        windows = len(store)
+        self.assertEqual(store.reconcile(), 1)
+        self.assertEqual(len(store), windows - 1)
+        self.assertNotIn(key, store.windows)
+        self.assertNotIn(sale.item_id, store._slots)
+        amounts, _ = store._prices(*key, now=None)
+        self.assertIn(sale.sale_amount, list(amounts))
+
+    def test_sketches(self):
+        """
+        A window's sketch is merged from kept sketches of its hours, which
+        take in new sales, and an hour with a rewritten sale is redone.
+        """
+
+        db = poefixer.PoeDb(db_connect='sqlite:///:memory:', logger=self.logger)
+        db.create_database()
+        store = SaleWindowStore(db, relevant=10 * 3600, weight_increment=1)
+        key = ("Chaos Orb", "Exalted Orb", "Standard")
+        now = 100 * 3600
+        store.windows[key] = SaleWindow()
+        prices = numpy.random.RandomState(6).lognormal(3, 0.5, 300)
+        for sale_id, price in enumerate(prices):
+            store.record(sale_id, *key, price, now - 3 * 3600 + sale_id * 30)
+
+        def robust_stats():
+            amounts, _ = store._prices(*key, now=now)
+            return QuantileSketch(amounts).robust_stats()
+
+        sketch = store.sketch(*key, now=now)
+        self.assertEqual(len(sketch), len(prices))
+        hours = dict(store._sketches[key])
+        self.assertEqual(len(hours), 3)
+        store.record(1000, *key, 1.0, now - 600)
+        store.record(5, *key, 5000.0, now - 3 * 3600 + 150)
+        sketch = store.sketch(*key, now=now)
+        self.assertEqual(len(sketch), len(prices) + 1)
+        for got, want in zip(sketch.robust_stats(), robust_stats()):
+            self.assertAlmostEqual(got / want, 1, delta=0.02)
+        # Only the hour with the rewritten sale was sketched again
+        for hour, hour_sketch in store._sketches[key].items():
+            self.assertEqual(
+                hour_sketch is hours[hour], hour != now - 3 * 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
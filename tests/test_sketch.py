@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.postprocess.sketch"""
+
+import unittest
+
+import numpy
+
+import poefixer.extra.logger as plogger
+from poefixer.postprocess.sketch import QuantileSketch
+from test_summary import process_currency, summary_rows, synthetic_db
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('WARNING')
+        self.values = numpy.random.RandomState(4).lognormal(3, 0.5, 20000)
+
+    def test_quantiles(self):
+        sketch = QuantileSketch(self.values)
+        self.assertEqual(len(sketch), len(self.values))
+        self.assertLessEqual(len(sketch.means), sketch.compression)
+        for q in (0.01, 0.25, 0.5, 0.75, 0.99):
+            want = numpy.quantile(self.values, q)
+            self.assertAlmostEqual(sketch.quantile(q) / want, 1, delta=0.02)
+        self.assertEqual(sketch.quantile(0), self.values.min())
+        self.assertEqual(sketch.quantile(1), self.values.max())
+        self.assertEqual(QuantileSketch().robust_stats(), (None,) * 3)
+        self.assertEqual(QuantileSketch([5.0]).robust_stats(), (5.0, 0, 5.0))
+
+    def test_merge_and_bytes(self):
+        whole = QuantileSketch(self.values)
+        merged = QuantileSketch()
+        parts = []
+        for index in range(7):
+            part = QuantileSketch()
+            for value in self.values[index::7]:
+                part.add(value)
+            parts.append(part)
+            merged.merge(QuantileSketch.from_bytes(part.to_bytes()))
+        self.assertEqual(len(merged), len(whole))
+        for got, want in zip(merged.robust_stats(), whole.robust_stats()):
+            self.assertAlmostEqual(got / want, 1, delta=0.01)
+
+        # Merged all at once, leaving the parts alone
+        at_once = QuantileSketch.merged(parts)
+        self.assertEqual(len(at_once), len(whole))
+        self.assertEqual(len(parts[0]), len(self.values[::7]))
+        for got, want in zip(at_once.robust_stats(), whole.robust_stats()):
+            self.assertAlmostEqual(got / want, 1, delta=0.01)
+
+    def test_trolls(self):
+        # A few absurd listings drag the mean, but not the robust figures
+        prices = numpy.concatenate([
+            numpy.random.RandomState(5).normal(100, 5, 200),
+            [1, 1, 10000, 20000]])
+        median, spread, trimmed = QuantileSketch(prices).robust_stats()
+        self.assertGreater(prices.mean(), 200)
+        self.assertAlmostEqual(median, 100, delta=2)
+        self.assertAlmostEqual(trimmed, 100, delta=2)
+        self.assertLess(spread, 15)
+
+    def _summaries(self, rebuild=False, **kwargs):
+        db = synthetic_db(2, self.logger, pages=3, item_note_rate=0.8)
+        processor = process_currency(db, self.logger, **kwargs)
+        if rebuild:
+            processor.do_currency_rebuild()
+        rows = summary_rows(
+            db, ('median', 'interquartile_range', 'trimmed_mean'), places=None)
+        return dict((row[:3], row[3:]) for row in rows)
+
+    def test_summaries(self):
+        summaries = self._summaries()
+        self.assertGreater(len(summaries), 5)
+        for stats in summaries.values():
+            self.assertNotIn(None, stats)
+        self.assertEqual(summaries, self._summaries(sale_windows=False))
+        self.assertEqual(summaries, self._summaries(rebuild=True))
+
+        # Merged from the sketches of hourly buckets
+        bucketed = self._summaries(sale_windows=False, price_buckets=True)
+        self.assertEqual(set(bucketed), set(summaries))
+        for key, stats in summaries.items():
+            for got, want in zip(bucketed[key], stats):
+                self.assertAlmostEqual(got, want, delta=abs(want) * 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.stashapi"""
+
+import unittest
+
+import poefixer
+import poefixer.extra.logger as plogger
+from poefixer.extra.sample_data import sample_stash_data
+
+
+class TestCompactApiData(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = plogger.get_poefixer_logger('ERROR')
+
+    def test_matches_api_stash(self):
+        for data in sample_stash_data():
+            stash = poefixer.ApiStash(data)
+            compact = poefixer.CompactApiStash(data)
+            for field in poefixer.ApiStash.fields:
+                if field != 'items':
+                    self.assertEqual(
+                        getattr(compact, field), getattr(stash, field))
+            self.assertEqual(compact.api_item_count, stash.api_item_count)
+            for item, compact_item in zip(stash.items, compact.items):
+                for field in poefixer.ApiItem.fields:
+                    self.assertEqual(
+                        getattr(compact_item, field), getattr(item, field),
+                        field)
+
+    def test_markup_stripped(self):
+        data = sample_stash_data()[0]
+        data['items'][0]['name'] = '<<set:MS>><<set:M>><<set:S>>Behemoth Lock'
+        item = poefixer.CompactApiStash(data).items[0]
+        self.assertEqual(item.name, 'Behemoth Lock')
+        with self.assertRaises(AttributeError):
+            item.not_a_field = 1
+
+    def test_validation(self):
+        data = sample_stash_data()[0]
+        del data['items'][1]['league']
+        stash = poefixer.CompactApiStash(data, logger=self.logger)
+        self.assertEqual(len(stash.items), 2)
+        self.assertEqual(stash.api_item_count, 3)
+
+        del data['stashType']
+        with self.assertRaises(ValueError):
+            poefixer.CompactApiStash(data, logger=self.logger)
+
+    def test_compact_api(self):
+        data = sample_stash_data()
+        del data[1]['public']
+        api = poefixer.PoeApi(rate=0, compact=True, logger=self.logger)
+        stashes = list(api.stash_generator(data))
+        self.assertEqual(len(stashes), 1)
+        self.assertIsInstance(stashes[0], poefixer.CompactApiStash)
+
+    def test_bulk_insert(self):
+        db = poefixer.PoeDb(db_connect='sqlite:///:memory:')
+        db.create_database()
+        db.insert_api_stashes(
+            [poefixer.CompactApiStash(s) for s in sample_stash_data()],
+            with_items=True)
+        db.session.commit()
+        names = sorted(
+            row.typeLine for row in db.session.query(poefixer.Item).all())
+        self.assertEqual(len(names), 6)
+        self.assertIn('Cloth Belt', names)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
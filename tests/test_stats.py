@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""A unittest for poefixer.postprocess.stats"""
+
+import unittest
+
+import numpy
+
+from poefixer.postprocess.stats import \
+    weighted_price_stats, grouped_weighted_price_stats, bucket_price_stats
+
+
+class TestStats(unittest.TestCase):
+
+    def test_grouped_matches_single(self):
+        rng = numpy.random.RandomState(3)
+        prices = [
+            rng.uniform(1, 2, 12),
+            # Large spread with an outlier, so it is recalibrated
+            numpy.array([1.0, 1.1, 0.9, 1.0, 1.2, 1.0, 1.1, 400.0]),
+            numpy.array([5.0]),
+            numpy.array([2.0, 3.0])]
+        weights = [rng.uniform(0.1, 1, len(group)) for group in prices]
+        groups = numpy.concatenate([
+            numpy.full(len(group), index) for index, group in enumerate(prices)])
+
+        found = grouped_weighted_price_stats(
+            groups, numpy.concatenate(prices), numpy.concatenate(weights),
+            len(prices) + 1)
+        for index in range(len(prices)):
+            expected = weighted_price_stats(prices[index], weights[index])
+            for got, want in zip(found, expected):
+                self.assertAlmostEqual(float(got[index]), want)
+        # The last group has no prices
+        self.assertEqual(found[3][-1], 0)
+        self.assertEqual(found[3][1], 7)
+
+    def test_buckets_match_prices(self):
+        prices = numpy.array([1.0, 1.1, 0.9, 1.0, 1.2, 1.0, 1.1, 400.0])
+        weights = numpy.linspace(0.2, 1, len(prices))
+
+        # With one price per bucket, the buckets are the prices
+        found = bucket_price_stats(
+            numpy.ones(len(prices)), prices, numpy.zeros(len(prices)),
+            prices, prices, weights)
+        for got, want in zip(found, weighted_price_stats(prices, weights)):
+            self.assertAlmostEqual(got, want)
+
+        # Buckets of equally weighted prices, without the outlier
+        mean, stddev, weight, count = bucket_price_stats(
+            numpy.array([3, 4]), numpy.array([3.0, 4.4]),
+            numpy.array([0.05, 0.06]), numpy.array([0.9, 1.0]),
+            numpy.array([1.1, 1.2]), numpy.array([1.0, 1.0]))
+        self.assertAlmostEqual(mean, 1.0571428571)
+        self.assertEqual((weight, count), (7.0, 7))
+        self.assertEqual(
+            bucket_price_stats(*[numpy.array([])] * 6), (None,) * 4)
+
+    def test_buckets_keep_precision(self):
+        # A large mean and a small spread: summing raw squares loses it
+        rng = numpy.random.RandomState(5)
+        prices = 1e8 + rng.uniform(0, 0.01, 40)
+        weights = numpy.ones(len(prices))
+        buckets = numpy.array_split(prices, 4)
+        counts = numpy.array([len(bucket) for bucket in buckets])
+        minimums = numpy.array([bucket.min() for bucket in buckets])
+        mean, stddev, weight, count = bucket_price_stats(
+            counts,
+            numpy.array([bucket.sum() for bucket in buckets]),
+            numpy.array([
+                ((bucket - bucket.min())**2).sum() for bucket in buckets]),
+            minimums,
+            numpy.array([bucket.max() for bucket in buckets]),
+            numpy.ones(len(buckets)))
+        expected = weighted_price_stats(prices, weights)
+        self.assertAlmostEqual(mean, expected[0])
+        self.assertAlmostEqual(stddev / expected[1], 1.0, places=4)
+        self.assertEqual((weight, count), (40.0, 40))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sts=4:sw=4:ai:
@@ -2,14 +2,22 @@
 
 """A unittest for poefixer.db"""
 
+import os
+import time
 import logging
+import tempfile
 import unittest
+import unittest.mock
 import collections
 
+import sqlalchemy
+
 import poefixer
 import poefixer.extra.logger as plogger
 from poefixer.extra.sample_data import sample_stash_data
+from poefixer.extra.synthetic import SyntheticPages
 from poefixer.postprocess.currency import CurrencyPostprocessor
+from poefixer.postprocess.notes import PriceNoteParser
 
 
 class CurrencyStep:
@@ -55,6 +63,69 @@ class CurrencyStep:
         return self.currency
 
 
+def synthetic_db(
+        seed, logger, pages=1, db_connect='sqlite:///:memory:',
+        stashes_per_page=40, item_note_rate=None, **db_kwargs):
+    """
+    Return a new database holding the first `pages` pages of synthetic
+    stashes for `seed`. Any other keyword arguments go to PoeDb.
+    """
+
+    db = poefixer.PoeDb(db_connect=db_connect, logger=logger, **db_kwargs)
+    db.create_database()
+    synthetic = SyntheticPages(
+        seed=seed, stashes_per_page=stashes_per_page,
+        item_note_rate=item_note_rate)
+    change_id = None
+    for _ in range(pages):
+        db.insert_api_stashes(
+            [poefixer.ApiStash(stash) for stash in synthetic.stashes(change_id)],
+            with_items=True)
+        change_id = synthetic.next_change_id(change_id)
+    db.session.commit()
+    return db
+
+def process_currency(db, logger, block_size=None, **kwargs):
+    """
+    Run one currency postprocessor pass over `db` and return the
+    postprocessor. Any other keyword arguments go to CurrencyPostprocessor.
+    """
+
+    cp = CurrencyPostprocessor(
+        db, start_time=None, recent=None, logger=logger, **kwargs)
+    if block_size:
+        cp.block_size = block_size
+    cp.do_currency_postprocessor()
+    return cp
+
+def sale_rows(
+        db, columns=('item_api_id', 'name', 'sale_currency', 'sale_amount')):
+    """The sorted `columns` of every sale in `db`"""
+
+    db.session.expire_all()
+    return sorted(
+        tuple(getattr(row, column) for column in columns)
+        for row in db.session.query(poefixer.Sale))
+
+def summary_rows(db, columns=('count', 'mean'), places=9):
+    """
+    The sorted currency pair, league and `columns` of every summary in
+    `db`, with floats rounded to `places` (if not None).
+    """
+
+    def value(row, column):
+        value = getattr(row, column)
+        if places is not None and isinstance(value, float):
+            return round(value, places)
+        return value
+
+    db.session.expire_all()
+    return sorted(
+        (row.from_currency, row.to_currency, row.league) +
+            tuple(value(row, column) for column in columns)
+        for row in db.session.query(poefixer.CurrencySummary))
+
+
 class TestPoefixerDb(unittest.TestCase):
 
     DB_URI = 'sqlite:///:memory:'
@@ -103,6 +174,303 @@ class TestPoefixerDb(unittest.TestCase):
         self.assertAlmostEqual(row.mean, 0.01)
         self.assertEqual(row.league, 'Standard')
 
+    def test_keyset_resume(self):
+        """
+        Blocks are read by seeking past the last (updated_at, id), even
+        when many rows share an updated_at, and an interrupted run picks
+        up after the last committed block.
+        """
+
+        stashes = sample_stashes(
+            [("Chaos Orb", "Exalted Orb", 0.01) for _ in range(7)])
+        db = self._get_default_db()
+        for stash in stashes:
+            db.insert_api_stash(stash, with_items=True)
+        db.session.commit()
+
+        cp = self._currency_postprocessor(db)
+        cp.block_size = 2
+        cp.limit = 3
+        cp.do_currency_postprocessor()
+        self.assertEqual(db.session.query(poefixer.Sale).count(), 4)
+        watermark = cp.get_watermark()
+        self.assertEqual(
+            watermark[1],
+            sorted(row.id for row in db.session.query(poefixer.Item))[3])
+
+        cp = self._currency_postprocessor(db)
+        cp.block_size = 2
+        cp.do_currency_postprocessor()
+        self.assertEqual(db.session.query(poefixer.Sale).count(), 7)
+        self.assertEqual(
+            cp.get_watermark()[1],
+            max(row.id for row in db.session.query(poefixer.Item)))
+
+        # Nothing new, so nothing more to do
+        self.assertEqual(
+            cp._currency_processor_single_pass(None, cp.get_watermark()),
+            (0, None))
+
+    def test_resume_slack(self):
+        """
+        A row that lands behind the watermark after a pass, in the
+        watermark's second with a lower id, is still picked up, and rows
+        already priced are not processed again.
+        """
+
+        stashes = sample_stashes(
+            [("Chaos Orb", "Exalted Orb", 0.01) for _ in range(5)])
+        db = self._get_default_db()
+        for stash in stashes:
+            db.insert_api_stash(stash, with_items=True)
+        db.session.commit()
+        first = min(row.id for row in db.session.query(poefixer.Item))
+        late = db.session.get(poefixer.Item, first)
+        late.note = None
+        db.session.commit()
+
+        cp = self._currency_postprocessor(db)
+        cp.do_currency_postprocessor()
+        self.assertEqual(db.session.query(poefixer.Sale).count(), 4)
+        watermark = cp.get_watermark()
+        self.assertGreater(watermark[1], first)
+
+        late.note = '~price 2 chaos'
+        late.updated_at = watermark[0]
+        db.session.commit()
+
+        cp = self._currency_postprocessor(db)
+        cp.do_currency_postprocessor()
+        self.assertEqual(db.session.query(poefixer.Sale).count(), 5)
+        sale = db.session.query(poefixer.Sale).filter(
+            poefixer.Sale.item_id == first).one()
+        self.assertEqual(sale.sale_amount, 2)
+        self.assertEqual(cp.get_watermark(), watermark)
+
+        # The priced rows behind the watermark are not read again
+        self.assertEqual(
+            cp._currency_processor_single_pass(
+                watermark[0] - cp.watermark_slack, seen=watermark),
+            (0, None))
+
+    def test_continuous_idle(self):
+        """
+        In continuous mode, a pass that finds nothing new to process
+        pauses before the next one.
+        """
+
+        class Idle(Exception):
+            pass
+
+        stashes = sample_stashes(
+            [("Chaos Orb", "Exalted Orb", 0.01) for _ in range(5)])
+        db = self._get_default_db()
+        for stash in stashes:
+            db.insert_api_stash(stash, with_items=True)
+        db.session.commit()
+
+        cp = CurrencyPostprocessor(
+            db, start_time=None, recent=None, continuous=True,
+            logger=self.logger)
+        passes = []
+        single_pass = cp._currency_processor_single_pass
+
+        def counted_pass(*args, **kwargs):
+            passes.append(single_pass(*args, **kwargs))
+            return passes[-1]
+
+        def sleep(seconds):
+            raise Idle()
+
+        cp._currency_processor_single_pass = counted_pass
+        with unittest.mock.patch.object(time, 'sleep', sleep):
+            with self.assertRaises(Idle):
+                cp.do_currency_postprocessor()
+        self.assertEqual([rows for rows, _ in passes], [5, 0])
+        self.assertEqual(db.session.query(poefixer.Sale).count(), 5)
+
+    def test_deferred_summaries(self):
+        """
+        Summarizing once per block ends up with the same summaries as
+        summarizing after every sale, and values the block's sales.
+        """
+
+        def summarize(deferred):
+            db = synthetic_db(
+                None, self.logger, stashes_per_page=60, item_note_rate=0.8)
+            process_currency(
+                db, self.logger, block_size=100, deferred=deferred)
+            return (db, summary_rows(db))
+
+        (_, immediate) = summarize(False)
+        (db, deferred) = summarize(True)
+        self.assertGreater(len(deferred), 5)
+        self.assertEqual(deferred, immediate)
+
+        sales = db.session.query(poefixer.Sale).join(
+            poefixer.Item, poefixer.Item.id == poefixer.Sale.item_id)
+        sales = sales.add_columns(poefixer.Item.league).all()
+        valued = [row for row in sales if row.Sale.sale_amount_chaos is not None]
+        self.assertGreater(len(valued), len(sales) / 2)
+        for row in valued:
+            if row.Sale.sale_currency == 'Chaos Orb':
+                self.assertEqual(
+                    row.Sale.sale_amount_chaos, row.Sale.sale_amount)
+
+    def test_batched_sales(self):
+        """
+        Writing a block's sales with one upsert leaves the same sales as
+        writing them one at a time, including when items are reprocessed.
+        """
+
+        def process(deferred):
+            db = synthetic_db(3, self.logger)
+            cp = process_currency(
+                db, self.logger, block_size=50, deferred=deferred)
+
+            # Reprice some items, so that their sales are rewritten
+            items = db.session.query(poefixer.Item).filter(
+                poefixer.Item.note.isnot(None)).limit(20).all()
+            for item in items:
+                item.note = '~price 3 chaos'
+                item.updated_at += 1
+            db.session.commit()
+            cp.do_currency_postprocessor()
+            return sale_rows(db)
+
+        immediate = process(False)
+        self.assertGreater(len(immediate), 20)
+        self.assertEqual(process(True), immediate)
+        self.assertGreaterEqual(
+            sum(1 for row in immediate if row[2:4] == ('Chaos Orb', 3.0)), 20)
+
+    def test_prices_at_ingest(self):
+        """
+        Items priced at ingest give the same sales as parsing their notes
+        in the postprocessor.
+        """
+
+        def process(price_parser):
+            db = synthetic_db(4, self.logger, price_parser=price_parser)
+            process_currency(db, self.logger)
+            return sale_rows(db)
+
+        parsed = process(PriceNoteParser(logger=self.logger).parse)
+        self.assertGreater(len(parsed), 20)
+        self.assertEqual(parsed, process(None))
+
+    def test_item_categories(self):
+        """
+        Items written before category_root and is_currency existed are
+        still recognised as currency, and currency-only passes skip
+        everything else.
+        """
+
+        def process(legacy=False, currency_only=False):
+            db = synthetic_db(5, self.logger)
+            if legacy:
+                db.session.execute(
+                    sqlalchemy.update(poefixer.Item).values(
+                        category_root=None, is_currency=None))
+                db.session.commit()
+            process_currency(db, self.logger, currency_only=currency_only)
+            return sale_rows(
+                db, ('item_api_id', 'name', 'is_currency', 'sale_amount'))
+
+        sales = process()
+        self.assertTrue(any(sale[2] for sale in sales))
+        self.assertFalse(all(sale[2] for sale in sales))
+        self.assertEqual(process(legacy=True), sales)
+        self.assertEqual(
+            process(currency_only=True), [sale for sale in sales if sale[2]])
+        self.assertEqual(
+            process(legacy=True, currency_only=True),
+            [sale for sale in sales if sale[2]])
+
+    def test_parallel_workers(self):
+        """
+        Sharding a pass over worker processes gives the same sales and
+        summaries as a single process, and moves the shared watermark to
+        the end of the pass.
+        """
+
+        def process(workers, path):
+            db = synthetic_db(6, self.logger, db_connect='sqlite:///' + path)
+            # Some items from before shard keys were written at ingest
+            db.session.execute(
+                sqlalchemy.update(poefixer.Item).where(
+                    poefixer.Item.id % 3 == 0).values(shard_key=None))
+            db.session.commit()
+            cp = process_currency(
+                db, self.logger, block_size=50, workers=workers)
+            watermarks = dict(
+                (row.name, (row.item_updated_at, row.item_id))
+                for row in db.session.query(poefixer.ProcessingWatermark))
+            unkeyed = db.session.query(poefixer.Item).filter(
+                poefixer.Item.shard_key.is_(None)).count()
+            return (
+                sale_rows(db), summary_rows(db), watermarks,
+                cp._last_item_key(), unkeyed)
+
+        with tempfile.TemporaryDirectory() as directory:
+            (sales, summaries, _, _, _) = process(
+                None, os.path.join(directory, 'single.db'))
+            (p_sales, p_summaries, watermarks, last, unkeyed) = process(
+                2, os.path.join(directory, 'parallel.db'))
+
+        self.assertGreater(len(sales), 20)
+        self.assertEqual(unkeyed, 0)
+        self.assertEqual(p_sales, sales)
+        self.assertEqual(p_summaries, summaries)
+        self.assertEqual(watermarks, {'currency': last})
+
+    def test_rebuild(self):
+        """
+        Rebuilding the summaries from the sale table gives what processing
+        the sales one at a time left, and revalues the sales.
+        """
+
+        db = synthetic_db(
+            7, self.logger, stashes_per_page=60, item_note_rate=0.8)
+        cp = process_currency(db, self.logger)
+
+        def summaries():
+            return summary_rows(
+                db, ('count', 'mean', 'standard_dev', 'weight'), places=6)
+
+        incremental = summaries()
+        self.assertGreater(len(incremental), 5)
+        db.session.execute(
+            sqlalchemy.update(poefixer.Sale).values(sale_amount_chaos=None))
+        db.session.execute(
+            sqlalchemy.update(poefixer.CurrencySummary).values(mean=-1))
+        # A summary with no recent sales is left as it was
+        now = int(time.time())
+        old = (
+            "Chaos Orb", "Mirror of Kalandra", "Standard", 3, 0.0001, 0.0,
+            1.0)
+        db.session.add(poefixer.CurrencySummary(
+            **dict(zip(
+                ('from_currency', 'to_currency', 'league', 'count', 'mean',
+                    'standard_dev', 'weight'), old)),
+            created_at=now, updated_at=now))
+        db.session.commit()
+        cp.do_currency_rebuild()
+        self.assertEqual(summaries(), sorted(incremental + [old]))
+
+        sales = db.session.query(poefixer.Sale).join(
+            poefixer.Item, poefixer.Item.id == poefixer.Sale.item_id)
+        sales = sales.add_columns(poefixer.Item.league).all()
+        valued = [row for row in sales if row.Sale.sale_amount_chaos is not None]
+        self.assertGreater(len(valued), len(sales) / 2)
+        for row in sales:
+            expected = cp.find_value_of(
+                row.Sale.sale_currency, row.league, row.Sale.sale_amount)
+            if expected is None:
+                self.assertIsNone(row.Sale.sale_amount_chaos)
+            else:
+                self.assertAlmostEqual(row.Sale.sale_amount_chaos, expected)
+
     def test_actual_currency_name(self):
         """
         Test the dynamic currency name handling based on data